@@ -1,2 +1,3 @@
-from datamijn.parsing import parse_definition, parse, Terminator, \
-    ResolveError, ParseError
+from datamijn.parsing import parse_definition, parse, compile, Schema, \
+    Terminator, ResolveError, ParseError, primitive, pipe_stage, \
+    register_primitive, register_pipe_stage
@@ -1,9 +1,8 @@
 import click
 
-from datamijn.parsing import parse_definition, parse
-import json
+from datamijn.parsing import compile, BACKENDS, PROVENANCE_LEVELS
 
-DATAMIJN_OUTPUTS = ["pretty_repr", "json", "typescript", "repl", "ipython", "browser", "profiler"]
+DATAMIJN_OUTPUTS = ["pretty_repr", "json", "typescript", "repl", "ipython", "browser", "profiler", "layout"]
 
 @click.command('datamijn')
 @click.argument('struct-filename', type=click.Path(exists=True))
@@ -11,22 +10,38 @@ DATAMIJN_OUTPUTS = ["pretty_repr", "json", "typescript", "repl", "ipython", "bro
 @click.argument('output', type=click.Choice(DATAMIJN_OUTPUTS), default="pretty_repr")
 @click.option('-p', '--show-private', is_flag=True)
 @click.option('-l', '--lenient', is_flag=True)
-def cli(struct_filename, binary_filename, output, show_private, lenient):
+@click.option('--no-cache', is_flag=True, help="Don't use or update the resolved definition cache.")
+@click.option('-b', '--backend', type=click.Choice(BACKENDS), default="interpreter")
+@click.option('--provenance', type=click.Choice(PROVENANCE_LEVELS), default="full",
+    help="How much of where each value came from to keep.")
+@click.option('--pipe-window', type=click.IntRange(min=0), default=None,
+    help="How many bytes back pipes keep for back-references (all by default).")
+@click.option('--lazy', is_flag=True,
+    help="Parse structs and arrays of fixed-size elements as they're looked at.")
+def cli(struct_filename, binary_filename, output, show_private, lenient, no_cache, backend, provenance, pipe_window, lazy):
     struct_file = open(struct_filename, 'r')
-    binary_file = open(binary_filename, 'rb')
     if output == "profiler":
         from profiling.tracing import TracingProfiler
         profiler = TracingProfiler()
         print("Profiling...")
         profiler.start()
     
-    result = parse(struct_file, binary_file, lenient=lenient)
+    schema = compile(struct_file, cache=not no_cache, backend=backend)
+    if output == "layout":
+        # Only depends on the definition.
+        print(schema.layout())
+        return
+    
+    result = schema.parse(binary_filename,
+        lenient=lenient, provenance=provenance, pipe_window=pipe_window, lazy=lazy)
 
     if output == "pretty_repr":
         print(result._pretty_repr())
     elif output == "json":
+        import json
         print(json.dumps(result._json(), indent=4, ensure_ascii=False))
     elif output == "typescript":
+        import json
         print("// Code generated by datamijn")
         for key, value in result._json().items():
             value = json.dumps(result._json(), indent='\t', ensure_ascii=False)
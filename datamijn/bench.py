@@ -0,0 +1,575 @@
+""" Parse-time benchmarks.
+
+    python -m datamijn.bench [name ...]
+
+Runs every benchmark by default.  Times are the best of several runs. """
+import os
+import sys
+import time
+import tracemalloc
+
+import datamijn
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def best_time(func, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def retained_memory(func):
+    """ Memory still held by what `func` returns. """
+    tracemalloc.start()
+    try:
+        result = func()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+def report(name, baseline, timings, records=1, unit="record"):
+    """ Prints each of `timings` next to `baseline`, per record. """
+    base_name, base_time = baseline
+    print(f"  {name}")
+    print(f"    {base_name:<14} {base_time/records*1e6:10.2f} µs/{unit}")
+    for label, elapsed in timings:
+        print(f"    {label:<14} {elapsed/records*1e6:10.2f} µs/{unit}  {base_time/elapsed:5.2f}x")
+
+# Definitions from the test suite, repeated over many records.
+RECORD_DEFINITIONS = {
+    "coords": ("""
+:Coords {
+    x       U8
+    y       U8
+    nested  {
+        z       U8
+    }
+}
+records [{count}]Coords
+""", bytes(range(3))),
+    "computed": ("""
+:Test {
+    x       U8
+    y       S8
+    z       U16
+    = x * 2 + y + z
+}
+records [{count}]Test
+""", bytes(range(4))),
+    "match": ("""
+:Item   U8 match {
+    0       => :Zero
+    1       => U8 match {
+        1 => 11
+        2 => 12
+    }
+    2..4    => 2
+    x       => x + 1
+}
+records [{count}]Item
+""", b"\x01\x02\x00\x03\x20"),
+}
+
+@benchmark
+def codegen(count=5000):
+    print(f"codegen: interpreter vs. generated code, {count} records")
+    for name, (dm, record) in RECORD_DEFINITIONS.items():
+        dm = dm.replace("{count}", str(count))
+        data = record * count
+        interpreted = datamijn.compile(dm)
+        generated = datamijn.compile(dm, backend="codegen")
+        assert interpreted.parse(data)._json() == generated.parse(data)._json()
+        report(name,
+            ("interpreter", best_time(lambda: interpreted.parse(data))),
+            [("codegen", best_time(lambda: generated.parse(data)))],
+            records=count)
+
+@benchmark
+def fixed_layout(count=5000):
+    print(f"fixed_layout: field by field vs. unpack_from, {count} records")
+    dm = """
+:Record {
+    a       U8
+    b       S8
+    c       U16
+    d       U32
+}
+records [{count}]Record
+""".replace("{count}", str(count))
+    data = bytes(range(8)) * count
+    unpacked = datamijn.compile(dm)
+    parsed = datamijn.compile(dm)
+    record = parsed._struct._contents["records"]._parsetype
+    record._layout = None
+    assert unpacked.parse(data) == parsed.parse(data)
+    report("records",
+        ("field by field", best_time(lambda: parsed.parse(data))),
+        [("unpack_from", best_time(lambda: unpacked.parse(data)))],
+        records=count)
+
+@benchmark
+def numeric_array(count=65536):
+    print(f"numeric_array: list of objects vs. numpy, {count} elements")
+    from datamijn.dmtypes import NumericArray
+    dm = f"""
+u8      [{count}]U8
+u16     [{count // 2}]U16
+"""
+    data = bytes(range(256)) * (count // 128)
+    accepts = NumericArray.__dict__["_accepts"]
+    NumericArray._accepts = classmethod(lambda self, array: False)
+    try:
+        lists = datamijn.compile(dm)
+    finally:
+        NumericArray._accepts = accepts
+    arrays = datamijn.compile(dm)
+    assert isinstance(arrays.parse(data).u8, NumericArray)
+    assert lists.parse(data)._json() == arrays.parse(data)._json()
+    report("parse",
+        ("list", best_time(lambda: lists.parse(data), repeat=3)),
+        [("numpy", best_time(lambda: arrays.parse(data), repeat=3))],
+        unit="parse")
+    list_memory = peak_memory(lambda: lists.parse(data))
+    array_memory = peak_memory(lambda: arrays.parse(data))
+    print(f"    peak memory    list {list_memory/1024:.0f} KiB, numpy {array_memory/1024:.0f} KiB")
+
+@benchmark
+def input_source(count=5000):
+    print(f"input_source: BytesIO with bits vs. buffer with a cursor, {count} records")
+    from datamijn.dmtypes import BytesIOWithBits
+    for name in ("coords", "computed"):
+        dm, record = RECORD_DEFINITIONS[name]
+        schema = datamijn.compile(dm.replace("{count}", str(count)))
+        data = record * count
+        assert schema._parse_stream(BytesIOWithBits(data))._json() == schema.parse(data)._json()
+        report(name,
+            ("BytesIO", best_time(lambda: schema._parse_stream(BytesIOWithBits(data)))),
+            [("cursor", best_time(lambda: schema.parse(data)))],
+            records=count)
+
+@benchmark
+def bit_fields(count=5000):
+    print(f"bit_fields: bit by bit vs. word-buffered reads, {count} GB colors")
+    from datamijn.dmtypes import BytesIOWithBits
+    
+    class BitByBit(BytesIOWithBits):
+        # How read_bits used to work.
+        def read_bits(self, bits, msb=False):
+            num = 0
+            for i in range(bits):
+                num |= self.read_bit() << i
+            return num
+    
+    schema = datamijn.compile(f"""
+colors [{count}]{{
+    r      B5
+    g      B5
+    b      B5
+    _      B1
+}}
+""")
+    data = bytes(range(256)) * (count // 128 + 1)
+    assert schema._parse_stream(BitByBit(data))._json() == schema.parse(data)._json()
+    report("colors",
+        ("bit by bit", best_time(lambda: schema._parse_stream(BitByBit(data)))),
+        [("BytesIO", best_time(lambda: schema._parse_stream(BytesIOWithBits(data)))),
+         ("cursor", best_time(lambda: schema.parse(data)))],
+        records=count)
+
+def without_bit_runs(type_, seen=None):
+    seen = seen if seen is not None else set()
+    if not isinstance(type_, type) or id(type_) in seen:
+        return
+    seen.add(id(type_))
+    if getattr(type_, "_bit_runs", None):
+        type_._bit_runs = None
+    for sub in list(getattr(type_, "_contents", {}).values()) + \
+      [getattr(type_, "_parsetype", None), getattr(type_, "_type", None)]:
+        without_bit_runs(sub, seen)
+
+@benchmark
+def bit_runs(count=1000):
+    print(f"bit_runs: field by field vs. one read per run, {count} palettes")
+    for name, dm in (
+        ("GBPalette", f"palettes [{count}]GBPalette"),
+        ("plain", f"""
+palettes [{count}][4]{{
+    r      B5
+    g      B5
+    b      B5
+    _      B1
+}}
+"""),
+    ):
+        data = bytes(range(256)) * (count // 32 + 1)
+        runs = datamijn.compile(dm)
+        fields = datamijn.compile(dm)
+        without_bit_runs(fields._struct)
+        assert runs.parse(data)._pretty_repr() == fields.parse(data)._pretty_repr()
+        report(name,
+            ("field by field", best_time(lambda: fields.parse(data))),
+            [("runs", best_time(lambda: runs.parse(data)))],
+            records=count * 4, unit="color")
+
+@benchmark
+def provenance(count=5000):
+    print(f"provenance: parse time and peak memory per level, {count} records")
+    for name, (dm, record) in RECORD_DEFINITIONS.items():
+        dm = dm.replace("{count}", str(count))
+        data = record * count
+        for backend in ("interpreter", "codegen"):
+            schema = datamijn.compile(dm, backend=backend)
+            timings = {level: best_time(lambda: schema.parse(data, provenance=level))
+                for level in ("full", "addresses", "none")}
+            report(f"{name} ({backend})", ("full", timings.pop("full")),
+                list(timings.items()), records=count)
+            memory = {level: peak_memory(lambda: schema.parse(data, provenance=level))
+                for level in ("full", "addresses", "none")}
+            print("    peak memory    " + ", ".join(f"{level} {size/1024:.0f} KiB"
+                for level, size in memory.items()))
+
+@benchmark
+def plain_result(count=5000):
+    print(f"plain_result: rich objects and _json() vs. plain results, {count} records")
+    for name, (dm, record) in RECORD_DEFINITIONS.items():
+        schema = datamijn.compile(dm.replace("{count}", str(count)))
+        data = record * count
+        assert schema.parse(data)._json() == schema.parse(data, result="plain")
+        report(name,
+            ("rich, _json()", best_time(lambda: schema.parse(data)._json())),
+            [("plain", best_time(lambda: schema.parse(data, result="plain")))],
+            records=count)
+        print(f"    retained       rich {retained_memory(lambda: schema.parse(data))/1024:.0f} KiB, "
+            f"plain {retained_memory(lambda: schema.parse(data, result='plain'))/1024:.0f} KiB")
+
+@benchmark
+def parse_state(count=100000):
+    print(f"parse_state: parse time and peak memory without provenance, {count} records")
+    for name, (dm, record) in RECORD_DEFINITIONS.items():
+        dm = dm.replace("{count}", str(count))
+        data = record * count
+        for backend in ("interpreter", "codegen"):
+            schema = datamijn.compile(dm, backend=backend)
+            elapsed = best_time(lambda: schema.parse(data, provenance="none"), repeat=3)
+            memory = peak_memory(lambda: schema.parse(data, provenance="none"))
+            label = f"{name} ({backend})"
+            print(f"  {label:<24} {elapsed/count*1e6:6.2f} µs/record, peak {memory/1024/1024:.1f} MiB")
+
+NESTED_COUNT_DM = """
+count   U8
+:Record {
+    a {
+        b {
+            c {
+                values [count]U8
+            }
+        }
+    }
+}
+records [{count}]Record
+"""
+
+@benchmark
+def name_binding(count=20000):
+    print(f"name_binding: a count four scopes up, {count} records")
+    data = bytes([2]) + bytes(range(2)) * count
+    for backend in ("interpreter", "codegen"):
+        schema = datamijn.compile(NESTED_COUNT_DM.replace("{count}", str(count)), backend=backend)
+        elapsed = best_time(lambda: schema.parse(data, provenance="none"), repeat=3)
+        print(f"  {backend:<14} {elapsed/count*1e6:10.2f} µs/record")
+
+def char_table_dm(count, ranges=False):
+    """ A 256-entry character table, or the same table with its upper half
+    given as ranges. """
+    entries = [f'    {i} => "{chr(0x61 + i % 26)}"' for i in range(128 if ranges else 256)]
+    if ranges:
+        entries += [f'    {i}..{i + 16} => "{chr(0x41 + i // 16)}"' for i in range(128, 256, 16)]
+    return ":Char U8 char match {\n" + "\n".join(entries) + "\n}\n" \
+        + f"text [{count}]Char\n"
+
+@benchmark
+def match_table(count=20000):
+    print(f"match_table: a 256-entry character table, {count} characters")
+    data = bytes(range(256)) * (count // 256) + bytes(count % 256)
+    for label, ranges in (("keys", False), ("ranges", True)):
+        schemas = [datamijn.compile(char_table_dm(count, ranges), backend=backend)
+            for backend in ("interpreter", "codegen")]
+        timings = [best_time(lambda: schema.parse(data, provenance="none"), repeat=3)
+            for schema in schemas]
+        report(label, ("interpreter", timings[0]), [("codegen", timings[1])],
+            records=count, unit="char")
+        
+        # The lookup alone, with and without the dense table.
+        match = schemas[0]._struct._contents["text"]._parsetype
+        lookup = lambda: [match._branch(key) for key in data]
+        tabled = best_time(lookup)
+        table, match._table = match._table, None
+        untabled = best_time(lookup)
+        match._table = table
+        report(f"{label}, lookup", ("dict, bisect", untabled), [("table", tabled)],
+            records=count, unit="char")
+
+@benchmark
+def char_strings(count=20000):
+    print(f"char_strings: text through a character table, {count} characters")
+    table = open(os.path.join(os.path.dirname(__file__), "test/ascii.dm")).read()
+    words = bytes(range(0x41, 0x5b)) * (count // 26 + 1)
+    cases = (
+        ("one string", "text [] Char\n", words[:count] + b"\x00"),
+        ("20-char strings", f"texts [{count // 20}][] Char\n",
+            (words[:19] + b"\x00") * (count // 20)),
+    )
+    for label, dm, data in cases:
+        schema = datamijn.compile(table + dm)
+        char = schema._struct._types["Char"]
+        tabled = best_time(lambda: schema.parse(data, provenance="none"), repeat=3)
+        translation, char._translation = char._translation, None
+        untabled = best_time(lambda: schema.parse(data, provenance="none"), repeat=3)
+        char._translation = translation
+        report(label, ("per character", untabled), [("translated", tabled)],
+            records=count, unit="char")
+
+CONTROL_CODE_DM = """
+:Char            U8 char match {
+    0x20 => " "
+    0x41..0x5b => "x"
+    0xe1 => :TextSpeed  U8
+    0x00 => Terminator
+}
+text [] Char
+"""
+
+@benchmark
+def concat(count=10000):
+    print(f"concat: {count}-character strings, one character at a time")
+    words = (bytes(range(0x41, 0x5b)) + b" ") * (count // 27 + 1)
+    speed = b"\xe1\x01" + words[:48]
+    cases = (
+        ("plain", words[:count] + b"\x00"),
+        ("control codes", speed * (count // 50) + b"\x00"),
+    )
+    schema = datamijn.compile(CONTROL_CODE_DM)
+    # As when parsing from a pipe.
+    schema._struct._types["Char"]._translation = None
+    for label, data in cases:
+        text = schema.parse(data, provenance="none").text
+        timings = [
+            ("parse", best_time(lambda: schema.parse(data, provenance="none"), repeat=3)),
+            ("str", best_time(lambda: str(type(text)(text)), repeat=3)),
+        ]
+        print(f"  {label}, {len(text)} items")
+        for name, elapsed in timings:
+            print(f"    {name:<14} {elapsed/count*1e6:10.2f} µs/char")
+
+@benchmark
+def pipe_buffer(count=262144):
+    print(f"pipe_buffer: {count} bytes yielded through a pipe one at a time")
+    dm = f"data {{\n    < Byte\n}} | [{count // 4}]U32\n"
+    schema = datamijn.compile(dm)
+    data = bytes(range(256)) * (count // 256)
+    for window in (None, 4096):
+        parse = lambda: schema.parse(data, provenance="none", pipe_window=window)
+        elapsed = best_time(parse, repeat=3)
+        print(f"  window {window}: {elapsed/count*1e6:.2f} µs/byte, "
+            f"peak {peak_memory(parse)/1e6:.1f} MB")
+
+@benchmark
+def byte_pipe(count=5000):
+    print(f"byte_pipe: {count} records piped from [16]Byte, through a PipeStream vs. a view")
+    from datamijn.dmtypes import Pipe
+    dm = f"""
+records [{count}] {{
+    record  ([16]Byte) | {{
+        id      U32
+        flags   [4]U8
+        name    [8]Byte
+    }}
+}}
+"""
+    schema = datamijn.compile(dm)
+    data = bytes(range(256)) * (count * 16 // 256 + 1)
+    pipe = schema._struct._contents["records"]._parsetype._contents["record"]
+    assert issubclass(pipe, Pipe)
+    timings = []
+    for label, view in (("PipeStream", False), ("view", True)):
+        pipe._view_left = view
+        timings.append((label, best_time(lambda: schema.parse(data, provenance="none"), repeat=3)))
+    report("records", timings[0], timings[1:], records=count)
+
+# The GBA BIOS formats in the DSL, one byte yielded at a time.
+RLE_DM = """
+:RLEBlock {
+    _flag   U8
+    _       _flag match {
+        0..0x80     => [_flag + 1] {
+            < Byte
+        }
+        0x80..0x100 => < Byte * (_flag - 0x7d)
+    }
+}
+header  [4]Byte
+data    RLEBlock | [{size}]Byte
+"""
+
+LZ77_DM = """
+:LZ77Block {
+    _flags  [8]MSB1
+    _       [8] {
+        _   _flags[I] match {
+            0 => < Byte
+            1 => {
+                _length     MSB4
+                _high       MSB4
+                _low        U8
+                _           [_length + 3] {
+                    < |@(0 - (_high * 256 + _low + 1)) Byte
+                }
+            }
+        }
+    }
+}
+header  [4]Byte
+data    LZ77Block | [{size}]Byte
+"""
+
+def compressed_samples(blocks):
+    """ Made-up compressed data for each format, and its size decompressed. """
+    import zlib
+    # Eight literals and a run of 34.
+    rle = b"".join(b"\x07" + bytes(range(i % 64, i % 64 + 8)) + b"\xff" + bytes([i % 256])
+        for i in range(blocks))
+    # Four literals, then four back-references of 18 bytes from 4 back.
+    lz77 = b"".join(b"\x0f" + bytes(range(i % 64, i % 64 + 4)) + b"\xf0\x03" * 4
+        for i in range(blocks))
+    # Four literals, a run of 18 and a 16 byte copy from 4 back.
+    gsclz = b"".join(b"\x03" + bytes(range(i % 64, i % 64 + 4)) + b"\x31" + bytes([i % 256])
+        + b"\x8f\x83" for i in range(blocks)) + b"\xff"
+    text = open(os.path.join(os.path.dirname(__file__), "dmtypes.py"), "rb").read()
+    return {
+        "RLE": (b"\x30" + (42 * blocks).to_bytes(3, 'little') + rle, 42 * blocks),
+        "LZ77": (b"\x10" + (76 * blocks).to_bytes(3, 'little') + lz77, 76 * blocks),
+        "GSCLZ": (gsclz, 38 * blocks),
+        "Zlib": (zlib.compress(text), len(text)),
+    }
+
+@benchmark
+def decompressors(blocks=1024):
+    print(f"decompressors: native decompressors vs. the same formats in the DSL")
+    definitions = {"RLE": RLE_DM, "LZ77": LZ77_DM}
+    for name, (data, size) in compressed_samples(blocks).items():
+        native = datamijn.compile(f"data {name} | [{size}]Byte\n")
+        result = native.parse(data).data
+        assert len(result) == size
+        elapsed = best_time(lambda: native.parse(data, provenance="none"), repeat=3)
+        timings = [("native", elapsed)]
+        if name in definitions:
+            dsl = datamijn.compile(definitions[name].replace("{size}", str(size)))
+            assert dsl.parse(data).data == result
+            timings.insert(0, ("DSL", best_time(lambda: dsl.parse(data, provenance="none"), repeat=1)))
+        print(f"  {name}, {size} bytes")
+        for label, elapsed in timings:
+            ratio = f"  {timings[0][1]/elapsed:8.1f}x" if len(timings) > 1 else ""
+            print(f"    {label:<14} {size/elapsed/1e6:10.2f} MB/s{ratio}")
+
+@benchmark
+def back_references(blocks=1024):
+    print(f"back_references: LZ77 in the DSL, copying byte by byte vs. |@ [N]Byte")
+    data, size = compressed_samples(blocks)["LZ77"]
+    bulk_dm = LZ77_DM.replace("""_           [_length + 3] {
+                    < |@(0 - (_high * 256 + _low + 1)) Byte
+                }""", "< |@(0 - (_high * 256 + _low + 1)) [_length + 3]Byte")
+    timings = []
+    for label, dm in (("byte by byte", LZ77_DM), ("bulk", bulk_dm)):
+        schema = datamijn.compile(dm.replace("{size}", str(size)))
+        timings.append((label, schema, best_time(lambda: schema.parse(data, provenance="none"), repeat=3)))
+    assert timings[0][1].parse(data).data == timings[1][1].parse(data).data
+    print(f"  {size} bytes")
+    for label, schema, elapsed in timings:
+        print(f"    {label:<14} {size/elapsed/1e6:10.2f} MB/s  {timings[0][2]/elapsed:8.1f}x")
+
+@benchmark
+def extensions(count=20000):
+    print(f"extensions: {count} 24-bit ints, in the DSL vs. registered from Python")
+    from datamijn.parsing import primitive_types
+    data = bytes(range(256)) * (count * 3 // 256 + 1)
+    dsl = datamijn.compile(f"""
+:Int24 {{
+    low     U16
+    high    U8
+    = low + high * 0x10000
+}}
+ints    [{count}]Int24
+""")
+    
+    def decode(buffer, offset):
+        return int.from_bytes(buffer[offset:offset + 3], 'little'), 3
+    def batch(buffer, offset, count):
+        return [int.from_bytes(buffer[i:i + 3], 'little')
+            for i in range(offset, offset + count * 3, 3)], count * 3
+    
+    timings = []
+    for label, batch_decoder in (("primitive", None), ("batch", batch)):
+        datamijn.register_primitive("Int24", decode, size=3, batch=batch_decoder)
+        try:
+            schema = datamijn.compile(f"ints [{count}]Int24\n")
+            assert list(schema.parse(data).ints) == list(dsl.parse(data).ints)
+            timings.append((label, best_time(lambda: schema.parse(data, provenance="none"))))
+        finally:
+            del primitive_types["Int24"]
+    report("Int24", ("DSL", best_time(lambda: dsl.parse(data, provenance="none"))),
+        timings, records=count, unit="int")
+
+@benchmark
+def lazy_array(count=50000):
+    print(f"lazy_array: reading 3 of {count} records, eagerly vs. lazily")
+    schema = datamijn.compile(f"""
+:Mon {{
+    species     U8
+    level       U8
+    moves       [4]U8
+    exp         U16
+}}
+mons        [{count}]Mon
+""")
+    data = bytes(range(256)) * (count * 8 // 256 + 1)
+    def pick(lazy):
+        mons = schema.parse(data, lazy=lazy).mons
+        return [mons[0].level, mons[count // 2].moves, mons[-1].exp]
+    assert pick(True) == pick(False)
+    report("[N]Mon, 3 lookups", ("eager", best_time(lambda: pick(False), repeat=3)),
+        [("lazy", best_time(lambda: pick(True), repeat=3))], unit="parse")
+
+@benchmark
+def lazy_struct(count=2000):
+    print(f"lazy_struct: reading 3 of {count} top-level fields, eagerly vs. lazily")
+    fields = "".join(f"table{i} [8]U16\nname{i} {{\n    length U8\n    chars [length]U8\n}}\n"
+        for i in range(count // 2))
+    schema = datamijn.compile(fields)
+    data = bytes([4, 1, 2, 3, 4]).join(bytes(16) for i in range(count // 2 + 1))
+    def pick(lazy):
+        result = schema.parse(data, lazy=lazy)
+        return [result.table0, result[f"table{count // 4}"], result[f"name{count // 8}"].chars]
+    assert pick(True) == pick(False)
+    report("top-level fields, 3 lookups", ("eager", best_time(lambda: pick(False), repeat=3)),
+        [("lazy", best_time(lambda: pick(True), repeat=3))], unit="parse")
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,111 @@
+import os
+import sys
+import pickle
+import hashlib
+from io import BytesIO
+from glob import glob
+
+# Resolved definitions are trees of classes made on the fly by
+# DatamijnObject.make, which pickle can't import by name.  They're pickled
+# structurally instead: the class is recreated from its name and bases, and
+# its attributes are restored afterwards so that self-references work.
+
+def _set_type_state(type_, state):
+    for key, value in state.items():
+        setattr(type_, key, value)
+
+def _importable(type_):
+    module = sys.modules.get(type_.__module__)
+    return getattr(module, type_.__qualname__, None) is type_
+
+SKIPPED_ATTRIBUTES = ("__dict__", "__weakref__", "__module__", "__doc__", "__qualname__")
+
+class DefinitionPickler(pickle.Pickler):
+    def __init__(self, file, primitive_types):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._primitive_names = {id(type_): name for name, type_ in primitive_types.items()}
+
+    def persistent_id(self, obj):
+        if isinstance(obj, type):
+            return self._primitive_names.get(id(obj))
+        return None
+
+    def reducer_override(self, obj):
+        if not isinstance(obj, type) or _importable(obj):
+            return NotImplemented
+        state = {key: value for key, value in vars(obj).items()
+            if key not in SKIPPED_ATTRIBUTES}
+        return (type(obj), (obj.__name__, obj.__bases__, {"__module__": obj.__module__}),
+            state, None, None, _set_type_state)
+
+class DefinitionUnpickler(pickle.Unpickler):
+    def __init__(self, file, primitive_types):
+        super().__init__(file)
+        self._primitive_types = primitive_types
+
+    def persistent_load(self, pid):
+        if pid not in self._primitive_types:
+            from datamijn.extensions import load_entry_point
+            load_entry_point(pid)
+        return self._primitive_types[pid]
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+_code_digest = None
+
+def code_digest():
+    """ Digest of datamijn itself, including grammar.g and stdlib.dm.
+    A cached definition is only valid for the code that resolved it. """
+    global _code_digest
+    if _code_digest is None:
+        package_dir = os.path.dirname(__file__)
+        digest = hashlib.sha256(sys.version.encode())
+        paths = sorted(glob(package_dir + "/*.py")) + \
+            [package_dir + "/grammar.g", package_dir + "/stdlib.dm"]
+        for path in paths:
+            if os.path.basename(path).startswith("test_"):
+                continue
+            digest.update(file_digest(path).encode())
+        _code_digest = digest.hexdigest()
+    return _code_digest
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "datamijn")
+
+def cache_filename(cache_dir, definition, path):
+    digest = hashlib.sha256()
+    digest.update(code_digest().encode())
+    digest.update(os.path.abspath(path or ".").encode())
+    digest.update(definition.encode())
+    return os.path.join(cache_dir, digest.hexdigest() + ".pickle")
+
+def load(cache_dir, definition, path):
+    """ Returns the cached resolved struct, or None if there's no entry or
+    any file the definition touched has changed since. """
+    from datamijn.parsing import primitive_types, builtin_types
+    filename = cache_filename(cache_dir, definition, path)
+    try:
+        with open(filename, 'rb') as f:
+            files, payload = pickle.load(f)
+        for file_path, digest in files:
+            if file_digest(file_path) != digest:
+                return None
+        return DefinitionUnpickler(BytesIO(payload), {**builtin_types, **primitive_types}).load()
+    except Exception:
+        # Missing, stale or unreadable entries are all just cache misses.
+        return None
+
+def store(cache_dir, definition, path, struct, files):
+    from datamijn.parsing import primitive_types, builtin_types
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = cache_filename(cache_dir, definition, path)
+    files = [(os.path.abspath(file_path), file_digest(file_path)) for file_path in files]
+    payload = BytesIO()
+    DefinitionPickler(payload, {**builtin_types, **primitive_types}).dump(struct)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump((files, payload.getvalue()), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,573 @@
+import bisect
+
+from datamijn.dmtypes import DatamijnObject, Struct, Array, Byte, Short, U8, \
+    S8, U16, ExprInt, ExprString, ExprName, ExprOp, Return, Pointer, \
+    MatchType, If, DatamijnInt, DatamijnString, Terminator, ParsePath, \
+    PROVENANCE_FULL, S8_FORMAT, U16_FORMAT
+from datamijn.traceint import Source, untraced
+from datamijn.utils import ParseError
+
+# The code generator compiles resolved types into plain Python functions,
+# one per type, which behave exactly like the types' parse_stream.  Each
+# function is only generated when the type uses the very parse_stream it
+# mirrors; anything else is called through its parse_stream as usual.
+
+def path_error(ex, path):
+    return type(ex)(f'{ex}\nPath: {".".join(str(x) for x in path)}')
+
+def implements(type_, owner, method="parse_stream"):
+    return getattr(type_, method).__func__ is getattr(owner, method).__func__
+
+def is_primitive(type_):
+    return implements(type_, DatamijnObject) \
+        and any(implements(type_, prim, "_parse_stream") for prim in (U8, S8, U16))
+
+class CodeGenerator():
+    def __init__(self, provenance=PROVENANCE_FULL):
+        self._provenance = provenance
+        self._names = {}
+        self._namespace = {
+            "path_error": path_error,
+            "untraced": untraced,
+            "S8_FORMAT": S8_FORMAT,
+            "U16_FORMAT": U16_FORMAT,
+            "ParseError": ParseError,
+            "Source": Source,
+            "Byte": Byte,
+            "Short": Short,
+            "DatamijnInt": DatamijnInt,
+            "DatamijnString": DatamijnString,
+            "DatamijnObject": DatamijnObject,
+            "Terminator": Terminator,
+            "ParsePath": ParsePath,
+            "dict_setitem": dict.__setitem__,
+            "bisect_right": bisect.bisect_right,
+        }
+        self._counter = 0
+
+    def constant(self, value, prefix="c"):
+        name = f"{prefix}{self._counter}"
+        self._counter += 1
+        self._namespace[name] = value
+        return name
+
+    def function(self, type_):
+        """ Returns the name under which the parse function for `type_` is
+        available to generated code. """
+        key = id(type_)
+        if key in self._names:
+            return self._names[key]
+
+        generate = self.generator_for(type_)
+        if not generate:
+            name = self.constant(type_.parse_stream, "parse_stream")
+            self._names[key] = name
+            return name
+
+        name = f"parse{self._counter}_{''.join(c for c in type_.__name__ if c.isalnum())}"
+        self._counter += 1
+        # Registered before generating, so that recursive types refer to it.
+        self._names[key] = name
+        lines = generate(type_, name)
+        code = "\n".join(lines) + "\n"
+        exec(compile(code, f"<datamijn {type_.__name__}>", "exec"), self._namespace)
+        return name
+
+    def generator_for(self, type_):
+        if not isinstance(type_, type) or not issubclass(type_, DatamijnObject):
+            return None
+        if is_primitive(type_):
+            return self.gen_primitive
+        for owner, generate in (
+                (Struct, self.gen_struct),
+                (Array, self.gen_array),
+                (Pointer, self.gen_pointer),
+                (MatchType, self.gen_match),
+                (ExprOp, self.gen_op),
+                (ExprInt, self.gen_int),
+                (ExprString, self.gen_string),
+                (ExprName, self.gen_name),
+                (Return, self.gen_return),
+                (If, self.gen_if)):
+            if implements(type_, owner):
+                return generate(type_)
+        return None
+
+    def compile(self, type_):
+        return self._namespace[self.function(type_)]
+
+    #
+    # primitives
+    #
+
+    def primitive_lines(self, type_, result, path, lenient):
+        """ Inline read of a U8, S8 or U16, as done by DatamijnObject.parse_stream
+        wrapping its _parse_stream. """
+        T = self.constant(type_, "T")
+        if self._provenance < PROVENANCE_FULL:
+            return self.untraced_primitive_lines(type_, T, result, path, lenient)
+        if implements(type_, U16, "_parse_stream"):
+            data_class, size, read = "Short", 2, "stream.read(2)[::-1]"
+            convert = f"{T}(data[1] | (data[0] << 8))"
+        else:
+            data_class, size, read = "Byte", 1, "stream.read(1)"
+            if implements(type_, S8, "_parse_stream"):
+                convert = f"{T}(ord(data) - 256 if ord(data) > 127 else ord(data))"
+            else:
+                convert = f"{T}(ord(data))"
+        return [
+            f"try:",
+            f"    try:",
+            f"        data_address = stream.tell()",
+            f"        data = {read}",
+            f"        if len(data) != {size}:",
+            f"            raise ParseError({path}, 'Failed to read stream')",
+            f"        data = {data_class}(data)",
+            f"        data._address = data_address",
+            f"        data._size = {size}",
+            f"    except Exception as ex:",
+            f"        raise path_error(ex, {path})",
+            f"    data._path = {path}",
+            f"    data._error = False",
+            f"    {result} = {convert}",
+            f"    {result}._trace = Source({T}, data)",
+            f"except Exception as ex:",
+            f"    if {lenient}:",
+            f"        {result} = ex",
+            f"    else:",
+            f"        raise path_error(ex, {path})",
+            f"{result}._path = {path}",
+            f"{result}._error = {lenient} and isinstance({result}, Exception)",
+        ]
+
+    def untraced_primitive_lines(self, type_, T, result, path, lenient):
+        """ The same, for provenance levels that leave out traces. """
+        size = 1
+        if implements(type_, U16, "_parse_stream"):
+            read = f"{T}(stream.unpack(U16_FORMAT)[0])"
+            size = 2
+        elif implements(type_, S8, "_parse_stream"):
+            read = f"{T}(stream.unpack(S8_FORMAT)[0])"
+        else:
+            read = f"{T}(stream.read(1)[0])"
+        lines = [f"try:"]
+        if self._provenance:
+            lines += [
+                f"    data_address = stream.tell()",
+                f"    {result} = {read}",
+                f"    {result}._address = data_address",
+                f"    {result}._size = {size}",
+            ]
+        else:
+            lines += [f"    {result} = {read}"]
+        lines += [
+            f"except Exception as ex:",
+            f"    if {lenient}:",
+            f"        {result} = ex",
+            f"    else:",
+            f"        raise path_error(ex, {path})",
+        ]
+        if self._provenance:
+            lines += [
+                f"{result}._path = {path}",
+                f"{result}._error = {lenient} and isinstance({result}, Exception)",
+            ]
+        else:
+            lines += [
+                f"if {lenient} and isinstance({result}, Exception):",
+                f"    {result}._error = True",
+            ]
+        return lines
+
+    def gen_primitive(self, type_, name):
+        return [
+            f"def {name}(state, index=None):",
+            f"    stream = state.stream",
+            f"    path = state.path",
+            f"    lenient = state.lenient",
+            *indent(self.primitive_lines(type_, "result", "path", "lenient")),
+            f"    return result",
+        ]
+
+    #
+    # structures
+    #
+
+    def gen_struct(self, type_):
+        if type_._layout:
+            # Already decoded with a single unpack_from.
+            return None
+        return self._gen_struct
+
+    def _gen_struct(self, type_, name):
+        T = self.constant(type_, "T")
+        has_return = bool(type_._return)
+        lines = [
+            f"def {name}(state, index=None):",
+            f"    stream = state.stream",
+            f"    ctx = state.ctx",
+            f"    path = state.path",
+            f"    lenient = state.lenient",
+            f"    start_address = stream.tell()",
+            f"    error = False",
+            f"    size = 0",
+            f"    obj = {T}()",
+            f"    ctx.append(obj)",
+            f"    obj._ctx = ctx",
+        ]
+        parsed = {}
+        runs = type_._bit_runs or {}
+        fields = iter(type_._contents.items())
+        for field_name, field_type in fields:
+            field_lines = self.field_lines(field_name, field_type, has_return, parsed)
+            if field_name in runs:
+                run = runs[field_name]
+                for i in range(len(run.names) - 1):
+                    field_lines += self.field_lines(*next(fields), has_return, parsed)
+                field_lines = self.run_lines(run, has_return, parsed, field_lines)
+            lines += indent(field_lines)
+
+        if has_return:
+            expr = self.expression(type_._return, parsed, "index=index")
+            lines += [
+                f"    state.path = ParsePath(path, '_return')",
+                f"    value = {expr}",
+                f"    state.path = path",
+                f"    ctx.pop()",
+                f"    return value",
+            ]
+        else:
+            lines += [
+                f"    state.path = path",
+                f"    ctx.pop()",
+            ]
+            if self._provenance:
+                lines += [
+                    f"    obj._address = start_address",
+                    f"    obj._size = size",
+                    f"    obj._path = path",
+                ]
+            lines += [
+                f"    obj._error = error",
+                f"    return obj",
+            ]
+        return lines
+
+    def run_lines(self, run, has_return, parsed, field_lines):
+        """ Reads a BitRun at once, falling back to `field_lines` (reading its
+        fields one by one) if the stream isn't aligned. """
+        lines = [
+            f"# {', '.join(run.names)}",
+            f"results = {self.constant(run, 'run')}.read(stream, path)",
+            f"if results != None:",
+        ]
+        if not has_return:
+            lines.append(f"    size += {run.size}")
+        for i, field_name in enumerate(run.names):
+            key = self.constant(field_name, "key")
+            lines += [
+                f"    {parsed[field_name]} = results[{i}]",
+                f"    dict_setitem(obj, {key}, {parsed[field_name]})",
+            ]
+        return lines + ["else:"] + indent(field_lines)
+
+    def field_lines(self, field_name, field_type, has_return, parsed):
+        key = self.constant(field_name, "key")
+        body = [f"field_path = ParsePath(path, {key})"]
+        if not has_return:
+            body.append("address = stream.tell()")
+        if isinstance(field_type, type) and is_primitive(field_type):
+            body += self.primitive_lines(field_type, "result", "field_path", "lenient")
+        else:
+            expr = self.expression(field_type, parsed, "index=index")
+            body += [f"state.path = field_path", f"result = {expr}"]
+        body += [
+            f"if lenient and hasattr(result, '_error') and result._error:",
+            f"    error = True",
+        ]
+        if not has_return:
+            body.append("size += stream.tell() - address")
+        if isinstance(field_name, str):
+            local = f"field{len(parsed)}"
+            body += [f"dict_setitem(obj, {key}, result)", f"{local} = result"]
+            parsed[field_name] = local
+        else:
+            body.append(f"obj[{key}] = result")
+        return [f"# {field_name}"] + body
+
+    def expression(self, type_, parsed, arguments):
+        """ A Python expression equivalent to type_.parse_stream(state,
+        **arguments).  Names of fields already parsed in the enclosing struct
+        are read from locals. """
+        if isinstance(type_, type) and implements(type_, ExprName) \
+          and type_._name in parsed:
+            # The enclosing struct is innermost in ctx, and it already has this
+            # field, so the interpreter's lookup would find exactly this.
+            return parsed[type_._name]
+        if isinstance(type_, type) and implements(type_, ExprInt):
+            return f"DatamijnInt({type_._int!r})"
+        if isinstance(type_, type) and implements(type_, ExprOp):
+            op = self.constant(type_._op, "op")
+            # ExprOp passes everything but `index` straight through
+            left = self.expression(type_._left, parsed, arguments)
+            right = self.expression(type_._right, parsed, arguments)
+            if self._provenance < PROVENANCE_FULL:
+                return f"untraced({op}, {left}, {right})"
+            return f"{op}({left}, {right})"
+        if isinstance(type_, type) and implements(type_, Return):
+            return self.expression(type_._expr, parsed, arguments)
+        return f"{self.function(type_)}(state, {arguments})"
+
+    def gen_array(self, type_):
+        if type_._length is None or type_._final_length or type_._concat \
+          or type_._bytestring or type_._parsetype == Byte \
+          or getattr(type_._parsetype, "_layout", None):
+            return None
+        return self._gen_array
+
+    def _gen_array(self, type_, name):
+        T = self.constant(type_, "T")
+        length = self.expression(type_._length, {}, "")
+        parsetype = type_._parsetype
+        lines = [
+            f"def {name}(state, index=None):",
+            f"    stream = state.stream",
+            f"    path = state.path",
+            f"    contents = []",
+            f"    length = {length}",
+            f"    start_address = stream.tell()",
+            f"    error = False",
+            f"    i = 0",
+        ]
+        if is_primitive(parsetype):
+            lines += [
+                f"    lenient = state.lenient",
+                f"    while True:",
+                f"        item_path = ParsePath(path, i)",
+                *indent(self.primitive_lines(parsetype, "item", "item_path", "lenient"), 2),
+            ]
+        else:
+            element = self.function(parsetype)
+            lines += [
+                f"    while True:",
+                f"        state.path = ParsePath(path, i)",
+                f"        item = {element}(state, index=i)",
+            ]
+        lines += [
+            f"        if hasattr(item, '_error') and item._error:",
+            f"            error = True",
+            f"        contents.append(item)",
+            f"        i += 1",
+            f"        if length != None:",
+            f"            if i >= length:",
+            f"                break",
+        ]
+        # Without a length, Array.parse_stream stops on the first zero int or
+        # on a Terminator.
+        if issubclass(parsetype, int):
+            lines += [
+                f"        elif contents[-1] == 0:",
+                f"            break",
+            ]
+        else:
+            lines += [
+                f"        elif isinstance(contents[-1], Terminator):",
+                f"            if type(contents[-1]) is Terminator:",
+                f"                contents.pop()",
+                f"            break",
+            ]
+        lines += [
+            f"    state.path = path",
+            f"    size = stream.tell() - start_address",
+            f"    if len(contents) and isinstance(contents[0], bytes):",
+            f"        return b''.join(contents)",
+            f"    obj = {T}(contents)",
+        ]
+        if self._provenance:
+            lines += [
+                f"    obj._address = start_address",
+                f"    obj._size = size",
+                f"    obj._path = path",
+            ]
+        lines += [
+            f"    obj._error = error",
+            f"    return obj",
+        ]
+        return lines
+
+    def gen_pointer(self, type_):
+        return self._gen_pointer
+
+    def _gen_pointer(self, type_, name):
+        addr = self.function(type_._addr)
+        target = self.function(type_._type)
+        lines = [
+            f"def {name}(state, index=None):",
+            f"    stream = state.stream",
+            f"    path = state.path",
+            f"    state.path = ParsePath(path, '(addr)')",
+            f"    address = {addr}(state, index=index)",
+            f"    state.path = path",
+            f"    position = stream.position()",
+            f"    stream.jump(address)",
+            f"    result = {target}(state, index=index)",
+            f"    stream.restore(position)",
+        ]
+        if self._provenance:
+            lines.append(f"    result._pointer = address")
+        return lines + [f"    return result"]
+
+    def gen_match(self, type_):
+        return self._gen_match
+
+    def _gen_match(self, type_, name):
+        key_type = self.function(type_._type)
+        converted = {}
+        def convert(branch):
+            # The branch with the type's generated function in place of the type.
+            if branch is None:
+                return None
+            if id(branch) not in converted:
+                converted[id(branch)] = (self._namespace[self.function(branch[0])], branch[1])
+            return converted[id(branch)]
+        branches = self.constant({key: convert(branch)
+            for key, branch in type_._branches.items()}, "branches")
+        lines = [
+            f"def {name}(state, index=None):",
+            f"    value = {key_type}(state, index=index)",
+            f"    key_value = value",
+            f"    if isinstance(value, Byte):",
+            f"        key_value = ord(value)",
+            f"    elif isinstance(value, int):",
+            f"        key_value = int(key_value)",
+            f"    path = state.path",
+        ]
+        lookup = [f"branch = {branches}.get(key_value)"]
+        if type_._range_starts:
+            starts = self.constant(type_._range_starts, "starts")
+            ends = self.constant(type_._range_ends, "ends")
+            range_branches = self.constant([convert(branch)
+                for branch in type_._range_branches], "range_branches")
+            lookup += [
+                f"if branch is None:",
+                f"    i = bisect_right({starts}, key_value) - 1",
+                f"    if i >= 0 and key_value < {ends}[i]:",
+                f"        branch = {range_branches}[i]",
+            ]
+        if type_._table is not None:
+            table = self.constant([convert(branch) for branch in type_._table], "table")
+            lines += [
+                f"    if type(key_value) is int and 0 <= key_value < {len(type_._table)}:",
+                f"        branch = {table}[key_value]",
+                f"    else:",
+                *indent(lookup, 2),
+            ]
+        else:
+            lines += indent(lookup)
+        lines += [
+            f"    if branch is not None:",
+            f"        state.path = ParsePath(path, branch[1])",
+            f"        obj = branch[0](state)",
+            f"        state.path = path",
+            f"        if obj != None:",
+            f"            obj._match_value = value",
+            f"        return obj",
+        ]
+        default_key = type_._default_key
+        if default_key != None:
+            default = self.function(type_._default_branch)
+            if default_key:
+                ctx_extra = f"{{{str(default_key)!r}: value}}"
+            else:
+                ctx_extra = self.constant(type_._default_ctx, "default_ctx")
+            lines += [
+                f"    state.ctx.append({ctx_extra})",
+                f"    state.path = ParsePath(path, '[_]')",
+                f"    obj = {default}(state)",
+                f"    state.path = path",
+                f"    state.ctx.pop()",
+                f"    if isinstance(obj, DatamijnObject):",
+                f"        obj._match_value = value",
+                f"    return obj",
+            ]
+        else:
+            lines += [
+                f"    raise Exception(f\"Parsed value {{value}}, but not present in match.\\nPath: {{'.'.join(str(x) for x in path)}}\")",
+            ]
+        return lines
+
+    #
+    # expressions
+    #
+
+    def gen_op(self, type_):
+        return self._gen_op
+
+    def _gen_op(self, type_, name):
+        expr = self.expression(type_, {}, "index=index")
+        return [
+            f"def {name}(state, index=None):",
+            f"    return {expr}",
+        ]
+
+    def gen_int(self, type_):
+        return lambda type_, name: [
+            f"def {name}(state, index=None):",
+            f"    return DatamijnInt({type_._int!r})",
+        ]
+
+    def gen_string(self, type_):
+        return lambda type_, name: [
+            f"def {name}(state, index=None):",
+            f"    return DatamijnString({type_._string!r})",
+        ]
+
+    def gen_name(self, type_):
+        return self._gen_name
+
+    def _gen_name(self, type_, name):
+        lines = [f"def {name}(state, index=None):"]
+        if type_._scope:
+            lines += [
+                f"    ctx = state.ctx",
+                f"    if {type_._depth} < len(ctx):",
+                f"        context = ctx[{-1 - type_._depth}]",
+                f"        if type(context) is {self.constant(type_._scope, 'T')} and {type_._name!r} in context:",
+                f"            return context[{type_._name!r}]",
+            ]
+        return lines + [
+            f"    for context in reversed(state.ctx):",
+            f"        if {type_._name!r} in context:",
+            f"            return context[{type_._name!r}]",
+            f"    raise ParseError(state.path, {'Cannot resolve name ' + type_._name!r})",
+        ]
+
+    def gen_return(self, type_):
+        return lambda type_, name: [
+            f"def {name}(state, index=None):",
+            f"    return {self.expression(type_._expr, {}, 'index=index')}",
+        ]
+
+    def gen_if(self, type_):
+        return self._gen_if
+
+    def _gen_if(self, type_, name):
+        lines = [
+            f"def {name}(state, index=None):",
+            f"    result = {self.function(type_._expr)}(state, index=index)",
+            f"    if result:",
+            f"        return {self.function(type_._true_struct)}(state, index=index)",
+        ]
+        if type_._false_struct:
+            lines.append(f"    return {self.function(type_._false_struct)}(state, index=index)")
+        else:
+            lines.append(f"    return None")
+        return lines
+
+def indent(lines, levels=1):
+    return ["    "*levels + line for line in lines]
+
+def generate(type_, provenance=PROVENANCE_FULL):
+    """ Returns a function with the signature and behavior of
+    type_.parse_stream, for streams at the given provenance level. """
+    return CodeGenerator(provenance).compile(type_)
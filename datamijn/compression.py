@@ -0,0 +1,212 @@
+""" Decompressors, for the left side of pipes:
+
+    graphics    LZ77 | [64]GBTile
+
+Each parse decompresses one compressed stream, in bulk, and gives the bytes,
+leaving the input after the stream.  This is what a struct that yields them
+would do, only much faster. """
+import zlib
+
+from datamijn.dmtypes import DatamijnObject, ByteString
+from datamijn.utils import ParseError
+
+# Bytes with their bits in reverse order.
+FLIPPED = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+# How much input zlib is given at a time.
+INFLATE_CHUNK = 64 * 1024
+
+def copy(out, start, length):
+    """ Appends `length` bytes from `start` in `out`.  If they run into the
+    bytes being appended, those are repeated, as with a copy byte by byte. """
+    distance = len(out) - start
+    if start < 0 or distance <= 0:
+        raise ValueError(f"Back-reference to {hex(start)} outside of the {hex(len(out))} bytes decompressed")
+    if distance >= length:
+        out += out[start:start + length]
+    else:
+        out += (out[start:] * (length // distance + 1))[:length]
+
+def inflate(data, pos, wbits):
+    decompressor = zlib.decompressobj(wbits)
+    out = []
+    with memoryview(data) as view:
+        while not decompressor.eof:
+            chunk = view[pos:pos + INFLATE_CHUNK]
+            if not chunk:
+                raise ValueError("Compressed data ends early")
+            out.append(decompressor.decompress(chunk))
+            pos += len(chunk)
+    return b"".join(out), pos - len(decompressor.unused_data)
+
+def bios_header(data, pos, type_):
+    """ The decompressed size from the header of GBA and DS BIOS formats. """
+    if data[pos] != type_:
+        raise ValueError(f"Expected compression type {hex(type_)}, got {hex(data[pos])}")
+    return int.from_bytes(data[pos + 1:pos + 4], 'little')
+
+def lz77(data, pos):
+    size = bios_header(data, pos, 0x10)
+    pos += 4
+    out = bytearray()
+    while len(out) < size:
+        flags = data[pos]
+        pos += 1
+        if flags == 0 and size - len(out) >= 8:
+            out += data[pos:pos + 8]
+            pos += 8
+            continue
+        for bit in range(7, -1, -1):
+            if len(out) >= size:
+                break
+            if flags >> bit & 1:
+                byte0, byte1 = data[pos], data[pos + 1]
+                pos += 2
+                distance = ((byte0 & 0xf) << 8 | byte1) + 1
+                copy(out, len(out) - distance, (byte0 >> 4) + 3)
+            else:
+                out.append(data[pos])
+                pos += 1
+    if pos > len(data):
+        raise IndexError()
+    del out[size:]
+    return out, pos
+
+def rle(data, pos):
+    size = bios_header(data, pos, 0x30)
+    pos += 4
+    out = bytearray()
+    while len(out) < size:
+        flag = data[pos]
+        pos += 1
+        if flag & 0x80:
+            out += bytes((data[pos],)) * ((flag & 0x7f) + 3)
+            pos += 1
+        else:
+            length = (flag & 0x7f) + 1
+            out += data[pos:pos + length]
+            pos += length
+    if pos > len(data):
+        raise IndexError()
+    del out[size:]
+    return out, pos
+
+def gsc_lz(data, pos):
+    out = bytearray()
+    while True:
+        byte = data[pos]
+        pos += 1
+        if byte == 0xff:
+            break
+        command = byte >> 5
+        if command == 7:
+            command = byte >> 2 & 7
+            length = ((byte & 3) << 8 | data[pos]) + 1
+            pos += 1
+        else:
+            length = (byte & 0x1f) + 1
+
+        if command == 0:
+            # literal
+            out += data[pos:pos + length]
+            pos += length
+        elif command == 1:
+            # one byte, repeated
+            out += bytes((data[pos],)) * length
+            pos += 1
+        elif command == 2:
+            # two bytes, alternated
+            out += (bytes(data[pos:pos + 2]) * (length // 2 + 1))[:length]
+            pos += 2
+        elif command == 3:
+            # zeros
+            out += bytes(length)
+        else:
+            offset = data[pos]
+            pos += 1
+            if offset & 0x80:
+                offset = len(out) - (offset & 0x7f) - 1
+            else:
+                offset = offset << 8 | data[pos]
+                pos += 1
+            if command == 4:
+                copy(out, offset, length)
+            elif command == 5 and 0 <= offset < len(out):
+                # bit-reversed copy
+                if offset + length <= len(out):
+                    out += out[offset:offset + length].translate(FLIPPED)
+                else:
+                    # Overlapping: bytes copied again are flipped back.
+                    for i in range(length):
+                        out.append(FLIPPED[out[offset + i]])
+            elif command == 6 and offset < len(out) and offset - length + 1 >= 0:
+                # reversed copy
+                out += out[offset - length + 1:offset + 1][::-1]
+            else:
+                raise ValueError(f"Invalid command {hex(byte)}")
+    if pos > len(data):
+        raise IndexError()
+    return out, pos
+
+class Decompressor(DatamijnObject):
+    _final_type = ByteString
+    _wrap = False
+
+    @classmethod
+    def resolve(self, ctx, path):
+        return self
+
+    @classmethod
+    def decompress(self, data, pos):
+        """ Decompresses the stream at `pos` in `data`.  Returns the bytes
+        and where the stream ends. """
+        raise NotImplementedError()
+
+    @classmethod
+    def _parse_stream(self, state, index=None):
+        stream = state.stream
+        view = stream.view()
+        if view is None:
+            raise ParseError(state.path, f"{self.__name__} can only decompress byte-aligned data read straight from the input")
+        data, pos = view
+        try:
+            out, end = self.decompress(data, pos)
+        except IndexError:
+            raise ParseError(state.path, f"{self.__name__} data runs past the end of the input")
+        except (ValueError, zlib.error) as ex:
+            raise ParseError(state.path, f"Invalid {self.__name__} data: {ex}")
+        stream.jump(stream.tell() + end - pos)
+        return bytes(out)
+
+class Zlib(Decompressor):
+    @classmethod
+    def decompress(self, data, pos):
+        return inflate(data, pos, 15)
+
+class Deflate(Decompressor):
+    @classmethod
+    def decompress(self, data, pos):
+        return inflate(data, pos, -15)
+
+class Gzip(Decompressor):
+    @classmethod
+    def decompress(self, data, pos):
+        return inflate(data, pos, 31)
+
+class LZ77(Decompressor):
+    """ The GBA and DS BIOS's LZ77 (LZ10), whose window is 4096 bytes. """
+    @classmethod
+    def decompress(self, data, pos):
+        return lz77(data, pos)
+
+class RLE(Decompressor):
+    """ The GBA and DS BIOS's run-length encoding. """
+    @classmethod
+    def decompress(self, data, pos):
+        return rle(data, pos)
+
+class GSCLZ(Decompressor):
+    """ The LZ variant of Pokémon Gold, Silver and Crystal. """
+    @classmethod
+    def decompress(self, data, pos):
+        return gsc_lz(data, pos)
@@ -1,10 +1,29 @@
+import os
+import re
+import mmap
 import operator
+import struct as pystruct
+import bisect
+import importlib.util
 from io import BytesIO, BufferedIOBase
 from typing import Union
-from datamijn.utils import UPPERCASE, JsonTypes, full_type_name, ResolveError, ParseError, ForeignKeyError, ReadError, SaveNotImplementedError, MakeError, JsonType
-from datamijn.traceint import TraceInt, Source
+from datamijn.utils import UPPERCASE, JsonTypes, full_type_name, DatamijnPathError, ResolveError, ParseError, ForeignKeyError, ReadError, SaveNotImplementedError, MakeError, JsonType
+from datamijn.traceint import TraceInt, Source, untraced
+
+# How much provenance parsed objects carry.  "none" leaves out everything
+# but errors; "addresses" keeps _address, _size and _path; "full" also keeps
+# the raw data behind each int in its _trace.
+PROVENANCE_LEVELS = ["none", "addresses", "full"]
+PROVENANCE_NONE, PROVENANCE_ADDRESSES, PROVENANCE_FULL = range(3)
 
 class IOWithBits(BufferedIOBase):
+    _provenance = PROVENANCE_FULL
+    # How far back pipes on this stream keep their output for back-references
+    # (PipePointers), in bytes.  None keeps all of it.
+    _pipe_window = None
+    # Whether arrays of fixed-size elements are parsed as they're accessed.
+    _lazy = False
+    
     def __init__(self, *args, **kvargs):
         super().__init__(*args, **kvargs)
         self._byte = None
@@ -24,26 +43,433 @@ class IOWithBits(BufferedIOBase):
         
         return bit
     
-    def read_bits(self, bits):
-        if bits == 1:
+    def read_bits(self, bits, msb=False):
+        """ Reads `bits` bits, least significant first within each byte, or
+        most significant first with `msb`.  Only as many whole bytes as are
+        needed are read, all at once. """
+        if bits == 1 and not msb:
             return self.read_bit()
-        num = 0
-        for i in range(bits):
-            num |= self.read_bit() << i
+        if self._byte == None:
+            available = 0
+            acc = 0
+            last = None
+        else:
+            available = 8 - self._bit_number
+            last = self._byte
+            if msb:
+                acc = last & ((1 << available) - 1)
+            else:
+                acc = last >> self._bit_number
+        
+        if bits > available:
+            data = self._read((bits - available + 7) >> 3)
+            if msb:
+                acc = (acc << (len(data) * 8)) | int.from_bytes(data, 'big')
+            else:
+                acc |= int.from_bytes(data, 'little') << available
+            available += len(data) * 8
+            last = data[-1]
+        
+        left = available - bits
+        if msb:
+            value = acc >> left
+        else:
+            value = acc & ((1 << bits) - 1)
         
-        return num
+        if left:
+            self._byte = last
+            self._bit_number = 8 - left
+        else:
+            self._byte = None
+            self._bit_number = None
+        
+        return value
     
     def read(self, amount, strict=True):
-        pos = self.tell()
         if self._byte != None:
-            raise ReadError(f"Attempting to read bytes while not byte-aligned.\nRead of size {amount} at position {hex(pos)}.")
+            raise ReadError(f"Attempting to read bytes while not byte-aligned.\nRead of size {amount} at position {hex(self.tell())}.")
+        return self._read(amount, strict)
+    
+    def _read(self, amount, strict=True):
+        """ Reads whole bytes regardless of the bit state. """
+        pos = self.tell()
         result = super().read(amount)
         if strict and len(result) < amount:
             raise ReadError(f"Data access out of bounds.\nRead of size {amount} at position {hex(pos)}.")
         return result
+    
+    def read_fixed(self, amount):
+        """ Reads exactly `amount` bytes if possible.  Otherwise returns None
+        and leaves the stream as it was, so the caller can fall back to
+        reading piecewise (and failing in the usual place). """
+        if self._byte != None:
+            return None
+        pos = self.tell()
+        result = super().read(amount)
+        if len(result) < amount:
+            self.seek(pos)
+            return None
+        return result
+    
+    def read_until(self, stops, limit=None):
+        """ Reads whole bytes up to the first one matching `stops`, a
+        compiled bytes pattern, and at most `limit` of them.  Streams that
+        can't search ahead read nothing. """
+        return b""
+    
+    def view(self):
+        """ The data behind the stream and the position in it, for reading
+        ahead in bulk, or None if there's no such thing or the stream isn't
+        byte-aligned. """
+        if self._byte != None or not hasattr(self, "getbuffer"):
+            return None
+        return self.getbuffer(), self.tell()
+    
+    def unpack(self, unpacker):
+        """ Reads and unpacks a struct.Struct. """
+        return unpacker.unpack(self.read(unpacker.size))
+    
+    def position(self):
+        """ An opaque position, including the bit state, for restore(). """
+        return (self.tell(), self._bit_number, self._byte)
+    
+    def restore(self, position):
+        pos, self._bit_number, self._byte = position
+        self.seek(pos)
+    
+    def jump(self, address):
+        """ Seeks to a byte address, dropping any partially read byte. """
+        self.seek(address)
+        self._bit_number = 0
+        self._byte = None
 
 BytesIOWithBits = type(f"BytesIOWithBits", (IOWithBits, BytesIO), {})
 
+# Files at least this big are mapped rather than read into memory.
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+class BufferStream(IOWithBits):
+    """ Input over a bytes-like buffer (bytes, memoryview or mmap) with an
+    integer cursor.  The cursor counts bits, so a position() is a plain int.
+    As with IOWithBits, a byte counts as read once any of its bits are. """
+    def __init__(self, buffer):
+        if isinstance(buffer, memoryview):
+            buffer = buffer.cast("B")
+        self._buffer = buffer
+        self._length = len(buffer)
+        self._cursor = 0
+    
+    @classmethod
+    def open(self, data):
+        """ Makes a stream from bytes, a buffer, a path or a binary file. """
+        if isinstance(data, (bytes, bytearray, memoryview, mmap.mmap)):
+            return self(data)
+        if isinstance(data, (str, os.PathLike)):
+            with open(data, 'rb') as f:
+                return self.open(f)
+        if hasattr(data, "fileno") and data.seekable() and data.tell() == 0:
+            try:
+                size = os.fstat(data.fileno()).st_size
+            except OSError:
+                size = 0
+            if size >= MMAP_THRESHOLD:
+                # The map stays valid after the file is closed.
+                return self(mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ))
+        return self(data.read())
+    
+    def tell(self):
+        return (self._cursor + 7) >> 3
+    
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            offset += self._length
+        self._cursor = offset << 3
+        return offset
+    
+    def seekable(self):
+        return True
+    
+    def readable(self):
+        return True
+    
+    def read_bit(self):
+        cursor = self._cursor
+        pos = cursor >> 3
+        if pos >= self._length:
+            raise ReadError(f"Data access out of bounds.\nRead of size 1 at position {hex(pos)}.")
+        self._cursor = cursor + 1
+        return (self._buffer[pos] >> (cursor & 7)) & 1
+    
+    def read_bits(self, bits, msb=False):
+        cursor = self._cursor
+        pos = cursor >> 3
+        end = (cursor + bits + 7) >> 3
+        if end > self._length:
+            start = self.tell()
+            raise ReadError(f"Data access out of bounds.\nRead of size {end - start} at position {hex(start)}.")
+        self._cursor = cursor + bits
+        if msb:
+            return (int.from_bytes(self._buffer[pos:end], 'big') >> (((end - pos) << 3) - (cursor & 7) - bits)) \
+              & ((1 << bits) - 1)
+        else:
+            return (int.from_bytes(self._buffer[pos:end], 'little') >> (cursor & 7)) & ((1 << bits) - 1)
+    
+    def read(self, amount=-1, strict=True):
+        if self._cursor & 7:
+            raise ReadError(f"Attempting to read bytes while not byte-aligned.\nRead of size {amount} at position {hex(self.tell())}.")
+        pos = self._cursor >> 3
+        if amount is None or amount < 0:
+            amount = self._length - pos
+        end = pos + amount
+        if end > self._length:
+            if strict:
+                raise ReadError(f"Data access out of bounds.\nRead of size {amount} at position {hex(pos)}.")
+            end = max(self._length, pos)
+        self._cursor = end << 3
+        return bytes(self._buffer[pos:end])
+    
+    def read_fixed(self, amount):
+        pos = self._cursor >> 3
+        if self._cursor & 7 or pos + amount > self._length:
+            return None
+        self._cursor = (pos + amount) << 3
+        return bytes(self._buffer[pos:pos + amount])
+    
+    def view(self):
+        if self._cursor & 7:
+            return None
+        return self._buffer, self._cursor >> 3
+    
+    def read_until(self, stops, limit=None):
+        if self._cursor & 7:
+            return b""
+        pos = self._cursor >> 3
+        end = self._length if limit is None else max(min(pos + limit, self._length), pos)
+        if stops is not None:
+            match = stops.search(self._buffer, pos, end)
+            if match:
+                end = match.start()
+        self._cursor = end << 3
+        return bytes(self._buffer[pos:end])
+    
+    def unpack(self, unpacker):
+        if self._cursor & 7:
+            return super().unpack(unpacker)
+        pos = self._cursor >> 3
+        if pos + unpacker.size > self._length:
+            # Fails with the usual error.
+            return super().unpack(unpacker)
+        self._cursor = (pos + unpacker.size) << 3
+        return unpacker.unpack_from(self._buffer, pos)
+    
+    def position(self):
+        return self._cursor
+    
+    def restore(self, position):
+        self._cursor = position
+    
+    def jump(self, address):
+        self._cursor = address << 3
+
+# Pipes drop data that's out of their window in pieces at least this big.
+PIPE_COMPACT_SIZE = 64 * 1024
+
+class PipeBuffer(BufferStream):
+    """ The output of a pipe's left side.  Addresses count from the start of
+    the output, but once a pipe is done with the data before its `window`,
+    that's dropped; reading it is then a ReadError. """
+    def __init__(self, window=None):
+        super().__init__(bytearray())
+        self._window = window
+        # The address of _buffer[0].
+        self._base = 0
+    
+    def append(self, data):
+        self._buffer += data
+        self._length = len(self._buffer)
+    
+    def take(self, address, amount):
+        """ Reads `amount` bytes at `address`, leaving the cursor alone. """
+        if address < self._base:
+            raise ReadError(f"Pipe data out of the window.\nRead at {hex(address)}, but only data from {hex(self._base)} on is kept.")
+        pos = address - self._base
+        return bytes(self._buffer[pos:pos + amount])
+
+    def copy(self, address, amount, strict=True):
+        """ Reads `amount` bytes at `address` like take(), but bytes past the
+        end are those from `address` on again, as if each byte read had been
+        appended before reading the next: an LZ back-reference. """
+        if address < self._base:
+            raise ReadError(f"Pipe data out of the window.\nRead at {hex(address)}, but only data from {hex(self._base)} on is kept.")
+        pos = address - self._base
+        available = self._length - pos
+        if available >= amount:
+            return bytes(self._buffer[pos:pos + amount])
+        if available <= 0:
+            if strict and amount:
+                raise ReadError(f"Data access out of bounds.\nRead of size {amount} at position {hex(address)}.")
+            return b""
+        pattern = bytes(self._buffer[pos:])
+        return (pattern * (amount // available + 1))[:amount]
+
+    def release(self, address):
+        """ Drops what's out of the window, for a pipe that has read up to
+        `address`.  The buffer is compacted rarely enough to take amortized
+        constant time per byte. """
+        if self._window is None:
+            return
+        drop = address - self._window - self._base
+        if drop >= PIPE_COMPACT_SIZE and drop * 2 >= self._length:
+            del self._buffer[:drop]
+            self._base += drop
+            self._length -= drop
+            self._cursor = max(self._cursor - (drop << 3), 0)
+    
+    def tell(self):
+        return self._base + super().tell()
+    
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence == 2:
+            offset += self._base + self._length
+        # Like BytesIO.
+        offset = max(offset, 0)
+        if offset < self._base:
+            raise ReadError(f"Pipe data out of the window.\nSeek to {hex(offset)}, but only data from {hex(self._base)} on is kept.")
+        self._cursor = (offset - self._base) << 3
+        return offset
+    
+    def position(self):
+        return (self._base << 3) + self._cursor
+    
+    def restore(self, position):
+        self._cursor = position - (self._base << 3)
+    
+    def jump(self, address):
+        self.seek(address)
+
+PLAIN_TYPES = (type(None), int, str, bool, bytes, list, dict)
+
+def plain(value):
+    """ Converts a parse result to bare Python objects, as in _json() but
+    keeping bytes as they are.  Small ints come out of the interpreter's
+    shared cache.  Exceptions from lenient parsing are kept. """
+    if type(value) in PLAIN_TYPES or isinstance(value, Exception):
+        return value
+    return value._plain()
+
+def add_bits(*sizes):
+    """ The sum of bit_size()s, or None if any of them depends on the data. """
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+# Where the parts of a resolved type are kept.
+PART_ATTRIBUTES = ("_contents", "_return", "_parsetype", "_length", "_type", "_addr",
+    "_match", "_left_type", "_right_type", "_true_struct", "_false_struct", "_expr",
+    "_left", "_right", "_index", "_replacement")
+
+def has_effects(type_, seen=None):
+    """ Whether parsing `type_` does more than read and make a value: yield,
+    or save or print a field.  Those can't be put off until later. """
+    if not isinstance(type_, type):
+        return True
+    if type_._yields:
+        return True
+    if seen is None:
+        seen = set()
+    if type_ in seen:
+        return False
+    seen.add(type_)
+    for attribute in PART_ATTRIBUTES:
+        part = getattr(type_, attribute, None)
+        parts = part.values() if isinstance(part, dict) else (part,)
+        for part in parts:
+            if part is None or isinstance(part, (int, str)):
+                continue
+            if has_effects(part, seen):
+                return True
+    return False
+
+class ParsePath():
+    """ A path into the parse result.  Each step only links to its parent,
+    so that going down a level doesn't copy the path; it's made into a list
+    when iterated, e.g. for an error message. """
+    __slots__ = ("_parent", "_name")
+
+    def __init__(self, parent=None, name=None):
+        self._parent = parent
+        self._name = name
+
+    def list(self):
+        names = []
+        node = self
+        while node._parent is not None:
+            names.append(node._name)
+            node = node._parent
+        names.reverse()
+        return names
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __len__(self):
+        return len(self.list())
+
+    def __add__(self, other):
+        return self.list() + list(other)
+
+    def __eq__(self, other):
+        if isinstance(other, (ParsePath, list)):
+            return self.list() == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.list())
+
+class ParseState():
+    """ What parse_stream works with besides the type: the stream, the stack
+    of structs being parsed (ctx), the path to the value being parsed and the
+    parse flags.  `right_size` is the size of the innermost pipe's right
+    side.  `output_dir` is where !save writes files.
+
+    There's one per parse.  Types that go down a level set `path` for the
+    duration and put it back afterwards; the rare ones that parse from
+    another stream or with other flags do so with a `copy()`. """
+    __slots__ = ("stream", "ctx", "path", "lenient", "strict_read",
+        "pipebuffer", "pipestream", "right_size", "output_dir")
+
+    def __init__(self, stream, ctx=None, path=None, lenient=False,
+            strict_read=True, pipebuffer=None, pipestream=None, right_size=None,
+            output_dir=None):
+        self.stream = stream
+        self.ctx = [] if ctx is None else ctx
+        self.path = ParsePath() if path is None else path
+        self.lenient = lenient
+        self.strict_read = strict_read
+        self.pipebuffer = pipebuffer
+        self.pipestream = pipestream
+        self.right_size = right_size
+        self.output_dir = output_dir
+
+    def copy(self, **changes):
+        state = ParseState(self.stream, self.ctx, self.path, self.lenient,
+            self.strict_read, self.pipebuffer, self.pipestream, self.right_size,
+            self.output_dir)
+        for name, value in changes.items():
+            setattr(state, name, value)
+        return state
+
+    def strict(self):
+        """ This state, or a copy of it if it's lenient, for parsing parts of
+        a value whose errors are the whole value's. """
+        return self.copy(lenient=False) if self.lenient else self
+
 class Subs(dict):
     def __init__(self, *subs, **kwargs):
         for sub in subs:
@@ -79,6 +505,9 @@ class DatamijnObject():
     _inherited_fields = []
     _arguments = []
     _subs = Subs()
+    # Whether parse_stream makes what _parse_stream returns into an instance
+    # of the type, rather than giving it as it is.
+    _wrap = True
     
     #def __init__(self, value=None, data=None):
     #    self._value = value
@@ -92,7 +521,25 @@ class DatamijnObject():
             return None
         else:
             raise NotImplementedError()
-    
+
+    @classmethod
+    def bit_size(self):
+        """ How many bits parsing this type always reads, or None if that
+        depends on the data.  Worked out once the type is resolved; a type
+        that contains itself depends on the data. """
+        if "_bits" not in self.__dict__:
+            self._bits = None
+            self._bits = self._bit_size()
+        return self._bits
+
+    @classmethod
+    def _bit_size(self):
+        try:
+            size = self.size()
+        except NotImplementedError:
+            return None
+        return None if size is None else size * 8
+
     @classmethod
     def rename(self, name=None):
         if name == None:
@@ -128,11 +575,11 @@ class DatamijnObject():
         return newtype
         
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _parse_stream(self, state, index=None):
         raise NotImplementedError()
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, lenient=False, **kwargs):
+    def parse_stream(self, state, index=None):
         #rich = ctx[0]._rich
         #if rich:
         #    address = stream.tell()
@@ -143,15 +590,20 @@ class DatamijnObject():
         #    #data = stream.read(1)
         #    #data = Data(data=data, address=address, length=length)
         
+        lenient = state.lenient
         try:
-            value = self._parse_stream(stream, ctx, path, index=index, **kwargs)
+            value = self._parse_stream(state, index=index)
             #assert value != None
         except Exception as ex:
             if lenient:
                 obj = ex
+            elif isinstance(ex, DatamijnPathError):
+                raise
             else:
-                raise type(ex)(f'{ex}\nPath: {".".join(str(x) for x in path)}')
+                raise type(ex)(f'{ex}\nPath: {".".join(str(x) for x in state.path)}')
         else:
+            if not self._wrap:
+                return value
             if not isinstance(value, self):
                 obj = self.__new__(self, value)
                 obj.__init__(value)
@@ -161,8 +613,11 @@ class DatamijnObject():
         #if rich:
             #obj._address = address
             #obj._size = length
-        obj._path = path
-        obj._error = lenient and isinstance(obj, Exception)
+        if state.stream._provenance:
+            obj._path = state.path
+            obj._error = lenient and isinstance(obj, Exception)
+        elif lenient and isinstance(obj, Exception):
+            obj._error = True
             
         return obj
     
@@ -188,12 +643,18 @@ class DatamijnObject():
     def _or_type(self, other):
         return None
     
-    def _save(self, ctx, path):
+    def _save(self, output_dir, path):
         pass
         #raise SaveNotImplementedError(path, f"{type(self).__name__} doesn't implement !save")
     
     def _json(self) -> JsonType:
         raise NotImplementedError(f"_json() is not implemented for type {self.__class__}")
+    
+    def _plain(self):
+        """ The value as bare dicts, lists, ints, strs and bytes. """
+        if isinstance(self, bytes):
+            return bytes(self)
+        return self._json()
 
     
 class UninitializedSub(DatamijnObject):
@@ -221,7 +682,7 @@ class Token(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def parse_stream(self, state, index=None):
         return self()
     
     def __str__(self):
@@ -250,20 +711,22 @@ class Null(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def parse_stream(self, state, index=None):
         return None
 
 class Byte(DatamijnObject, bytes):
     _size = 1
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _parse_stream(self, state, index=None):
+        stream = state.stream
         address = stream.tell()
         read = stream.read(1)
         if len(read) != 1:
-            raise ParseError(path, "Failed to read stream")
+            raise ParseError(state.path, "Failed to read stream")
         byte = self(read)
-        byte._address = address
-        byte._size = 1
+        if stream._provenance:
+            byte._address = address
+            byte._size = 1
         return byte
     
     @classmethod
@@ -274,24 +737,27 @@ class Byte(DatamijnObject, bytes):
 class Short(DatamijnObject, bytes):
     _size = 2
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _parse_stream(self, state, index=None):
+        stream = state.stream
         address = stream.tell()
         read = stream.read(2)[::-1]
         if len(read) != self._size:
-            raise ParseError(path, "Failed to read stream")
+            raise ParseError(state.path, "Failed to read stream")
         short = self(read)
-        short._address = address
-        short._size = self._size
+        if stream._provenance:
+            short._address = address
+            short._size = self._size
         return short
 
 class Word(DatamijnObject, bytes):
     _size = 4
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _parse_stream(self, state, index=None):
+        stream = state.stream
         # FIXME
         read = stream.read(4)[::-1]
         if len(read) != self._size:
-            raise ParseError(path, "Failed to read stream")
+            raise ParseError(state.path, "Failed to read stream")
         return self(read)
 
 class DatamijnInt(DatamijnObject, TraceInt):
@@ -309,6 +775,9 @@ class DatamijnInt(DatamijnObject, TraceInt):
     
     def _json(self) -> JsonType:
         return int(self)
+    
+    def _plain(self):
+        return int(self)
 
 class HexDatamijnObject(DatamijnInt):
     _root_name = "HexDatamijnObject"
@@ -322,9 +791,14 @@ class HexDatamijnObject(DatamijnInt):
 class DatamijnBits(DatamijnInt):
     _size = None
     _num_bits = None
+    _msb = False
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        value = stream.read_bits(self._num_bits)
+    def _bit_size(self):
+        return self._num_bits
+    
+    @classmethod
+    def _parse_stream(self, state, index=None):
+        value = state.stream.read_bits(self._num_bits, self._msb)
         return value
 
 class B1(DatamijnInt):
@@ -332,19 +806,38 @@ class B1(DatamijnInt):
     _size = None
     _num_bits = 1
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        value = stream.read_bit()
+    def _bit_size(self):
+        return 1
+    
+    @classmethod
+    def _parse_stream(self, state, index=None):
+        value = state.stream.read_bit()
         return value
 
-def make_bit_type(num_bits):
-    return type(f"B{num_bits}", (DatamijnBits,), {"_num_bits": num_bits, "_root_name": f"B{num_bits}"})
+def make_bit_type(num_bits, msb=False):
+    name = f"MSB{num_bits}" if msb else f"B{num_bits}"
+    return type(name, (DatamijnBits,), {"_num_bits": num_bits, "_msb": msb, "_root_name": name})
+
+S8_FORMAT = pystruct.Struct("<b")
+U16_FORMAT = pystruct.Struct("<H")
+U32_FORMAT = pystruct.Struct("<I")
 
 class U8(DatamijnInt):
     _root_name = "U8"
     _size = 1
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        data = Byte().parse_stream(stream, ctx, path, **kwargs)
+    def _parse_stream(self, state, index=None):
+        stream = state.stream
+        if not stream._provenance:
+            return self(stream.read(1)[0])
+        elif stream._provenance < PROVENANCE_FULL:
+            # Without the Byte it was read from, an int keeps the address.
+            address = stream.tell()
+            value = self(stream.read(1)[0])
+            value._address = address
+            value._size = 1
+            return value
+        data = Byte.parse_stream(state.strict())
         value = self(ord(data))
         value._trace = Source(self, data)
         return value
@@ -353,8 +846,17 @@ class S8(DatamijnInt):
     _root_name = "S8"
     _size = 1
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        data = Byte().parse_stream(stream, ctx, path, **kwargs)
+    def _parse_stream(self, state, index=None):
+        stream = state.stream
+        if not stream._provenance:
+            return self(stream.unpack(S8_FORMAT)[0])
+        elif stream._provenance < PROVENANCE_FULL:
+            address = stream.tell()
+            value = self(stream.unpack(S8_FORMAT)[0])
+            value._address = address
+            value._size = 1
+            return value
+        data = Byte.parse_stream(state.strict())
         value = ord(data)
         if value > 127:
             value = -(256 - value)
@@ -366,8 +868,17 @@ class U16(DatamijnInt):
     _root_name = "U16"
     _size = 2
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        data = Short().parse_stream(stream, ctx, path, **kwargs)
+    def _parse_stream(self, state, index=None):
+        stream = state.stream
+        if not stream._provenance:
+            return self(stream.unpack(U16_FORMAT)[0])
+        elif stream._provenance < PROVENANCE_FULL:
+            address = stream.tell()
+            value = self(stream.unpack(U16_FORMAT)[0])
+            value._address = address
+            value._size = 2
+            return value
+        data = Short.parse_stream(state.strict())
         value = self(data[1] | (data[0] << 8))
         value._trace = Source(self, data)
         return value
@@ -376,10 +887,8 @@ class U32(DatamijnInt):
     _root_name = "U32"
     _size = 4
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        data = stream.read(4)
-        value = data[0] | (data[1] << 8) | (data[2] << 16) | (data[3] << 24)
-        return value
+    def _parse_stream(self, state, index=None):
+        return state.stream.unpack(U32_FORMAT)[0]
 
 class DatamijnString(DatamijnObject, str):
     _root_name = "DatamijnString"
@@ -403,6 +912,8 @@ class Array(DatamijnObject):
     _concat = False
     _bytestring = False
     _final_length = False
+    # Whether results can be a LazyArray.
+    _lazy_elements = False
     
     ARRAY_CLASSES = {
     }
@@ -431,6 +942,8 @@ class Array(DatamijnObject):
                     new_array_type = new_class
                 else:
                     new_array_type = None
+            if new_array_type and not new_array_type._accepts(self):
+                new_array_type = None
             if new_array_type:
                 break
     
@@ -458,42 +971,132 @@ class Array(DatamijnObject):
         return new
         
     
+    @classmethod
+    def _accepts(self, array):
+        """ Whether this array class can hold the resolved `array`. """
+        return True
+    
+    @classmethod
+    def static_length(self):
+        """ The length, if it doesn't depend on the data. """
+        length = self._length
+        if isinstance(length, type) and issubclass(length, ExprInt):
+            length = length._int
+        return length if isinstance(length, int) else None
+    
     @classmethod
     def size(self):
-        if isinstance(self._length, int):
-            return self._length * self._parsetype.infer_type().size()
-        else:
+        bits = self.bit_size()
+        return None if bits is None else (bits + 7) >> 3
+    
+    @classmethod
+    def lazy_stride(self):
+        """ The size of each element in bytes, if they can be parsed when
+        they're first accessed instead, otherwise None. """
+        if "_stride" not in self.__dict__:
+            bits = self._parsetype.bit_size()
+            self._stride = None
+            if self._lazy_elements and bits and not bits & 7 and not has_effects(self._parsetype):
+                self._stride = bits >> 3
+        return self._stride
+    
+    @classmethod
+    def _bit_size(self):
+        length = self.static_length()
+        if length is None:
             return None
+        if self._parsetype != Byte:
+            # Like parse_stream, which always parses at least one element.
+            length = max(length, 1)
+        bits = self._parsetype.bit_size()
+        return None if bits is None else length * bits
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, strict_read=True, **kwargs):
+    def parse_stream(self, state, index=None):
+        stream = state.stream
+        path = state.path
         contents = []
         if self._final_length:
             length = self._length
         elif self._length != None:
-            length = self._length.parse_stream(stream, ctx, path, strict_read=strict_read, **kwargs)
+            length = self._length.parse_stream(state)
         else:
             length = None
         
         start_address = stream.tell()
         
+        if stream._lazy and isinstance(length, int) and length > 0 and self.lazy_stride() \
+          and not (state.lenient or state.pipebuffer or state.pipestream):
+            obj = LazyArray.parse(self, state, length)
+            if obj is not None:
+                return obj
+        
         if self._length != None and self._parsetype == Byte:
             # Speed optimization for byte arrays!
-            print(type(stream))
-            return stream.read(length, strict=strict_read)
+            return stream.read(length, strict=state.strict_read)
+        
+        layout = getattr(self._parsetype, "_layout", None)
+        if layout and isinstance(length, int) \
+          and self._parsetype.parse_stream.__func__ is Struct.parse_stream.__func__:
+            # Fixed-layout records: one read, one iter_unpack.  Like the loop
+            # below, this always parses at least one element.
+            count = max(length, 1)
+            data = stream.read_fixed(layout.size * count)
+            if data != None:
+                contents = []
+                provenance = stream._provenance
+                for i, values in enumerate(layout.unpacker.iter_unpack(data)):
+                    offset = i * layout.size
+                    contents.append(layout.build(data, offset, values,
+                        start_address + offset, state.ctx, ParsePath(path, i), provenance))
+                obj = self(contents)
+                if provenance:
+                    obj._address = start_address
+                    obj._size = len(data)
+                    obj._path = path
+                obj._error = False
+                return obj
+        
+        # Runs of plain characters are decoded in one go.
+        translation = getattr(self._parsetype, "_translation", None)
+        # The strings making up contents[-1], which are joined once it's
+        # followed by something else.
+        pieces = []
         
         error = False
         i = 0
         while True:
-            item = self._parsetype.parse_stream(stream, ctx, path + [i], index=i, strict_read=strict_read, **kwargs)
+            if translation is not None:
+                run = stream.read_until(self._parsetype._stop_bytes,
+                    None if length is None else length - i)
+                if len(run) > 1:
+                    item = DatamijnString(run.decode("latin-1").translate(translation))
+                    if pieces and type(pieces[0]) is DatamijnString:
+                        pieces.append(item)
+                    else:
+                        if len(pieces) > 1:
+                            contents[-1] = type(pieces[0])("".join(pieces))
+                        contents.append(item)
+                        pieces = [item]
+                    i += len(run)
+                    if length != None and i >= length:
+                        break
+                elif run:
+                    # A lone character keeps its _match_value.
+                    stream.jump(stream.tell() - 1)
+            state.path = ParsePath(path, i)
+            item = self._parsetype.parse_stream(state, index=i)
             if hasattr(item, '_error') and item._error:
                 error = True
-            if self._concat and len(contents) \
-              and type(contents[-1]) == type(item) \
+            if self._concat and pieces \
+              and type(pieces[0]) == type(item) \
               and isinstance(item, str):
-                contents[-1] += item
+                pieces.append(item)
             else:
+                if len(pieces) > 1:
+                    contents[-1] = type(pieces[0])("".join(pieces))
                 contents.append(item)
+                pieces = [item] if self._concat and isinstance(item, str) else []
             
             i += 1
             if length != None:
@@ -508,6 +1111,9 @@ class Array(DatamijnObject):
                 break
             #else:
             #    raise ValueError("Improper terminating condition")
+        if len(pieces) > 1:
+            contents[-1] = type(pieces[0])("".join(pieces))
+        state.path = path
         
         size = stream.tell() - start_address
 
@@ -518,9 +1124,10 @@ class Array(DatamijnObject):
             return b"".join(contents)
         else:
             obj = self(contents)
-            obj._address = start_address
-            obj._size = size
-            obj._path = path
+            if stream._provenance:
+                obj._address = start_address
+                obj._size = size
+                obj._path = path
             obj._error = error
             return obj
     
@@ -546,9 +1153,9 @@ class Array(DatamijnObject):
         
         return newlist
         
-    def _save(self, ctx, path):
+    def _save(self, output_dir, path):
         for i, elem in enumerate(self):
-            elem._save(ctx, path + [i])
+            elem._save(output_dir, path + [i])
             
     def __repr__(self):
         return f"{type(self).__name__}"
@@ -573,30 +1180,117 @@ class Array(DatamijnObject):
     
     def _json(self) -> JsonType:
         return [elem if type(elem) in JsonTypes else elem._json() for elem in self]
+    
+    def _plain(self):
+        return [plain(elem) for elem in self]
 
 class ListArray(list, Array):
+    _lazy_elements = True
+    
     def __add__(self, other):
-        if not isinstance(other, ListArray):
+        if not isinstance(other, (ListArray, NumericArray)):
             return NotImplemented
         
         return type(self)(list(self) + list(other))
 
+# An element of a LazyArray that hasn't been parsed yet.
+UNPARSED = object()
+
+class LazyArray(ListArray):
+    """ An array whose elements, each `stride` bytes long, are parsed from
+    `base` on as they're first accessed, with the state the array was parsed
+    in.  Anything that goes through all of them (iterating, comparing,
+    _json()) parses them all. """
+    _state = None
+    
+    @classmethod
+    def parse(self, array, state, length):
+        """ Makes a lazy result of the resolved `array`, or returns None if
+        the stream doesn't have all of its data at hand. """
+        stream = state.stream
+        stride = array.lazy_stride()
+        view = stream.view()
+        if view is None or view[1] + length * stride > len(view[0]):
+            return None
+        if "_lazy_type" not in array.__dict__:
+            array._lazy_type = type(array.__name__, (self, array), {})
+        obj = array._lazy_type([UNPARSED] * length)
+        obj._state = state.copy(ctx=list(state.ctx))
+        obj._base = stream.tell()
+        obj._stride = stride
+        stream.jump(obj._base + length * stride)
+        if stream._provenance:
+            obj._address = obj._base
+            obj._size = length * stride
+            obj._path = state.path
+        obj._error = False
+        return obj
+    
+    def _element(self, i):
+        state = self._state
+        stream = state.stream
+        position = stream.position()
+        stream.jump(self._base + i * self._stride)
+        item = self._parsetype.parse_stream(state.copy(path=ParsePath(state.path, i)), index=i)
+        stream.restore(position)
+        list.__setitem__(self, i, item)
+        return item
+    
+    def _materialize(self):
+        for i, item in enumerate(list.__iter__(self)):
+            if item is UNPARSED:
+                self._element(i)
+    
+    def __getitem__(self, key):
+        item = list.__getitem__(self, key)
+        if isinstance(key, slice):
+            if any(element is UNPARSED for element in item):
+                self._materialize()
+                item = list.__getitem__(self, key)
+        elif item is UNPARSED:
+            item = self._element(int(key) % len(self))
+        return item
+    
+    def __iter__(self):
+        for i, item in enumerate(list.__iter__(self)):
+            yield self._element(i) if item is UNPARSED else item
+
+def _materializing(method):
+    def materializing(self, *args, **kwargs):
+        self._materialize()
+        return method(self, *args, **kwargs)
+    materializing.__name__ = method.__name__
+    return materializing
+
+# What sees the elements without __getitem__, or moves them from where
+# they're parsed from.
+for name in ("__contains__", "__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__",
+  "__reversed__", "__delitem__", "__mul__", "__rmul__", "__imul__",
+  "copy", "count", "index", "insert", "pop", "remove", "reverse", "sort"):
+    setattr(LazyArray, name, _materializing(getattr(list, name)))
+del name
+
 class String(ListArray):
     _concat = True
+    _lazy_elements = False
+    # Rendered by __str__; parse results aren't changed after the fact.
+    _str = None
     
     def __str__(self):
-        string = ""
-        for item in self:
-            if isinstance(item, str):
-                string += item
-            elif isinstance(item, Terminator):
-                pass
-            elif isinstance(item, Exception):
-                pass
-            else:
-                string += f"<{repr(item)}>"
+        if self._str is None:
+            pieces = []
+            for item in self:
+                if isinstance(item, str):
+                    pieces.append(item)
+                elif isinstance(item, Terminator):
+                    pass
+                elif isinstance(item, Exception):
+                    pass
+                else:
+                    pieces.append(f"<{repr(item)}>")
+            self._str = "".join(pieces)
         
-        return string
+        return self._str
     
     def _pretty_repr(self):
         string = str(self).replace('"', '\"')
@@ -604,17 +1298,396 @@ class String(ListArray):
     
     def _json(self) -> JsonType:
         return str(self)
+    
+    def _plain(self):
+        return str(self)
 
 class ByteString(bytes, Array):
     _concat = True
     _bytestring = True
+    
+    def _plain(self):
+        return bytes(self)
 
     def _pretty_repr(self):
         return repr(self)
 
+class NumericArray(Array):
+    """ An array of U8, S8, U16 or U32 kept in a numpy array rather than as
+    one object per element.  Elements are built (trace and all) when they're
+    accessed.  Only used when numpy is installed. """
+    DTYPES = {
+        U8:     "u1",
+        S8:     "i1",
+        U16:    "<u2",
+        U32:    "<u4",
+    }
+    
+    def __init__(self, values):
+        # Parsing that couldn't use the fast path (unaligned streams, short
+        # data with lenient parsing, piping) gives a list of elements instead.
+        if isinstance(values, list):
+            self._values = None
+            self._items = values
+        else:
+            self._values = values
+            self._items = None
+    
+    @classmethod
+    def _accepts(self, array):
+        if array._subs.length is None or importlib.util.find_spec("numpy") is None:
+            return False
+        primitive = FixedLayout.primitive_kind(array._parsetype)
+        return primitive != None and primitive[0] in self.DTYPES
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        import numpy
+        stream = state.stream
+        length = self._length.parse_stream(state)
+        start_address = stream.tell()
+        kind, fmt = FixedLayout.primitive_kind(self._parsetype)
+        dtype = numpy.dtype(self.DTYPES[kind])
+        # Like Array, this always parses at least one element.
+        data = stream.read_fixed(max(length, 1) * dtype.itemsize)
+        if data == None:
+            return super().parse_stream(state, index=index)
+        obj = self(numpy.frombuffer(data, dtype=dtype))
+        obj._data = data
+        obj._provenance = stream._provenance
+        if obj._provenance:
+            obj._address = start_address
+            obj._size = len(data)
+            obj._path = state.path
+        obj._error = False
+        return obj
+    
+    def _element(self, i):
+        if self._items is not None:
+            return self._items[i]
+        size = self._values.itemsize
+        kind, fmt = FixedLayout.primitive_kind(self._parsetype)
+        if self._provenance:
+            address = self._address + i * size
+            path = ParsePath(self._path, i)
+        else:
+            address = path = None
+        return FixedLayout.build_field(self._parsetype, kind, self._data, i * size,
+            address, path, int(self._values[i]), self._provenance)
+    
+    def __len__(self):
+        if self._items is not None:
+            return len(self._items)
+        return len(self._values)
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(len(self))[key]]
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("list index out of range")
+        return self._element(key)
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._element(i)
+    
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, NumericArray)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self.tolist(), other))
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __add__(self, other):
+        if not isinstance(other, (ListArray, NumericArray)):
+            return NotImplemented
+        return type(self)(list(self) + list(other))
+    
+    def __repr__(self):
+        return repr(self.tolist())
+    
+    def tolist(self):
+        if self._items is not None:
+            return list(self._items)
+        return self._values.tolist()
+    
+    def _save(self, output_dir, path):
+        if self._items is not None:
+            super()._save(output_dir, path)
+    
+    def _json(self) -> JsonType:
+        if self._items is not None:
+            return super()._json()
+        return self._values.tolist()
+    
+    def _plain(self):
+        if self._items is not None:
+            return super()._plain()
+        return self._values.tolist()
+
+class FixedLayout():
+    """ The layout of a struct made only of byte-aligned primitives, so that
+    a record can be decoded with a single unpack_from.  Results are built
+    exactly as parsing field by field would. """
+    FORMATS = (
+        (U8,    "B"),
+        (S8,    "b"),
+        (U16,   "H"),
+        (U32,   "I"),
+        (Byte,  "c"),
+        (Short, "2s"),
+        (Word,  "4s"),
+    )
+    
+    def __init__(self, struct, fields):
+        self.struct = struct
+        self.fields = fields
+        self.unpacker = pystruct.Struct("<" + "".join(fmt for name, type_, kind, fmt, offset in fields))
+        self.size = self.unpacker.size
+    
+    def __getstate__(self):
+        # struct.Struct doesn't pickle; the resolved definition cache needs to.
+        return {"struct": self.struct, "fields": self.fields}
+    
+    def __setstate__(self, state):
+        self.__init__(state["struct"], state["fields"])
+    
+    @classmethod
+    def primitive_kind(self, type_):
+        """ Returns the (kind, format) a primitive type decodes as, or None. """
+        if not isinstance(type_, type) \
+          or type_.parse_stream.__func__ is not DatamijnObject.parse_stream.__func__:
+            return None
+        for kind, fmt in self.FORMATS:
+            if type_._parse_stream.__func__ is kind._parse_stream.__func__:
+                return kind, fmt
+        return None
+    
+    @classmethod
+    def of(self, struct):
+        if struct._return or not struct._contents \
+          or struct.parse_stream.__func__ is not Struct.parse_stream.__func__:
+            return None
+        fields = []
+        offset = 0
+        for name, type_ in struct._contents.items():
+            primitive = self.primitive_kind(type_)
+            if not isinstance(name, str) or not primitive:
+                return None
+            kind, fmt = primitive
+            fields.append((name, type_, kind, fmt, offset))
+            offset += pystruct.calcsize("<" + fmt)
+        return self(struct, fields)
+    
+    @staticmethod
+    def build_field(type_, kind, data, start, address, path, value, provenance=PROVENANCE_FULL):
+        """ Builds the object parsing `type_` at `address` would give. """
+        if kind is U8 or kind is S8:
+            result = type_(value)
+            if provenance == PROVENANCE_FULL:
+                byte = Byte(data[start:start+1])
+                byte._address = address
+                byte._size = 1
+                byte._path = path
+                byte._error = False
+                result._trace = Source(type_, byte)
+            elif provenance:
+                result._address = address
+                result._size = 1
+        elif kind is U16:
+            result = type_(value)
+            if provenance == PROVENANCE_FULL:
+                short = Short(data[start:start+2][::-1])
+                short._address = address
+                short._size = 2
+                short._path = path
+                short._error = False
+                result._trace = Source(type_, short)
+            elif provenance:
+                result._address = address
+                result._size = 2
+        elif kind is U32:
+            result = type_(value)
+        elif kind is Byte:
+            result = type_(value)
+            if provenance:
+                result._address = address
+                result._size = 1
+        elif kind is Short:
+            result = type_(value[::-1])
+            if provenance:
+                result._address = address
+                result._size = 2
+        else:
+            result = type_(value[::-1])
+        if provenance:
+            result._path = path
+            result._error = False
+        return result
+    
+    def build(self, data, offset, values, address, ctx, path, provenance=PROVENANCE_FULL):
+        obj = self.struct()
+        obj._ctx = ctx
+        for (name, type_, kind, fmt, field_offset), value in zip(self.fields, values):
+            result = self.build_field(type_, kind, data, offset + field_offset,
+                address + field_offset, ParsePath(path, name), value, provenance)
+            dict.__setitem__(obj, name, result)
+        if provenance:
+            obj._address = address
+            obj._size = self.size
+            obj._path = path
+        obj._error = False
+        return obj
+
+class BitRun():
+    """ Consecutive bit fields of a struct which together fill whole bytes,
+    so they can be read at once and taken apart with shifts and masks. """
+    def __init__(self, fields, msb):
+        self.msb = msb
+        self.names = [name for name, type_ in fields]
+        total = sum(type_._num_bits for name, type_ in fields)
+        self.size = total >> 3
+        self.fields = []
+        offset = 0
+        for name, type_ in fields:
+            bits = type_._num_bits
+            shift = total - offset - bits if msb else offset
+            self.fields.append((name, type_, shift, (1 << bits) - 1))
+            offset += bits
+    
+    @staticmethod
+    def bit_order(type_):
+        """ "lsb" or "msb" for plain bit field types, otherwise None. """
+        if not isinstance(type_, type) \
+          or type_.parse_stream.__func__ is not DatamijnObject.parse_stream.__func__:
+            return None
+        if type_._parse_stream.__func__ is B1._parse_stream.__func__:
+            return "lsb"
+        if type_._parse_stream.__func__ is DatamijnBits._parse_stream.__func__:
+            return "msb" if type_._msb else "lsb"
+        return None
+    
+    @classmethod
+    def of(self, struct):
+        """ Returns the runs in a struct, keyed by the name of their first
+        field. """
+        runs = {}
+        items = list(struct._contents.items())
+        i = 0
+        while i < len(items):
+            order = isinstance(items[i][0], str) and self.bit_order(items[i][1])
+            end = None
+            total = 0
+            j = i
+            while order and j < len(items) and isinstance(items[j][0], str) \
+              and self.bit_order(items[j][1]) == order:
+                total += items[j][1]._num_bits
+                j += 1
+                if total % 8 == 0:
+                    end = j
+            if end and end - i >= 2:
+                runs[items[i][0]] = self(items[i:end], order == "msb")
+                i = end
+            else:
+                i += 1
+        return runs
+    
+    def read(self, stream, path):
+        """ Returns the parsed fields, or None if the stream isn't aligned or
+        too short, in which case they're to be read one by one. """
+        data = stream.read_fixed(self.size)
+        if data == None:
+            return None
+        acc = int.from_bytes(data, 'big' if self.msb else 'little')
+        if not stream._provenance:
+            return [type_((acc >> shift) & mask) for name, type_, shift, mask in self.fields]
+        results = []
+        for name, type_, shift, mask in self.fields:
+            result = type_((acc >> shift) & mask)
+            result._path = ParsePath(path, name)
+            result._error = False
+            results.append(result)
+        return results
+
+class Layout():
+    """ Where a resolved type's data is, as far as that's known before
+    parsing: its size and, for a struct, each field's offset from its start,
+    both in bits.  What depends on the data is None, and so is every offset
+    after a field of unknown size.  An array's elements, `count` of them if
+    that's fixed, follow each other with the `element` layout. """
+    def __init__(self, type_, bits, fields=(), count=None, element=None):
+        self.type = type_
+        self.bits = bits
+        # (name, offset, Layout) for each field
+        self.fields = list(fields)
+        self.count = count
+        self.element = element
+
+    @classmethod
+    def of(self, type_, seen=()):
+        while isinstance(type_, type) and issubclass(type_, NestedExprName):
+            type_ = type_._replacement
+        bits = type_.bit_size()
+        if issubclass(type_, Struct) and type_ not in seen:
+            fields = []
+            offset = 0
+            for name, field in type_._contents.items():
+                if not isinstance(field, type):
+                    continue
+                layout = self.of(field, seen + (type_,))
+                fields.append((name, offset, layout))
+                offset = add_bits(offset, layout.bits)
+            return self(type_, bits, fields)
+        elif issubclass(type_, Array):
+            return self(type_, bits, count=type_.static_length(),
+                element=self.of(type_._parsetype, seen))
+        return self(type_, bits)
+
+    @property
+    def size(self):
+        """ The size in bytes, with a partly read byte counting as read. """
+        return None if self.bits is None else (self.bits + 7) >> 3
+
+    @property
+    def dynamic(self):
+        return self.bits is None
+
+    @staticmethod
+    def format_bits(bits, hexadecimal=False):
+        if bits is None:
+            return "?"
+        whole = hex(bits >> 3) if hexadecimal else str(bits >> 3)
+        return f"{whole}.{bits & 7}" if bits & 7 else whole
+
+    def lines(self, name, offset, depth=0):
+        """ (offset, size, name, type name) for this and what's in it, as
+        str() lays them out. """
+        return [(self.format_bits(offset, True), self.format_bits(self.bits),
+            "  " * depth + name, self.type.__name__)] + self.inner_lines(offset, depth + 1)
+
+    def inner_lines(self, offset, depth=0):
+        lines = []
+        for name, field_offset, layout in self.fields:
+            if not isinstance(name, str) or name.startswith("__unnamed_field"):
+                name = "_"
+            lines += layout.lines(name, add_bits(offset, field_offset), depth)
+        if self.element and self.element.fields:
+            lines += self.element.lines("[0]", offset, depth)
+        return lines
+
+    def __str__(self):
+        lines = [("offset", "size", "field", "type")] + self.inner_lines(0)
+        widths = [max(len(line[i]) for line in lines) for i in range(3)]
+        return "\n".join(f"{offset:>{widths[0]}}  {size:>{widths[1]}}  {name:<{widths[2]}}  {type_}".rstrip()
+            for offset, size, name, type_ in lines)
+
 class Struct(dict, DatamijnObject):
     _lenient = False
-    _rich = True
+    _layout = None
+    _bit_runs = None
     
     @classmethod
     def resolve(self, ctx=None, path=None, stdlib=None):
@@ -626,10 +1699,11 @@ class Struct(dict, DatamijnObject):
         self._contents = {}
         field_counter = 0
         
+        fields = self._fields
         if stdlib:
-            self._fields.insert(0, (None, stdlib))
+            fields = [(None, stdlib)] + fields
         
-        for name, field in self._fields:
+        for name, field in fields:
             if name == None and isinstance(field, type) and issubclass(field, DatamijnObject) and not issubclass(field, Yield):
                 type_ = field
                 name = field.__name__
@@ -665,36 +1739,89 @@ class Struct(dict, DatamijnObject):
             self._return = self._return.resolve(ctx, path + ["_return"])
             self._final_type = self._return.infer_type()
         
+        self._layout = FixedLayout.of(self)
+        self._bit_runs = BitRun.of(self)
+        
         ctx.pop()
         
         return self
     
-    #@classmethod
-    #def size(self):
-    #    size = 0
-    #    for name, type_ in self._contents:
-    #        size += type_.size() or None
-    #    
-    #    return size
+    @classmethod
+    def size(self):
+        bits = self.bit_size()
+        return None if bits is None else (bits + 7) >> 3
     
     @classmethod
-    def parse_stream(self, stream, ctx=None, path=None, index=None, lenient=False, **kwargs):
-        if not ctx: ctx = []
-        if not path: path = []
+    def _bit_size(self):
+        # !save and !debug fields aren't types and read nothing.
+        sizes = [type_.bit_size() for type_ in self._contents.values() if isinstance(type_, type)]
+        if self._return:
+            sizes.append(self._return.bit_size())
+        return add_bits(*sizes)
+    
+    @classmethod
+    def lazy_offsets(self):
+        """ The byte offset of each field, None for those that aren't always
+        at the same one, or None altogether if the struct can't be parsed
+        lazily. """
+        if "_offsets" not in self.__dict__:
+            self._offsets = None
+            if not self._return and not has_effects(self) \
+              and all(isinstance(name, str) for name in self._contents):
+                offsets = {}
+                offset = 0
+                for name, type_ in self._contents.items():
+                    offsets[name] = None if offset is None or offset & 7 else offset >> 3
+                    offset = add_bits(offset, type_.bit_size())
+                self._offsets = offsets
+        return self._offsets
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        stream = state.stream
+        ctx = state.ctx
+        path = state.path
         
         #rich = ctx[0]._rich if len(ctx) else self._rich
         #if rich:
         start_address = stream.tell()
         
+        if self._layout:
+            data = stream.read_fixed(self._layout.size)
+            if data != None:
+                values = self._layout.unpacker.unpack_from(data)
+                return self._layout.build(data, 0, values, start_address, ctx, path, stream._provenance)
+        
+        if stream._lazy and not (state.lenient or state.pipebuffer or state.pipestream) \
+          and self.lazy_offsets() is not None:
+            obj = LazyStruct.parse(self, state, index)
+            if obj is not None:
+                return obj
+        
         error = False
         size = 0
         obj = self()
         ctx.append(obj)
         obj._ctx = ctx
+        runs = self._bit_runs
+        skip = 0
         for name, type_ in self._contents.items():
+            if skip:
+                skip -= 1
+                continue
             address = stream.tell()
-            result = type_.parse_stream(stream, ctx, path + [name], index=index, lenient=lenient, **kwargs)
-            if lenient and hasattr(result, '_error') and result._error:
+            if runs and name in runs:
+                results = runs[name].read(stream, path)
+                if results != None:
+                    for run_name, result in zip(runs[name].names, results):
+                        dict.__setitem__(obj, run_name, result)
+                    if not self._return:
+                        size += stream.tell() - address
+                    skip = len(results) - 1
+                    continue
+            state.path = ParsePath(path, name)
+            result = type_.parse_stream(state, index=index)
+            if state.lenient and hasattr(result, '_error') and result._error:
                 error = True
             
             if not self._return:
@@ -711,16 +1838,20 @@ class Struct(dict, DatamijnObject):
             #    obj.update(result)
         
         if self._return:
-            value = self._return.parse_stream(stream, ctx, path + ["_return"], index=index, lenient=lenient, **kwargs)
+            state.path = ParsePath(path, "_return")
+            value = self._return.parse_stream(state, index=index)
+            state.path = path
             ctx.pop()
             return value
         else:
+            state.path = path
             ctx.pop()
 
-            obj._address = start_address
-            obj._size = size
-            #obj._size_extra = size_extra
-            obj._path = path
+            if stream._provenance:
+                obj._address = start_address
+                obj._size = size
+                #obj._size_extra = size_extra
+                obj._path = path
             obj._error = error
             return obj
     
@@ -742,7 +1873,7 @@ class Struct(dict, DatamijnObject):
                 if is_list:
                     if not isinstance(self[key_name], list):
                         raise TypeError(f"Attempting foreign list assignment to a non-list `{key_name}`")
-                    elif not isinstance(value, list):
+                    elif not isinstance(value, (list, NumericArray)):
                         raise TypeError(f"Attempting foreign list assignment to `{key_name}` with a non-list")
                     elif len(self[key_name]) != len(value):
                         raise TypeError(f"Attempting foreign list assignment to `{key_name}` with a list of a different length")
@@ -792,11 +1923,11 @@ class Struct(dict, DatamijnObject):
         
         return type(self)(newdict)
     
-    def _save(self, ctx, path):
+    def _save(self, output_dir, path):
         for key, value in self.items():
             if key.startswith("_"):
                 continue
-            value._save(ctx, path + [key])
+            value._save(output_dir, path + [key])
     
     def _is_empty(self):
         for key in self:
@@ -838,6 +1969,10 @@ class Struct(dict, DatamijnObject):
             for key, value in self.items()
             if not key.startswith("_")
         }
+    
+    def _plain(self):
+        return {key: plain(value) for key, value in self.items()
+            if not key.startswith("_")}
 
 class LenientStruct(Struct):
     """
@@ -848,6 +1983,134 @@ class LenientStruct(Struct):
     # which is something else.
     _lenient = True
 
+class LazyStruct(Struct):
+    """ A struct whose fields are parsed as they're first accessed, with the
+    state the struct was parsed in.  Fields at a static offset are parsed
+    right where they are.  The others are found by going through the fields
+    before them in order, skipping those of a static size and parsing the
+    rest.  Fields that are looked up while parsing another are parsed then.
+    Anything that goes through all of them (items(), _json(), ==) parses
+    them all. """
+    _state = None
+    
+    @classmethod
+    def parse(self, struct, state, index):
+        """ Makes a lazy result of the resolved `struct`, or returns None if
+        the stream doesn't have all of its data at hand.  Only the root of a
+        result, with nothing after it, may take up a size that depends on
+        the data. """
+        stream = state.stream
+        view = stream.view()
+        if view is None:
+            return None
+        bits = struct.bit_size()
+        end = None
+        if bits is not None and not bits & 7:
+            end = view[1] + (bits >> 3)
+            if end > len(view[0]):
+                return None
+        elif state.ctx:
+            return None
+        if "_lazy_type" not in struct.__dict__:
+            struct._lazy_type = type(struct.__name__, (self, struct), {"_names": tuple(struct._contents)})
+        obj = struct._lazy_type(dict.fromkeys(struct._contents, UNPARSED))
+        obj._state = state.copy(ctx=state.ctx + [obj])
+        obj._ctx = obj._state.ctx
+        obj._index = index
+        obj._base = view[1]
+        obj._end = end
+        # Where the fields that have been skipped start and where the ones
+        # that have been parsed end, and how far the fields have been gone
+        # through in order.
+        obj._starts = {}
+        obj._ends = {}
+        obj._next = 0
+        obj._position = stream.position()
+        if end is not None:
+            stream.jump(end)
+        if stream._provenance:
+            obj._address = obj._base
+            obj._path = state.path
+        obj._error = False
+        return obj
+    
+    def _seek_field(self, name):
+        """ Goes to where `name` starts, or with None, to the end. """
+        stream = self._state.stream
+        offset = self._offsets.get(name)
+        if offset is not None:
+            stream.jump(self._base + offset)
+            return
+        if name in self._starts:
+            stream.jump(self._starts[name])
+            return
+        stream.restore(self._position)
+        names = self._names
+        while self._next < len(names):
+            field = names[self._next]
+            if field == name:
+                return
+            if dict.__getitem__(self, field) is not UNPARSED:
+                stream.restore(self._ends[field])
+            else:
+                bits = self._contents[field].bit_size()
+                if bits is not None and not bits & 7 and stream.view() is not None:
+                    self._starts[field] = stream.tell()
+                    stream.jump(self._starts[field] + (bits >> 3))
+                else:
+                    self._parse(field)
+            self._next += 1
+            self._position = stream.position()
+    
+    def _parse(self, name):
+        state = self._state
+        result = self._contents[name].parse_stream(state.copy(path=ParsePath(state.path, name)),
+            index=self._index)
+        dict.__setitem__(self, name, result)
+        self._ends[name] = state.stream.position()
+        return result
+    
+    def _field(self, name):
+        stream = self._state.stream
+        position = stream.position()
+        self._seek_field(name)
+        result = self._parse(name)
+        stream.restore(position)
+        return result
+    
+    def _materialize(self):
+        for name in self._names:
+            self[name]
+    
+    @property
+    def _size(self):
+        if self._end is None:
+            stream = self._state.stream
+            position = stream.position()
+            self._seek_field(None)
+            self._end = stream.tell()
+            stream.restore(position)
+        return self._end - self._base
+    
+    def __getitem__(self, key):
+        item = dict.__getitem__(self, key)
+        if item is UNPARSED:
+            item = self._field(key)
+        return item
+    
+    def __iter__(self):
+        # Not dict's own, so that dict() and ** go through __getitem__ too.
+        return dict.__iter__(self)
+    
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+# What sees the fields without __getitem__.
+for name in ("__eq__", "__ne__", "items", "values",
+  "copy", "pop", "popitem", "setdefault"):
+    setattr(LazyStruct, name, _materializing(getattr(dict, name)))
+del name
+
 class Name(DatamijnObject):
     _namestring = "{self._name}"
     _subs = Subs("type")
@@ -888,8 +2151,12 @@ class Function(DatamijnObject):
         return newtype
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        raise ParseError(path, f"Attempted to parse using a function {self.__name__}.  Functions must be called.")
+    def _bit_size(self):
+        return None
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        raise ParseError(state.path, f"Attempted to parse using a function {self.__name__}.  Functions must be called.")
         
 
 class Call(DatamijnObject):
@@ -907,6 +2174,7 @@ class Call(DatamijnObject):
             raise ResolveError(path, f"Attempting to call non-function {full_type_name(self._func)}")
         
         self._resolved_arguments = arguments
+        self._argument_ctx = dict(zip(self._func._arguments, arguments))
         self._expr = self._func.call(ctx, path, arguments)
         argstring = ", ".join(a.__name__ for a in self._arguments)
         self.__name__ = f"{self._func.__name__}({argstring})"
@@ -914,15 +2182,24 @@ class Call(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        ctx.append(dict(zip(self._func._arguments, self._resolved_arguments)))
-        result = self._expr.parse_stream(stream, ctx, path + ["()"], index=index)
-        ctx.pop()
+    def _bit_size(self):
+        return self._expr.bit_size()
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        path = state.path
+        state.ctx.append(self._argument_ctx)
+        state.path = ParsePath(path, "()")
+        result = self._expr.parse_stream(state, index=index)
+        state.path = path
+        state.ctx.pop()
         return result
 
 class ExprName(DatamijnObject):
     _namestring = "{self._name}"
     #_name
+    _scope = None
+    _depth = None
     
     @classmethod
     def resolve(self, ctx, path):
@@ -935,19 +2212,29 @@ class ExprName(DatamijnObject):
                     if self._name in context._types:
                         return context._types[self._name]
             
+            from datamijn.parsing import builtin_types
+            from datamijn.extensions import load_entry_point
+            type_ = builtin_types.get(self._name) or load_entry_point(self._name)
+            if type_ is not None:
+                return type_.resolve(ctx, path)
+            
             raise ResolveError(path, f"Cannot resolve type {self._name}")
         else:
             # This is a reference!
             final_type = None
+            # The struct the name is a field of, if it is one, and how many
+            # scopes up it is.
+            scope = depth = None
             if self._name in self._arguments:
                 final_type = DatamijnObject # XXX
-            for context in reversed(ctx):
+            for i, context in enumerate(reversed(ctx)):
                 if isinstance(context, dict):
                     if self._name in context:
                         final_type = context[self._name]
                 else:
                     if self._name in context._contents:
                         final_type = context._contents[self._name]
+                        scope, depth = context, i
                     elif self._name in context._arguments:
                         final_type = DatamijnObject # XXX
                 if final_type:
@@ -961,17 +2248,30 @@ class ExprName(DatamijnObject):
             
             final_type_inferred = final_type.infer_type()
             
-            newtype = ExprName.make(None, [], _name=self._name, _final_type=final_type_inferred)
+            newtype = ExprName.make(None, [], _name=self._name, _final_type=final_type_inferred, _scope=scope, _depth=depth)
             
             return newtype
+    
+    @classmethod
+    def _bit_size(self):
+        return 0
 
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def parse_stream(self, state, index=None):
+        ctx = state.ctx
+        if self._scope and self._depth < len(ctx):
+            context = ctx[-1 - self._depth]
+            # Lazy results are of a subclass of their struct.
+            if isinstance(context, self._scope) and self._name in context:
+                return context[self._name]
+        # Names that aren't fields (match defaults), or whose struct is
+        # parsed at another depth than it was resolved at (a type used in
+        # another struct), are looked up through the context.
         for context in reversed(ctx):
             if self._name in context:
                 return context[self._name]
         
-        raise ParseError(path, f"Cannot resolve name {self._name}")
+        raise ParseError(state.path, f"Cannot resolve name {self._name}")
 
 class NestedExprName(ExprName):
     @classmethod
@@ -979,9 +2279,13 @@ class NestedExprName(ExprName):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _bit_size(self):
+        return self._replacement.bit_size()
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
         newtype = self._replacement
-        return newtype.parse_stream(stream, ctx, path, index=index, **kwargs)
+        return newtype.parse_stream(state, index=index)
 
 class ExprInt(DatamijnInt):
     _root_name = "ExprInt"
@@ -991,7 +2295,11 @@ class ExprInt(DatamijnInt):
     #_int
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _bit_size(self):
+        return 0
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
         return DatamijnInt(self._int)
 
 
@@ -1005,9 +2313,13 @@ class ExprString(DatamijnObject):
     _final = True
     _final_type = str
     #_string
+    
+    @classmethod
+    def _bit_size(self):
+        return 0
 
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def parse_stream(self, state, index=None):
         return DatamijnString(self._string)
 
 class ExprOp(DatamijnObject):
@@ -1053,9 +2365,16 @@ class ExprOp(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        left = self._left.parse_stream(stream, ctx, path, index=index, **kwargs)
-        right = self._right.parse_stream(stream, ctx, path, index=index, **kwargs)
+    def _bit_size(self):
+        # Operands can be types, e.g. `Byte * 3`.
+        return add_bits(self._left.bit_size(), self._right.bit_size())
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        left = self._left.parse_stream(state, index=index)
+        right = self._right.parse_stream(state, index=index)
+        if state.stream._provenance < PROVENANCE_FULL:
+            return untraced(self._op, left, right)
         return self._op(left, right)
 
 class ExprAttr(DatamijnObject):
@@ -1073,8 +2392,12 @@ class ExprAttr(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        left = self._left.parse_stream(stream, ctx, path, index=index, **kwargs)
+    def _bit_size(self):
+        return self._left.bit_size()
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        left = self._left.parse_stream(state, index=index)
         return left[self._name]
 
 class ExprIndex(DatamijnObject):
@@ -1094,9 +2417,13 @@ class ExprIndex(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        left = self._left.parse_stream(stream, ctx, path, index=index, **kwargs)
-        index = self._index.parse_stream(stream, ctx, path, index=index, **kwargs)
+    def _bit_size(self):
+        return add_bits(self._left.bit_size(), self._index.bit_size())
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        left = self._left.parse_stream(state, index=index)
+        index = self._index.parse_stream(state, index=index)
         return left[index]
 
 class Return(DatamijnObject):
@@ -1111,32 +2438,49 @@ class Return(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        return self._expr.parse_stream(stream, ctx, path, index=index, **kwargs)
+    def _bit_size(self):
+        return self._expr.bit_size()
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        return self._expr.parse_stream(state, index=index)
 
 class Index(DatamijnInt):
     _root_name = "Index"
     _final_type = DatamijnInt
     
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _bit_size(self):
+        return 0
+    
+    @classmethod
+    def _parse_stream(self, state, index=None):
         return index
 
 class Position(DatamijnInt):
     _final_type = DatamijnInt
     
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        return stream.tell()
+    def _bit_size(self):
+        return 0
+    
+    @classmethod
+    def _parse_stream(self, state, index=None):
+        return state.stream.tell()
 
 class RightSize(DatamijnObject):
+    """ The size of the right side of the pipe being parsed.  In a pipe
+    within another pipe's right side, that's the inner pipe's, not the
+    outer one's. """
     _final_type = int
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        for x in ctx:
-            if '_right_size' in x:
-                return x['_right_size']
+    def _bit_size(self):
+        return 0
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        return state.right_size
 
 class Pointer(DatamijnObject):
     _namestring = "@{self._subs.addr.__name__} {self._subs.type.__name__}"
@@ -1158,32 +2502,26 @@ class Pointer(DatamijnObject):
         return newtype
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, **kwargs):
-        rich = ctx[0]._rich
-        if rich:
-            address = stream.tell()
-            try:
-                length = self._addr.size()
-            except NotImplementedError:
-                length = None
-    
-        address = self._addr.parse_stream(stream, ctx, path + ['(addr)'], **kwargs)
-        # XXX handle the bit stuff elsewhere?
-        pos = stream.tell()
-        pos_bit = stream._bit_number
-        stream_byte = stream._byte
-        stream.seek(address)
-        stream._bit_number = 0
-        stream._byte = None
-        result = self._type.parse_stream(stream, ctx, path, **kwargs)
-        stream.seek(pos)
-        stream._bit_number = pos_bit
-        stream._byte = stream_byte
+    def _bit_size(self):
+        # What's pointed to is read elsewhere.
+        return self._addr.bit_size()
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        stream = state.stream
+        path = state.path
+        state.path = ParsePath(path, '(addr)')
+        address = self._addr.parse_stream(state, index=index)
+        state.path = path
+        position = stream.position()
+        stream.jump(address)
+        result = self._type.parse_stream(state, index=index)
+        stream.restore(position)
         
         #obj = self.__new__(self, result)
         #obj.__init__(result)
         obj = result
-        if rich:
+        if stream._provenance:
             if hasattr(result, '_address'):
                 obj._path = result._path
                 obj._address = result._address
@@ -1194,16 +2532,40 @@ class Pointer(DatamijnObject):
 
 class PipePointer(Pointer):
     _namestring = "|@({self._addr.__name__})({self._type.__name__})"
-    
+    _copies = False
+
+    @classmethod
+    def resolve(self, ctx, path):
+        newtype = super().resolve(ctx, path)
+        type_ = newtype._type
+        # `|@-distance [length]Byte` copies in bulk, even where the bytes
+        # it reads are the ones it gives.
+        newtype._copies = issubclass(type_, ByteString) and type_._parsetype == Byte \
+            and type_._length is not None
+        return newtype
+
     @classmethod
-    def parse_stream(self, stream, ctx, path, pipebuffer=None, **kwargs):
-        address = self._addr.parse_stream(stream, ctx, path + ['(addr)'], **kwargs)
+    def parse_stream(self, state, index=None):
+        path = state.path
+        state.path = ParsePath(path, '(addr)')
+        address = self._addr.parse_stream(state, index=index)
+        state.path = path
+        pipebuffer = state.pipebuffer
         pos = pipebuffer.tell()
         if address < 0:
             pipebuffer.seek(address, 2)
         else:
             pipebuffer.seek(address)
-        result = self._type.parse_stream(pipebuffer, ctx, path, pipebuffer=None, **kwargs)
+        substate = state.copy(stream=pipebuffer, pipebuffer=None)
+        if self._copies:
+            type_ = self._type
+            if type_._final_length:
+                length = type_._length
+            else:
+                length = type_._length.parse_stream(substate)
+            result = pipebuffer.copy(pipebuffer.tell(), length, strict=state.strict_read)
+        else:
+            result = self._type.parse_stream(substate, index=index)
         pipebuffer.seek(pos)
         return result
 
@@ -1217,13 +2579,20 @@ class Yield(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, pipestream=None, **kwargs):
+    def _bit_size(self):
+        return self._type.bit_size()
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
         # TODO check this in resolve already
+        pipestream = state.pipestream
         if not pipestream:
-            raise Exception(f'Cannot yield outside of a pipe.\nPath: {".".join(str(x) for x in path)}')
-        data = self._type.parse_stream(stream, ctx, path, **kwargs)
+            raise Exception(f'Cannot yield outside of a pipe.\nPath: {".".join(str(x) for x in state.path)}')
+        state.pipestream = None
+        data = self._type.parse_stream(state)
+        state.pipestream = pipestream
         if not isinstance(data, bytes):
-            raise TypeError(f'Only bytes may be yielded through a pipe (not {type(data).__name__}).\nPath: {".".join(str(x) for x in path)}')
+            raise TypeError(f'Only bytes may be yielded through a pipe (not {type(data).__name__}).\nPath: {".".join(str(x) for x in state.path)}')
         pipestream.append(data)
         return None
 
@@ -1248,6 +2617,9 @@ class MatchTypeMetaclass(type):
         else:
             raise AttributeError()
 
+# Matches whose keys are all ints below this are dispatched through a table.
+MATCH_TABLE_SIZE = 4096
+
 class MatchType(DatamijnObject, metaclass=MatchTypeMetaclass):
     _subs = Subs('type')
     _concat_result = False
@@ -1265,6 +2637,8 @@ class MatchType(DatamijnObject, metaclass=MatchTypeMetaclass):
             inferred_type = value.resolve(ctx, path + [key])
             if not issubclass(value, Terminator):
                 types.append(inferred_type)
+            if isinstance(key, str):
+                ctx.pop()
         
         if len(types) == 1:
             result_base = types[0]
@@ -1317,6 +2691,7 @@ class MatchType(DatamijnObject, metaclass=MatchTypeMetaclass):
                 self._ranges[key] = value
             elif isinstance(key, DefaultKey):
                 self._default_key = key
+        self._compile_dispatch()
         
         self._match_types = {v.__name__: v for k, v in self._match.items()
             if isinstance(v, type) and issubclass(v, DatamijnObject)}
@@ -1324,8 +2699,67 @@ class MatchType(DatamijnObject, metaclass=MatchTypeMetaclass):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        value = self._type.parse_stream(stream, ctx, path, index=index, **kwargs)
+    def _compile_dispatch(self):
+        """ Compiles the keys into `_branches`, a dict of the exact keys, and
+        an index of the ranges to bisect, with the first range given winning
+        where they overlap.  If all the keys are small ints, they all go into
+        `_table` instead, a list indexed by the key.  Each branch is a
+        (type, path name) pair; keys which aren't in any give None. """
+        self._branches = {key: (value, f"[{key}]") for key, value in self._match.items()
+            if not isinstance(key, (KeyRange, DefaultKey))}
+        
+        bounds = sorted({bound for range_ in self._ranges for bound in (range_.from_, range_.to)})
+        self._range_starts = []
+        self._range_ends = []
+        self._range_branches = []
+        for start, end in zip(bounds, bounds[1:]):
+            for range_, value in self._ranges.items():
+                if range_.from_ <= start and end <= range_.to:
+                    self._range_starts.append(start)
+                    self._range_ends.append(end)
+                    self._range_branches.append((value, f"[{range_}]"))
+                    break
+        
+        self._table = None
+        # Ranges end before their `to`, keys take up their own slot.
+        ends = [key + 1 for key in self._branches if isinstance(key, int)] + bounds
+        if ends and len(ends) == len(self._branches) + len(bounds) \
+          and all(isinstance(end, int) and end > 0 for end in ends) \
+          and min(bounds, default=0) >= 0 and max(ends) <= MATCH_TABLE_SIZE:
+            table = [None] * max(ends)
+            for start, end, branch in zip(self._range_starts, self._range_ends, self._range_branches):
+                table[start:end] = [branch] * (end - start)
+            for key, branch in self._branches.items():
+                table[key] = branch
+            self._table = table
+        
+        self._default_ctx = {}
+        if self._default_key != None:
+            self._default_branch = self._match[self._default_key]
+    
+    @classmethod
+    def _bit_size(self):
+        # Fixed if every branch reads as much.
+        sizes = {value.bit_size() for value in self._match.values()}
+        if len(sizes) != 1:
+            return None
+        return add_bits(self._type.bit_size(), *sizes)
+    
+    @classmethod
+    def _branch(self, key_value):
+        table = self._table
+        if table is not None and type(key_value) is int and 0 <= key_value < len(table):
+            return table[key_value]
+        branch = self._branches.get(key_value)
+        if branch is None and self._range_starts:
+            i = bisect.bisect_right(self._range_starts, key_value) - 1
+            if i >= 0 and key_value < self._range_ends[i]:
+                branch = self._range_branches[i]
+        return branch
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        value = self._type.parse_stream(state, index=index)
         
         key_value = value
         if isinstance(value, Byte):
@@ -1333,26 +2767,27 @@ class MatchType(DatamijnObject, metaclass=MatchTypeMetaclass):
         elif isinstance(value, int):
             key_value = int(key_value)
         
-        if key_value in self._match:
-            obj = self._match[key_value].parse_stream(stream, ctx, path + [f"[{key_value}]"], **kwargs)
+        path = state.path
+        branch = self._branch(key_value)
+        if branch is not None:
+            state.path = ParsePath(path, branch[1])
+            obj = branch[0].parse_stream(state)
+            state.path = path
             #if isinstance(obj, DatamijnObject):
             if obj != None:
                 obj._match_value = value
             return obj
         else:
-            for range, rangeval in self._ranges.items():
-                if range.from_ <= key_value < range.to:
-                    obj = rangeval.parse_stream(stream, ctx, path + [f"[{range}]"], **kwargs)
-                    if obj != None:
-                        obj._match_value = value
-                    return obj
-            
             if self._default_key != None:
-                ctx_extra = {}
+                ctx_extra = self._default_ctx
                 if self._default_key:
                     ctx_extra = {str(self._default_key): value}
                 # XXX this makes sense e.g. for pokered.type_effectiveness
-                obj = self._match[self._default_key].parse_stream(stream, ctx + [ctx_extra], path + [f"[_]"], **kwargs)
+                state.ctx.append(ctx_extra)
+                state.path = ParsePath(path, "[_]")
+                obj = self._default_branch.parse_stream(state)
+                state.path = path
+                state.ctx.pop()
                 # FIXME
                 #if obj != None and obj._size != None and value._size != None:
                 #    obj._address = value._address
@@ -1366,15 +2801,57 @@ class MatchType(DatamijnObject, metaclass=MatchTypeMetaclass):
 
 class CharMatchType(MatchType):
     _concat_result = True
+    
+    @classmethod
+    def resolve(self, ctx, path):
+        super().resolve(ctx, path)
+        self._compile_translation()
+        return self
+    
+    @classmethod
+    def _compile_translation(self):
+        """ For byte keys, compiles the constant strings the bytes decode to
+        into `_translation`, a table for str.translate.  The bytes matching
+        anything else, like a Terminator, are `_stop_bytes`; arrays parse
+        those one at a time. """
+        self._translation = None
+        self._stop_bytes = None
+        if self._type not in (U8, Byte):
+            return
+        
+        def constant(type_):
+            if isinstance(type_, type) and issubclass(type_, ExprString):
+                return type_._string
+            return None
+        
+        default = None
+        if self._default_key != None:
+            default = constant(self._default_branch)
+        
+        translation = [default] * 256
+        for byte in range(256):
+            branch = self._branch(byte)
+            if branch is not None:
+                translation[byte] = constant(branch[0])
+        stops = [byte for byte in range(256) if translation[byte] is None]
+        if len(stops) == 256:
+            return
+        
+        self._translation = translation
+        if stops:
+            self._stop_bytes = re.compile(b"[" + b"".join(re.escape(bytes([byte])) for byte in stops) + b"]")
 
 class PipeStream(IOWithBits):
-    def __init__(self, stream, ctx, type_, path):
-        self._path = path
-        self._stream = stream
-        self._ctx = ctx
+    def __init__(self, state, type_):
+        self._path = state.path
         self._type = type_
         
-        self._buffer = BytesIOWithBits(b"")
+        self._pipe_window = state.stream._pipe_window
+        self._buffer = PipeBuffer(self._pipe_window)
+        self._provenance = self._buffer._provenance = state.stream._provenance
+        self._buffer._pipe_window = self._pipe_window
+        self._state = state.copy(path=ParsePath(state.path, "<PipeStream>"),
+            lenient=False, strict_read=False, pipebuffer=self._buffer, pipestream=self)
         
         self._byte = None
         self._bit_number = None
@@ -1388,10 +2865,11 @@ class PipeStream(IOWithBits):
             else:
                 raise TypeError(f"Attempting to pipe {full_type_name(type_.infer_type())}")
     
-    def read(self, num):
-        self._buffer.seek(0, 2) # SEEK_END
+    def read(self, num, strict=True):
+        # The left side is parsed until there's enough, so `strict` makes no
+        # difference.
         while self._free_bytes < num:
-            result = self._type.parse_stream(self._stream, self._ctx, self._path + ["<PipeStream>"], pipebuffer=self._buffer, pipestream=self, strict_read=False) # XXX
+            result = self._type.parse_stream(self._state) # XXX
             if result != None and not (isinstance(result, Struct) and result._is_empty()):
                 if not isinstance(result, bytes):
                     print(repr(result))
@@ -1399,26 +2877,28 @@ class PipeStream(IOWithBits):
                     if isinstance(result, Struct):
                         errormsg += "\nHint: if you're yielding data, prefix your keys with _."
                     raise TypeError(errormsg)
-                self._free_bytes += len(result)
-                self._buffer.write(result)
+                self.append(result)
         
-        self._buffer.seek(self._pos)
-        val = self._buffer.read(num)
+        val = self._buffer.take(self._pos, num)
         assert(len(val) == num)
         self._pos += num
         self._free_bytes -= num
+        self._buffer.release(self._pos)
         
         return val
     
+    def _read(self, amount, strict=True):
+        return self.read(amount)
+    
     def tell(self):
         return self._pos
     
+    def read_fixed(self, amount):
+        return None
+    
     def append(self, data):
-        pos = self._buffer.tell()
-        self._buffer.seek(0, 2)
         self._free_bytes += len(data)
-        self._buffer.write(data)
-        self._buffer.seek(pos)
+        self._buffer.append(data)
     
     @property
     def empty(self):
@@ -1434,9 +2914,10 @@ class Pipe(DatamijnObject):
     def resolve(self, ctx, path):
         self._left_type = self._subs.left.resolve(ctx, path + ["(left)"])
         self._right_type = self._subs.right.resolve(ctx, path + ["(right)"])
+        # dir() rather than hasattr(), which also sees type.__or__ on 3.10+
         if not self._left_type._yields \
           and not issubclass(self._left_type.infer_type(), ByteString) \
-          and hasattr(self._left_type.infer_type(), "__or__"):
+          and "__or__" in dir(self._left_type.infer_type()):
           #and not (issubclass(self._right_type, PipedDatamijnObject) \
           #  and not issubclass(self._right_type, Pipe)):
             expr = ExprOp.make(f"({self._left_type.__name__}|{self._right_type.__name__})",
@@ -1445,17 +2926,69 @@ class Pipe(DatamijnObject):
         
         self._yields = self._left_type._yields or self._right_type._yields
         self._final_type = self._right_type.infer_type()
+        left = self._left_type
+        self._view_left = issubclass(left, ByteString) and left._parsetype == Byte \
+            and left._length is not None
         
         #self.__name__ = f"({self._left_type.__name__})|({self._right_type.__name__})"
         
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _bit_size(self):
+        left = self._left_type
+        left_bits = left.bit_size()
+        right_bits = self._right_type.bit_size()
+        if right_bits is None or not left_bits or left_bits & 7 \
+          or not issubclass(left.infer_type(), bytes) or left._yields:
+            return None
+        if self._view_left and right_bits <= left_bits:
+            return left_bits
+        # A PipeStream parses the left side for as many bytes as the right
+        # side reads.
+        needed = (right_bits + 7) >> 3
+        left_size = left_bits >> 3
+        return -(-needed // left_size) * left_bits
+    
+    @classmethod
+    def _parse_view(self, state, right_size):
+        """ Parses the right side straight from the input the left side's
+        `[length]Byte` covers, without copying it.  Pos counts from the start
+        of those bytes and RightSize, unless the right side's size is known,
+        is their length.  NotImplemented if the right side needs a PipeStream:
+        reading past the left side's bytes parses it again, so a right side
+        known to be bigger gets one. """
+        stream = state.stream
+        # Unlike input that can be viewed, a PipeStream can't go back either.
+        if stream.view() is None:
+            return NotImplemented
+        position = stream.position()
+        left = self._left_type
+        if left._final_length:
+            length = left._length
+        else:
+            length = left._length.parse_stream(state)
+        view = stream.view()
+        # A pipe's own buffer can't be resized while it's viewed.
+        if view is None or isinstance(view[0], bytearray) or not isinstance(length, int) \
+          or view[1] + length > len(view[0]) or (right_size or 0) > length:
+            stream.restore(position)
+            return NotImplemented
+        data, pos = view
+        substream = BufferStream(memoryview(data)[pos:pos + length])
+        substream._provenance = stream._provenance
+        substream._pipe_window = stream._pipe_window
+        result = self._right_type.parse_stream(state.copy(stream=substream,
+            right_size=length if right_size is None else right_size))
+        stream.jump(stream.tell() + length)
+        return result
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
         if False: #issubclass(self._right_type, PipedDatamijnObject):
             ctx = []
-            left = self._left_type.parse_stream(stream, ctx, path, index=index, **kwargs)
-            result = self._right_type.parse_left(left, ctx, path)
+            left = self._left_type.parse_stream(state, index=index)
+            result = self._right_type.parse_left(left, ctx, state.path)
             return result
         else:
             right_size = None
@@ -1463,13 +2996,16 @@ class Pipe(DatamijnObject):
                 right_size = self._right_type.size()
             except Exception as ex:
                 pass
-            #ctx.append({'_right_size': right_size})
-            ctx.append(Struct({'_right_size': right_size}))
-            pipe_stream = PipeStream(stream, ctx, self._left_type, path=path)
-            result = self._right_type.parse_stream(pipe_stream, ctx, path, **kwargs)
+            if self._view_left:
+                result = self._parse_view(state, right_size)
+                if result is not NotImplemented:
+                    return result
+            state = state.copy(right_size=right_size)
+            pipe_stream = PipeStream(state, self._left_type)
+            state.stream = pipe_stream
+            result = self._right_type.parse_stream(state)
             #if not pipe_stream.empty:
             #    raise ValueError("Unaccounted data remaining in pipe.  TODO this should be suppressable")
-            ctx.pop()
             return result
 
 class Inheritance(DatamijnObject):
@@ -1522,13 +3058,17 @@ class ForeignKey(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        key = self._type.parse_stream(stream, ctx, path, **kwargs)
+    def _bit_size(self):
+        return self._type.bit_size()
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        key = self._type.parse_stream(state)
         
         if key == None:
             return None
         
-        return self(key, ctx[0])
+        return self(key, state.ctx[0])
     
     @property
     def _object(self):
@@ -1609,14 +3149,22 @@ class If(DatamijnObject):
         return self
     
     @classmethod
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        result = self._expr.parse_stream(stream, ctx, path, index=index, **kwargs)
+    def _bit_size(self):
+        true = self._true_struct.bit_size()
+        false = self._false_struct.bit_size() if self._false_struct else 0
+        if true != false:
+            return None
+        return add_bits(self._expr.bit_size(), true)
+    
+    @classmethod
+    def parse_stream(self, state, index=None):
+        result = self._expr.parse_stream(state, index=index)
         
         if result:
-            return self._true_struct.parse_stream(stream, ctx, path, index=index, **kwargs)
+            return self._true_struct.parse_stream(state, index=index)
         else:
             if self._false_struct:
-                return self._false_struct.parse_stream(stream, ctx, path, index=index, **kwargs)
+                return self._false_struct.parse_stream(state, index=index)
             else:
                 return None
 
@@ -1630,12 +3178,13 @@ class SaveField(Field):
     def resolve(self, ctx, path):
         return self
     
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        path = path[:-1] # last element is __unnamed_field
+    def parse_stream(self, state, index=None):
+        path = state.path._parent # last element is __unnamed_field
+        ctx = state.ctx
         foreign = ctx[-1][self._field_name]
         if not hasattr(foreign, "_save"):
             raise ParseError(path, f"field {self._field_name} (type {full_type_name(type(foreign))}) has no attribute _save (INTERNAL)")
-        foreign._save(ctx, path + [self._field_name])
+        foreign._save(state.output_dir, path + [self._field_name])
 
 class DebugField(Field):
     _yields = False
@@ -1645,8 +3194,8 @@ class DebugField(Field):
     def resolve(self, ctx, path):
         return self
     
-    def parse_stream(self, stream, ctx, path, index=None, **kwargs):
-        foreign = ctx[-1][self._field_name]
+    def parse_stream(self, state, index=None):
+        foreign = state.ctx[-1][self._field_name]
         print(foreign)
 
 Array.ARRAY_CLASSES.update({
@@ -1654,4 +3203,8 @@ Array.ARRAY_CLASSES.update({
         (str,):             String,
         (ExprString,):      String,
         (ConcatableMatchResult,):   String,
+        (U8,):              NumericArray,
+        (S8,):              NumericArray,
+        (U16,):             NumericArray,
+        (U32,):             NumericArray,
 })
@@ -0,0 +1,158 @@
+""" Primitives and pipe stages written in Python.
+
+    def decode_u24(buffer, offset):
+        return int.from_bytes(buffer[offset:offset + 3], 'little'), 3
+
+    datamijn.register_primitive("U24", decode_u24, size=3)
+
+makes `U24` a type in definitions, like U16.  Installed packages can provide
+them too, as entry points in the `datamijn.primitives` group named after the
+type and pointing at a primitive() or pipe_stage().  Those are only imported
+once a definition uses a name it doesn't otherwise know. """
+from datamijn.dmtypes import DatamijnObject, Array, ListArray
+from datamijn.compression import Decompressor
+from datamijn.utils import UPPERCASE, ParseError, ReadError
+
+ENTRY_POINT_GROUP = "datamijn.primitives"
+
+class Primitive(DatamijnObject):
+    """ A type decoded by a Python function; see primitive(). """
+    _decode = None
+    _batch = None
+    _wrap = False
+
+    @classmethod
+    def resolve(self, ctx, path):
+        return self
+
+    @classmethod
+    def _read(self, stream):
+        view = stream.view()
+        if view is None:
+            if self._size is None:
+                raise ReadError(f"{self.__name__} has no fixed size, so it can only be read from byte-aligned input.")
+            value, consumed = self._decode(stream.read(self._size), 0)
+            return value
+        data, pos = view
+        if self._size is not None and pos + self._size > len(data):
+            raise ReadError(f"Data access out of bounds.\nRead of size {self._size} at position {hex(stream.tell())}.")
+        value, consumed = self._decode(data, pos)
+        if pos + consumed > len(data):
+            raise ReadError(f"Data access out of bounds.\nRead of size {consumed} at position {hex(stream.tell())}.")
+        stream.jump(stream.tell() + consumed)
+        return value
+
+    @classmethod
+    def _parse_stream(self, state, index=None):
+        try:
+            return self._read(state.stream)
+        except Exception as ex:
+            raise ParseError(state.path, f"Failed to decode {self.__name__}: {ex}")
+
+class PrimitiveArray(ListArray):
+    """ An array of a primitive with a batch decoder, which decodes it all at
+    once where it can. """
+    @classmethod
+    def _accepts(self, array):
+        return array._subs.length is not None and array._parsetype._batch is not None
+
+    @classmethod
+    def parse_stream(self, state, index=None):
+        stream = state.stream
+        if self._final_length:
+            length = self._length
+        else:
+            length = self._length.parse_stream(state)
+        view = stream.view()
+        if view is None or not isinstance(length, int):
+            return super().parse_stream(state, index=index)
+        data, pos = view
+        start_address = stream.tell()
+        # Like Array, this always parses at least one element.  Failures are
+        # left to the element by element parse, which reports them properly.
+        try:
+            values, consumed = self._parsetype._batch(data, pos, max(length, 1))
+        except Exception:
+            return super().parse_stream(state, index=index)
+        if pos + consumed > len(data):
+            return super().parse_stream(state, index=index)
+        stream.jump(start_address + consumed)
+        obj = self(values)
+        if stream._provenance:
+            obj._address = start_address
+            obj._size = consumed
+            obj._path = state.path
+        obj._error = False
+        return obj
+
+Array.ARRAY_CLASSES.update({
+    (Primitive,):       PrimitiveArray,
+})
+
+class PipeStage(Decompressor):
+    """ The left side of a pipe, decoded by a Python function; see
+    pipe_stage(). """
+    _decompress = None
+
+    @classmethod
+    def decompress(self, data, pos):
+        out, consumed = self._decompress(data, pos)
+        return out, pos + consumed
+
+def primitive(name, decode, size=None, batch=None):
+    """ Makes a primitive type.  `decode(buffer, offset)` returns the value
+    at `offset` in `buffer` and the number of bytes it took up, which is
+    `size` if every value takes up the same.  `batch(buffer, offset, count)`,
+    if given, does the same for `count` values at once, returning a list of
+    them, for arrays. """
+    if not name or name[0] not in UPPERCASE:
+        raise ValueError(f"Type names must start with a capital letter, not {name!r}")
+    return Primitive.make(name, _decode=staticmethod(decode), _size=size,
+        _batch=None if batch is None else staticmethod(batch))
+
+def pipe_stage(name, decompress):
+    """ Makes a type for the left side of pipes.  `decompress(buffer,
+    offset)` returns the bytes the data at `offset` in `buffer` decode to and
+    the number of bytes the data took up. """
+    if not name or name[0] not in UPPERCASE:
+        raise ValueError(f"Type names must start with a capital letter, not {name!r}")
+    return PipeStage.make(name, _decompress=staticmethod(decompress))
+
+def register(type_, name=None):
+    """ Makes `type_`, from primitive() or pipe_stage(), available to
+    definitions compiled from now on. """
+    from datamijn.parsing import primitive_types
+    name = name or type_.__name__
+    if primitive_types.get(name, type_) is not type_:
+        raise ValueError(f"There already is a primitive type {name}")
+    primitive_types[name] = type_
+    return type_
+
+def register_primitive(name, decode, size=None, batch=None):
+    return register(primitive(name, decode, size, batch))
+
+def register_pipe_stage(name, decompress):
+    return register(pipe_stage(name, decompress))
+
+_entry_points = None
+
+def load_entry_point(name):
+    """ Registers the type called `name` from the entry points, if there is
+    one, and returns it. """
+    global _entry_points
+    if _entry_points is None:
+        from importlib.metadata import entry_points
+        found = entry_points()
+        if hasattr(found, "select"):
+            found = found.select(group=ENTRY_POINT_GROUP)
+        else:
+            found = found.get(ENTRY_POINT_GROUP, [])
+        _entry_points = {entry_point.name: entry_point for entry_point in found}
+
+    entry_point = _entry_points.pop(name, None)
+    if entry_point is None:
+        return None
+    type_ = entry_point.load()
+    if not isinstance(type_, type) or not issubclass(type_, (Primitive, PipeStage)):
+        raise TypeError(f"Entry point {entry_point.value} for {name} is not a primitive() or pipe_stage()")
+    return register(type_, name)
@@ -1,9 +1,6 @@
 import os
-from pathlib import Path
 import array as pyarray
 
-import png
-
 from datamijn.dmtypes import DatamijnObject, Array, ListArray
 from datamijn.utils import bits, JsonType
 
@@ -19,8 +16,7 @@ class Tile(DatamijnObject):
     def __init__(self, tile):
         self.tile = tile
     
-    def _open_with_path(self, ctx, path):
-        output_dir = ctx[0]._output_dir
+    def _open_with_path(self, output_dir, path):
         filepath = "/".join(str(x) for x in path[:-1])
         filename = filepath + f"/{path[-1]}.png"
         full_filepath = output_dir + "/" + filepath
@@ -41,9 +37,9 @@ class PlanarTile(Tile):
     invert = False
     
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _parse_stream(self, state, index=None):
         # assert self.width == 8
-        tile_data = stream.read(self.depth*self.width*self.height//8)
+        tile_data = state.stream.read(self.depth*self.width*self.height//8)
         tile = pyarray.array("B", [0]*8*self.width)
         
         # 76543210
@@ -72,17 +68,18 @@ class PlanarTile(Tile):
             #    line = [x ^ ((1 << self.depth) - 1) for x in line]
         return tile
     
-    def _save(self, ctx, path):
-        self._filename, f = self._open_with_path(ctx, path)
+    def _save(self, output_dir, path):
+        import png
+        self._filename, f = self._open_with_path(output_dir, path)
         w = png.Writer(self.width, self.height, greyscale=True, bitdepth=self.depth)
         w.write_array(f, self.tile)
         f.close()
 
 class PlanarCompositeTile(PlanarTile):
     @classmethod
-    def _parse_stream(self, stream, ctx, path, index=None, **kwargs):
+    def _parse_stream(self, state, index=None):
         #assert self.width == 8
-        tile_data = stream.read(self.depth*self.width*self.height//8)
+        tile_data = state.stream.read(self.depth*self.width*self.height//8)
         tile = pyarray.array("B", [0]*8*self.width)
         i = 0
         for d in range(self.depth):
@@ -93,8 +90,9 @@ class PlanarCompositeTile(PlanarTile):
                     tile[line*self.width + 7-x] |= layer[x] << d
         return tile
     
-    def _save(self, ctx, path):
-        self._filename, f = self._open_with_path(ctx, path)
+    def _save(self, output_dir, path):
+        import png
+        self._filename, f = self._open_with_path(output_dir, path)
         w = png.Writer(self.width, self.height, greyscale=True, bitdepth=self.depth)
         w.write_array(f, self.tile)
         f.close()
@@ -111,13 +109,14 @@ class GBTile(PlanarTile):
 
 
 class Tileset(ListArray):
-    def _save(self, ctx, path):
+    def _save(self, output_dir, path):
+        import png
         palette = getattr(self, "_palette", None)
         if issubclass(self._child_type, Tile):
             # XXX maybe remove this
             for i, elem in enumerate(self):
-                elem._save(ctx, path + [i])
-            '''self._filename, f = self._type._open_with_path(self, ctx, path)
+                elem._save(output_dir, path + [i])
+            '''self._filename, f = self._type._open_with_path(self, output_dir, path)
             width = 8
             height = len(self) * 8
             w = png.Writer(width, height,
@@ -134,7 +133,7 @@ class Tileset(ListArray):
             w.write_array(f, pic)
             f.close()'''
         elif issubclass(self._child_type, Tileset):
-            self._filename, f = self._child_type._child_type._open_with_path(self, ctx, path)
+            self._filename, f = self._child_type._child_type._open_with_path(self, output_dir, path)
             width = self._child_type._child_type.width*len(self[0])
             height = self._child_type._child_type.height*len(self)
             if not palette:
@@ -181,6 +180,9 @@ class Tileset(ListArray):
     
     def _json(self) -> JsonType:
         return {"_type": "tileset", "_class": self.__class__.__name__, "_filename": getattr(self, '_filename', None)}
+    
+    def _plain(self):
+        return self._json()
 
 class Image(Tileset):
     pass
@@ -4,23 +4,14 @@
 # https://docs.python.org/3/library/collections.abc.html#module-collections.abc
 # https://docs.python.org/3/library/numbers.html#module-numbers
 
-import sys
 import os.path
-import math
-import operator
-from io import BytesIO, BufferedIOBase
-from pprint import pprint
 
-from lark import Lark, Transformer
-from lark.tree import Tree
-import oyaml as yaml
-import png
-
-    
 from datamijn.dmtypes import *
 from datamijn.gfx import Tile, Tile1BPP, NESTile, GBTile, Tileset, Image, \
     Palette, RGBColor
-from datamijn.utils import parse_symfile
+from datamijn.compression import Zlib, Deflate, Gzip, LZ77, RLE, GSCLZ
+from datamijn.extensions import primitive, pipe_stage, register_primitive, \
+    register_pipe_stage
 
 primitive_types = {
     "B1": B1,
@@ -41,307 +32,81 @@ primitive_types = {
     "Terminator": Terminator,
     "Null": Null,
     "RGBColor": RGBColor,
-    "String": String
+    "String": String,
+}
+
+# Types that are only used when a definition doesn't have its own of the
+# same name, like those from entry points.
+builtin_types = {
+    "Zlib": Zlib,
+    "Deflate": Deflate,
+    "Gzip": Gzip,
+    "LZ77": LZ77,
+    "RLE": RLE,
+    "GSCLZ": GSCLZ,
 }
 
 for i in range(2, 33):
     primitive_types[f"B{i}"] = make_bit_type(i)
+for i in range(1, 33):
+    builtin_types[f"MSB{i}"] = make_bit_type(i, msb=True)
 
-class TreeToStruct(Transformer):
-    def __init__(self, path):
-        self.path = path
-        self.match_last = -1
-    
-    def string(self, token):
-        return token[0][1:-1]
-    
-    def num(self, tree):
-        return eval(tree[0]) # this is safe, trust me
-    
-    def match_key_int(self, tree):
-        return DatamijnInt.__new__(DatamijnInt, tree[0])
-    
-    def match_key_string(self, tree):
-        return str(tree[0])
-    
-    def match_key_default(self, tree):
-        return DefaultKey()
-    
-    def match_key_default_name(self, tree):
-        return DefaultKey(tree[0])
-    
-    def match_key_range(self, tree):
-        return KeyRange(*tree)
-    
-    def match_field(self, tree):
-        if len(tree) == 1:
-            key = self.match_last + 1
-            type_ = tree[0]
-        else:
-            key = tree[0]
-            type_ = tree[1]
-        self.match_last = key
-        return (key, type_)
-    
-    def match(self, tree):
-        self.match_last = -1
-        return dict(tree)
-    
-    def struct(self, tree):
-        fields = []
-        return_ = None
-        
-        if len(tree) and isinstance(tree[-1], type) and issubclass(tree[-1], Return):
-            return_ = tree.pop()
-        
-        for field in tree:
-            if isinstance(field, type) and issubclass(field, Return):
-                raise SyntaxError("Return must be last in struct") # TODO nicer error
-            if isinstance(field, type) and issubclass(field, DatamijnObject):
-                fields.append((None, field))
-            elif isinstance(field, Field):
-                fields.append((None, field))
-            elif type(field) == tuple and len(field) == 2:
-                fields.append(field)
-            else:
-                print(tree)
-                raise RuntimeError(f"Internal error: unknown struct field {field}")
-        
-        return Struct.make(None, _fields=fields, _return=return_)
-    
-    #
-    # expr
-    #
-    
-    def expr(self, tree):
-        return tree[0]
-    
-    def expr_pipe(self, tree):
-        left_type, right_type = tree
-        return Pipe.make(None,
-            left=left_type, right=right_type)
-    
-    def expr_inherit(self, tree):
-        left_type, name = tree
-        
-        # TODO this should be handled in the resolve pass so we can have
-        # nicer error messages?
-        
-        if name in primitive_types:
-            right_type = primitive_types[name]
-        else:
-            raise SyntaxError(f"""Can only inherit from primitive types
-Attempted to inherit {left_type.__name__} from {name}""")
-        
-        return Inheritance.make(None,
-            left=left_type, right=right_type)
-    
-    def expr_attr(self, tree):
-        left, name = tree
-        return ExprAttr.make(None,
-            left=left, _name=name)
-    
-    def expr_index(self, tree):
-        left, index = tree
-        return ExprIndex.make(f"({left.__name__})[{index.__name__}]",
-            left=left, index=index)
-    
-    def expr_infix(self, tree):
-        OPERATIONS = {
-            "+": operator.add,
-            "-": operator.sub,
-            "*": operator.mul,
-            "/": operator.floordiv,
-            "%": operator.mod,
-            "==": operator.eq,
-            "!=": operator.ne,
-        }
-        left, sign, right = tree
-        return ExprOp.make(f"({left.__name__}{sign}{right.__name__})",
-            left=left, right=right, _op=OPERATIONS[sign])
-    
-    def expr_bracket(self, tree):
-        return tree[0]
-    
-    def expr_foreign_key(self, tree):
-        type_, field_name = tree
-        return ForeignKey.make(f"{type_.__name__}ForeignKey",
-            type=type_, _field_name=field_name)
-    
-    def expr_yield(self, tree):
-        type = tree[0]
-        return Yield.make("Yield", _type=type)
-    
-    def expr_match(self, tree):
-        type = tree[0]
-        match = tree[1]
-        return MatchType.make(f"{type.__name__}Match", type=type, _match=match)
-        
-    def expr_char_match(self, tree):
-        type = tree[0]
-        match = tree[1]
-        return CharMatchType.make(f"{type.__name__}Match", type=type, _match=match)
-    
-    def expr_name(self, f):
-        name = str(f[0])
-        if name in primitive_types:
-            return primitive_types[name]
-        else:
-            return ExprName.make(f"{name}", _name=name)
-    
-    def expr_int(self, f):
-        type_ = ExprHex if f[0].startswith("0x") else ExprInt
-        num = eval(f[0])
-        return type_.make(_int=num)
-    
-    def expr_string(self, token):
-        string = token[0]
-        return ExprString.make(string, _string=string)
-    
-    def expr_struct(self, f):
-        return f[0]
-    
-    def expr_count(self, f):
-        count_tree, type_ = f
-        if count_tree.children:
-            count = count_tree.children[0]
-        else:
-            count = None
-        return Array.make(f"[]{type_.__name__}", parsetype=type_, length=count)
-    
-    def expr_ptr(self, f):
-        addr = f[0]
-        type_ = f[1]
-        return Pointer.make(None, addr=addr, type=type_)
-    
-    def expr_pipeptr(self, f):
-        addr = f[0]
-        type_ = f[1]
-        return PipePointer.make(f"|@({addr.__name__})({type_.__name__})", addr=addr, type=type_)
-    
-    def expr_arguments(self, f):
-        return [str(x) for x in f]
-    
-    def expr_funcdef(self, f):
-        name = f[0].value
-        if len(f) == 3:
-            arguments = f[1]
-            type_ = f[2]
-        else:
-            arguments = []
-            type_ = f[1]
-        
-        return Function.make(_name=name, type=type_, _arguments=arguments)
-    
-    def expr_call(self, f):
-        expr = f[0]
-        arguments = f[1:]
-        
-        return Call.make(func=expr, arguments=arguments)
-    
-    def expr_typedef(self, f):
-        name = f[0].value
-        type_ = f[1]
-        
-        return Name.make(_name=name, type=type_)
-    
-    def expr_typedeftoken(self, f):
-        name = f[0].value
-        
-        return Name.make(_name=name, type=Token)
-    
-    #
-    # field
-    #
-    
-    def field_name(self, f):
-        return str(f[0])
-    
-    def field_name_dot(self, f):
-        return (f[0], f[1])
-    
-    def field_name_array(self, f):
-        return (ForeignListAssignment(f[0]), f[1])
-    
-    def field_name_underscore(self, f):
-        return "_"
-    
-    def field_return(self, f):
-        expr = f[0]
-        
-        return Return.make("Return", expr=expr)
-    
-    def field_if(self, f):
-        expr = f[0]
-        true_struct = f[1]
-        false_struct = f[2] if len(f) == 3 else []
-        
-        return (None, If.make("If", _expr=expr, _true_struct=true_struct, _false_struct=false_struct))
-    
-    def field_assert(self, f):
-        cond = f[0][8:]
-        
-        raise NotImplementedError()
-    
-    def field_save(self, f):
-        field_name = f[0]
-        
-        return SaveField(field_name)
-    
-    def field_debug(self, f):
-        field_name = f[0]
-        
-        return DebugField(field_name)
-    
-    def field_yield(self, f):
-        type = f[0]
-        
-        return (None, Yield.make("Yield", _type=type))
-    
-    def field_instance(self, f):
-        name = f[0]
-        type_ = f[1]
-        
-        return (name, type_)
-    
-    def field_typedef(self, f):
-        return f[0]
-    
-    def statement_import(self, token):
-        path = token[0] + ".dm"
-        if self.path:
-            path = self.path + "/" + path
-        
-        return parse_definition(open(path), name=f"!imported_{token[0]}", embed=True)
-    
-    def statement_symfile(self, token):
-        path = token[0] + ".sym"
-        if self.path:
-            path = self.path + "/" + path
-        
-        symbols = parse_symfile(open(path))
-        
-        fields = []
-        
-        for symbol, addr in symbols.items():
-            fields.append((symbol, ExprHex.make(None, _int=addr)))
-        
-        return ("sym", LenientStruct.make(f"SymfileStruct({token[0]})", _fields=fields, _return=[]))
-        
-grammar = open(os.path.dirname(__file__)+"/grammar.g").read()
+grammar_path = os.path.dirname(__file__)+"/grammar.g"
+# LALR tables for grammar.g, generated ahead of time by save_parser_tables()
+# so that nothing is built at import time.
+parser_tables_path = os.path.dirname(__file__)+"/grammar.lalr"
 
-parser = Lark(grammar, parser='lalr')
+def parser_tables_header():
+    import hashlib
+    import lark
+    grammar = open(grammar_path, 'rb').read()
+    return {"grammar": hashlib.sha256(grammar).hexdigest(), "lark": lark.__version__}
 
-def parse_definition(definition, name=None, embed=False, stdlib=None):
-    path = ""
+def build_parser():
+    from lark import Lark
+    return Lark(open(grammar_path).read(), parser='lalr')
+
+def save_parser_tables(path=parser_tables_path):
+    import pickle
+    parser = build_parser()
+    with open(path, 'wb') as f:
+        pickle.dump(parser_tables_header(), f)
+        parser.save(f)
+
+def load_parser_tables(path=parser_tables_path):
+    """ Returns the parser from pregenerated tables, or None if they're
+    missing, unreadable or were generated from another grammar or Lark
+    version. """
+    import pickle
+    from lark import Lark
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != parser_tables_header():
+                return None
+            return Lark.load(f)
+    except Exception:
+        # A truncated or corrupt file fails anywhere in unpickling or in
+        # Lark.load; either way the parser is built from grammar.g instead.
+        return None
+
+_parser = None
+
+def get_parser():
+    global _parser
+    if _parser is None:
+        _parser = load_parser_tables() or build_parser()
+    return _parser
+
+def parse_definition(definition, name=None, embed=False, stdlib=None, path="", files=None):
     if type(definition) != str:
         path = os.path.dirname(definition.name)
         definition = definition.read()
     
     definition += "\n"
     
-    transformer = TreeToStruct(path)
-    struct = transformer.transform(parser.parse(definition))
+    from datamijn.transform import TreeToStruct
+    transformer = TreeToStruct(path, files)
+    struct = transformer.transform(get_parser().parse(definition))
     struct._filepath = path
     
     struct.resolve(stdlib=stdlib)
@@ -352,28 +117,132 @@ def parse_definition(definition, name=None, embed=False, stdlib=None):
     
     return struct
 
-def parse(definition, data, output_dir=None, lenient=False):
-    stdlib = parse_definition(open(os.path.dirname(__file__)+"/stdlib.dm").read(), embed=True)
-    struct = parse_definition(definition, stdlib=stdlib)
-    if output_dir:
-        output_dir = str(output_dir)
-        if not output_dir.endswith("/"):
-            output_dir += "/"
-        struct._output_dir = output_dir
-    else:
-        struct._output_dir = struct._filepath + "/datamijn_out/"
+BACKENDS = ["interpreter", "codegen"]
+RESULT_MODES = ["rich", "plain"]
+
+class Schema():
+    """A resolved definition, ready to parse any number of binaries.
+    
+    All of the Lark, transform and resolve work happens once in `compile`;
+    `parse` only walks the binary."""
+    def __init__(self, struct, backend="interpreter"):
+        self._struct = struct
+        self._backend = backend
+        if backend == "interpreter":
+            parse = struct.parse_stream
+        elif backend == "codegen":
+            from datamijn.codegen import generate
+            parse = generate(struct)
+        else:
+            raise ValueError(f"Unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+        self._parses = {PROVENANCE_FULL: parse}
+    
+    def layout(self):
+        """The `Layout` of the definition: the size and offset of everything
+        in it that doesn't depend on the data."""
+        return Layout.of(self._struct)
+    
+    def _parse_for(self, provenance):
+        # Generated code is specialized for a provenance level; the
+        # interpreter checks the stream's.
+        if provenance not in self._parses:
+            if self._backend == "codegen":
+                from datamijn.codegen import generate
+                self._parses[provenance] = generate(self._struct, provenance)
+            else:
+                self._parses[provenance] = self._parses[PROVENANCE_FULL]
+        return self._parses[provenance]
+    
+    def _parse_stream(self, stream, lenient=False, output_dir=None):
+        if stream._lazy:
+            # Generated code parses everything as it goes.
+            parse = self._struct.parse_stream
+        else:
+            parse = self._parse_for(stream._provenance)
+        if not output_dir:
+            output_dir = self._struct._filepath + "/datamijn_out/"
+        return parse(ParseState(stream, lenient=lenient, output_dir=output_dir))
+    
+    def parse(self, data, output_dir=None, lenient=False, provenance="full", result="rich",
+      pipe_window=None, lazy=False):
+        """Parse `data`: bytes, a buffer, a path or a binary file.
+        
+        `provenance` is one of PROVENANCE_LEVELS.  Below "full", ints don't
+        keep the raw data they were read from, and with "none" nothing keeps
+        its address, size or path either, which saves time and memory.
+        
+        With `result="plain"`, the result is made of bare dicts, lists, ints,
+        strs and bytes, like _json() gives but without the rich objects
+        around.  There's no provenance to keep then, so it parses with
+        "none".
+        
+        Pipes keep all of their output around for back-references (`|@`)
+        unless `pipe_window` limits how many bytes back they may go.
+        
+        With `lazy`, arrays of elements that always take up the same number
+        of bytes, and structs, are only parsed as far as they're used.  Errors
+        in their elements and fields then come up when they're accessed, if
+        ever.  Lazy parsing always uses the interpreter."""
+        if provenance not in PROVENANCE_LEVELS:
+            raise ValueError(f"Unknown provenance level {provenance}, expected one of {', '.join(PROVENANCE_LEVELS)}")
+        if result not in RESULT_MODES:
+            raise ValueError(f"Unknown result mode {result}, expected one of {', '.join(RESULT_MODES)}")
+        if pipe_window is not None and pipe_window < 0:
+            raise ValueError(f"Pipe window must not be negative, got {pipe_window}")
+        level = PROVENANCE_LEVELS.index(provenance)
+        if result == "plain":
+            level = PROVENANCE_NONE
+        if output_dir:
+            output_dir = str(output_dir)
+            if not output_dir.endswith("/"):
+                output_dir += "/"
+        
+        stream = BufferStream.open(data)
+        stream._provenance = level
+        stream._pipe_window = pipe_window
+        stream._lazy = lazy and result != "plain"
+        
+        rich = self._parse_stream(stream, lenient=lenient, output_dir=output_dir)
+        if result == "plain":
+            return plain(rich)
+        
+        rich._structs = self._struct
+        return rich
+
+stdlib_path = os.path.dirname(__file__)+"/stdlib.dm"
+
+def compile(definition, cache=False, backend="interpreter"):
+    """Parse and resolve a definition into a `Schema`.
+    
+    With `cache`, the resolved definition is kept on disk (in `cache` if it's
+    a directory, otherwise under $XDG_CACHE_HOME) and reused for as long as
+    the definition, the files it imports and datamijn itself are unchanged.
     
-    start = struct
+    The `codegen` backend compiles the resolved types into specialized Python
+    functions, which is slower to set up but faster to parse with."""
+    path = ""
+    if type(definition) != str:
+        path = os.path.dirname(definition.name)
+        definition = definition.read()
     
-    if type(data) == bytes:
-        type_ = BytesIO
-    else:
-        type_ = type(data)
+    if cache:
+        from datamijn import cache as definition_cache
+        cache_dir = definition_cache.default_cache_dir() if cache is True else str(cache)
+        struct = definition_cache.load(cache_dir, definition, path)
+        if struct:
+            return Schema(struct, backend)
     
-    data = type(f"{type_.__name__}WithBits", (IOWithBits, type_), {})(data)
+    files = []
+    stdlib = parse_definition(open(stdlib_path).read(), embed=True)
+    struct = parse_definition(definition, stdlib=stdlib, path=path, files=files)
     
-    result = start.parse_stream(data, lenient=lenient)
-
-    result._structs = struct
-    return result
+    if cache:
+        definition_cache.store(cache_dir, definition, path, struct, files)
+    
+    return Schema(struct, backend)
 
+def parse(definition, data, output_dir=None, lenient=False, backend="interpreter",
+  provenance="full", result="rich", pipe_window=None, lazy=False):
+    return compile(definition, backend=backend).parse(data, output_dir=output_dir,
+        lenient=lenient, provenance=provenance, result=result, pipe_window=pipe_window,
+        lazy=lazy)
@@ -1,5 +1,7 @@
 import pytest
 import os
+import mmap
+import importlib.util
 
 import datamijn
 import datamijn.dmtypes as dmtypes
@@ -1215,6 +1217,13 @@ tile    {tile_type}
     result = datamijn.parse(open(tmpdir.join("test.dm")), b('0011223344556677')*2, tmpdir.join("x"))
     assert str(result.tile._filename) == "tile.png"
     assert open(tmpdir.join("/x/tile.png"))
+    
+    # Each parse saves where it's told to, without changing the schema.
+    schema = datamijn.compile(open(tmpdir.join("test.dm")))
+    for name in ("y", "z"):
+        schema.parse(b('0011223344556677')*2, tmpdir.join(name))
+        assert open(tmpdir.join(f"/{name}/tile.png"))
+    assert "_output_dir" not in vars(schema._struct)
 
 @pytest.mark.xfail
 def test_save_tiles(tmpdir):
@@ -1346,3 +1355,1214 @@ a A"""
         result = datamijn.parse(dm2, b"\x00")
 
 
+
+def test_compile_reuse(monkeypatch):
+    dm = """
+:Coords {
+    x       U8
+    y       U8
+}
+count   U8
+coords  [count]Coords
+"""
+    schema = datamijn.compile(dm)
+    fields = list(schema._struct._fields)
+    
+    def fail(*args, **kwargs):
+        raise AssertionError("definition reparsed")
+    monkeypatch.setattr(datamijn.parsing, "get_parser", fail)
+    
+    result = schema.parse(b("01 0a0b"))
+    assert result.coords[0].x == 0x0a
+    result = schema.parse(b("02 0a0b 1a1b"))
+    assert len(result.coords) == 2
+    assert result.coords[1].y == 0x1b
+    assert schema._struct._fields == fields
+
+def test_compile_cache(tmpdir, monkeypatch):
+    tmpdir.join("color.dm").write("""
+:Color   U8 match {
+    :White
+    :Red
+}
+""")
+    tmpdir.join("foobar.sym").write("""
+00:0001 One
+""")
+    tmpdir.join("test.dm").write("""
+!import color
+!symfile foobar
+
+color       Color
+bits        [4]B2
+one         @sym.One U8
+text        [] U8 char match {
+    0x41 => "A"
+            "B"
+    0x00 => Terminator
+}
+""")
+    cache_dir = tmpdir.join("cache")
+    data = b("01 1b 4241 00")
+    
+    expected = datamijn.parse(open(tmpdir.join("test.dm")), data)._json()
+    schema = datamijn.compile(open(tmpdir.join("test.dm")), cache=cache_dir)
+    assert schema.parse(data)._json() == expected
+    assert len(cache_dir.listdir()) == 1
+    
+    def fail(*args, **kwargs):
+        raise AssertionError("definition reparsed")
+    with monkeypatch.context() as m:
+        m.setattr(datamijn.parsing, "get_parser", fail)
+        cached = datamijn.compile(open(tmpdir.join("test.dm")), cache=cache_dir)
+    assert cached._struct is not schema._struct
+    result = cached.parse(data)
+    assert result._json() == expected
+    assert result.color == result.Color.Red
+    
+    # Touching an imported file invalidates the entry.
+    tmpdir.join("color.dm").write("""
+:Color   U8 match {
+    :Black
+    :White
+}
+""")
+    result = datamijn.compile(open(tmpdir.join("test.dm")), cache=cache_dir).parse(data)
+    assert type(result.color).__name__ == "White"
+
+def test_parser_tables():
+    """ The shipped LALR tables must be regenerated whenever grammar.g changes,
+    using datamijn.parsing.save_parser_tables(). """
+    import pickle
+    import lark
+    with open(datamijn.parsing.parser_tables_path, 'rb') as f:
+        header = pickle.load(f)
+    assert header["grammar"] == datamijn.parsing.parser_tables_header()["grammar"]
+    if header["lark"] != lark.__version__:
+        pytest.skip(f"tables were generated with Lark {header['lark']}")
+    
+    loaded = datamijn.parsing.load_parser_tables()
+    built = datamijn.parsing.build_parser()
+    for filename in ["datamijn/stdlib.dm", "datamijn/test/test2.dm", "datamijn/test/ascii.dm"]:
+        definition = open(filename).read() + "\n"
+        assert loaded.parse(definition) == built.parse(definition)
+
+def test_parser_tables_unreadable(tmpdir):
+    tables = open(datamijn.parsing.parser_tables_path, 'rb').read()
+    for name, data in (("empty", b""), ("garbage", b"not a pickle"),
+      ("truncated", tables[:len(tables) // 2])):
+        path = str(tmpdir.join(name))
+        open(path, 'wb').write(data)
+        assert datamijn.parsing.load_parser_tables(path) is None
+    assert datamijn.parsing.load_parser_tables(str(tmpdir.join("missing"))) is None
+
+def import_times(statement, env=None):
+    import subprocess
+    import sys
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True, text=True, check=True, env=env)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+HEAVY_MODULES = ["lark", "png", "yaml", "oyaml", "urwid", "IPython", "json"]
+
+def test_import_budget():
+    times = import_times("import datamijn.__main__")
+    for module in HEAVY_MODULES:
+        assert module not in times, f"{module} imported eagerly"
+    # microseconds, generous enough to hold without bytecode caches
+    assert times["datamijn"] < 200000
+
+def test_cached_parse_imports(tmpdir):
+    tmpdir.join("test.dm").write("""
+:Coords {
+    x       U8
+    y       U8
+}
+coords  [2]Coords
+""")
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmpdir.join("cache")))
+    statement = f"""
+import datamijn
+result = datamijn.compile(open({str(tmpdir.join("test.dm"))!r}), cache=True).parse(b"abcd")
+assert result.coords[1].y == 0x64
+"""
+    assert "lark" in import_times(statement, env)
+    times = import_times(statement, env)
+    for module in HEAVY_MODULES:
+        assert module not in times, f"{module} imported by a cached parse"
+
+CODEGEN_DEFINITIONS = [
+    ("""
+value   U8
+signed  [4]S8
+short   U16
+""", b("01 007f80ff 0102")),
+    ("""
+:Coords {
+    x       U8
+    y       U8
+    nested  {
+        z       U8
+    }
+}
+count   U8
+coords  [count]Coords
+sum     count + coords[0].x * 2
+""", b("02 010203 040506")),
+    ("""
+foo [3]{
+    bar     10
+    index   I
+}
+refoo [3]{
+    bar     foo[I].bar + I
+}
+numbers     [] U8
+""", b("aabb00")),
+    ("""
+val_ptr         U16
+val_count       U8
+vals            @val_ptr [val_count] U8
+byte            @(val_count + vals[0] - 0xa7) U8
+pos             Pos
+""", b('1000' + '03' + '00'*13 + 'aabbcc')),
+    ("""
+:Item   U8 match {
+    0       => :Zero
+    1       => U8 match {
+        1 => 11
+        2 => 12
+    }
+    2..4    => 2
+    0xff    => Terminator
+    x       => x + 1
+}
+items   [] Item
+:Test {
+    x       U8
+    = x * 2
+}
+array   [2]Test
+""", b("00 0101 03 20 ff 0102")),
+    ("""
+:Char        U8 char match {
+    0x41 => "A"
+            "B"
+    0xe1 => :TextSpeed  U8
+    0x00 => :End Terminator
+}
+string      [] Char
+bits        [8]B1
+stuff [2]{
+    a   U8
+}
+stuff[].d   [2]U8
+""", b("4241e10541 00 aa 0102 0304")),
+    ("""
+:Selfref {
+    a {
+        test U8
+    }
+    x a.test match {
+        32 => Selfref
+        x => x
+    }
+}
+selfref Selfref
+""", b("20 20 05")),
+]
+
+@pytest.mark.parametrize("dm,data", CODEGEN_DEFINITIONS)
+def test_codegen_backend(dm, data):
+    interpreted = datamijn.compile(dm).parse(data)
+    generated = datamijn.compile(dm, backend="codegen").parse(data)
+    assert generated._pretty_repr() == interpreted._pretty_repr()
+    assert generated._json() == interpreted._json()
+
+def test_codegen_backend_complex():
+    interpreted = datamijn.parse(open("datamijn/test/test2.dm"),
+        open("datamijn/test/test.bin", "rb"))
+    generated = datamijn.parse(open("datamijn/test/test2.dm"),
+        open("datamijn/test/test.bin", "rb"), backend="codegen")
+    assert generated._json() == interpreted._json()
+    assert generated.version._trace.param._address == 0
+    assert generated.positions[1].nested.z._path == ["positions", 1, "nested", "z"]
+
+def test_codegen_backend_errors():
+    dm = """
+test0 U8
+test1 [2]U16
+test2 U8
+"""
+    with pytest.raises(datamijn.utils.ReadError) as interpreted:
+        datamijn.parse(dm, b("000102"))
+    with pytest.raises(datamijn.utils.ReadError) as generated:
+        datamijn.parse(dm, b("000102"), backend="codegen")
+    assert str(generated.value) == str(interpreted.value)
+    
+    result = datamijn.parse(dm, b("000102"), lenient=True, backend="codegen")
+    assert result.test0 == 0
+    assert isinstance(result.test1[1], datamijn.utils.ReadError)
+    assert isinstance(result.test2, datamijn.utils.ReadError)
+    assert result._error
+
+FIXED_LAYOUT_DM = """
+:Record {
+    a       U8
+    b       S8
+    c       U16
+    d       U32
+    e       Byte
+    f       Short
+    g       Word
+}
+record      Record
+records     [3]Record
+"""
+FIXED_LAYOUT_RECORD = b("01 ff 0201 04030201 aa 0102 01020304")
+
+def provenance(obj):
+    if isinstance(obj, dict):
+        return [(key, provenance(value)) for key, value in obj.items()]
+    elif isinstance(obj, (list, dmtypes.NumericArray)):
+        return [provenance(value) for value in obj]
+    trace = getattr(obj, "_trace", None)
+    param = getattr(trace, "param", None)
+    return (getattr(obj, "_address", None), getattr(obj, "_size", None),
+        getattr(obj, "_path", None), getattr(param, "_address", None),
+        getattr(param, "_path", None))
+
+def test_fixed_layout(monkeypatch):
+    data = FIXED_LAYOUT_RECORD * 4
+    schema = datamijn.compile(FIXED_LAYOUT_DM)
+    record = schema._struct._contents["record"]
+    assert record._layout.size == len(FIXED_LAYOUT_RECORD)
+    unpacked = schema.parse(data)
+    assert unpacked.record.b == -1
+    assert unpacked.records[2].c == 0x102
+    assert unpacked.records[2].d == 0x1020304
+    assert unpacked.records[2]._address == 3 * len(FIXED_LAYOUT_RECORD)
+    
+    monkeypatch.setattr(record, "_layout", None)
+    parsed = schema.parse(data)
+    assert unpacked._pretty_repr() == parsed._pretty_repr()
+    assert unpacked == parsed
+    assert provenance(unpacked) == provenance(parsed)
+
+def test_fixed_layout_fallback():
+    # Unaligned reads still fail the way they do field by field.
+    with pytest.raises(datamijn.utils.ReadError, match="not byte-aligned"):
+        datamijn.parse("bit B1\n" + FIXED_LAYOUT_DM, b("01") + FIXED_LAYOUT_RECORD * 4)
+    result = datamijn.parse("bits [8]B1\n" + FIXED_LAYOUT_DM, b("01") + FIXED_LAYOUT_RECORD * 4)
+    assert result.records[2].c == 0x102
+    
+    assert datamijn.compile("""
+x {
+    a   U8
+    b   B4
+}
+""")._struct._contents["x"]._layout is None
+    
+    # Short data fails in the same place and the same way.
+    with pytest.raises(datamijn.utils.ReadError) as unpacked:
+        datamijn.parse(FIXED_LAYOUT_DM, FIXED_LAYOUT_RECORD * 3 + b("01ff"))
+    schema = datamijn.compile(FIXED_LAYOUT_DM)
+    schema._struct._contents["record"]._layout = None
+    with pytest.raises(datamijn.utils.ReadError) as parsed:
+        schema.parse(FIXED_LAYOUT_RECORD * 3 + b("01ff"))
+    assert str(unpacked.value) == str(parsed.value)
+    
+    result = datamijn.parse(FIXED_LAYOUT_DM, FIXED_LAYOUT_RECORD * 3 + b("01ff"), lenient=True)
+    assert result.records[1].a == 1
+    assert result.records[2]._error
+
+LAYOUT_DM = """
+:Mon {
+    species     U8
+    moves       [4]U8
+    flags       {
+        shiny       B1
+        gender      B2
+        rest        B5
+    }
+    kind        U8 match {
+        0 => U16
+        _ => [2]Byte
+    }
+    species_at  @(species) U8
+}
+header      [4]Byte
+party       [3]Mon
+count       U8
+names       [count]U8
+tail        U16
+"""
+
+def test_layout(tmp_path):
+    schema = datamijn.compile(LAYOUT_DM)
+    layout = schema.layout()
+    assert [(name, offset) for name, offset, field in layout.fields] \
+        == [("header", 0), ("party", 32), ("count", 248), ("names", 256), ("tail", None)]
+    party = layout.fields[1][2]
+    assert party.size == 27 and party.count == 3
+    mon = party.element
+    assert mon.size == 9
+    assert [(name, offset) for name, offset, field in mon.fields[:4]] \
+        == [("species", 0), ("moves", 8), ("flags", 40), ("kind", 48)]
+    assert [(name, offset, field.bits) for name, offset, field in mon.fields[2][2].fields] \
+        == [("shiny", 0, 1), ("gender", 1, 2), ("rest", 3, 5)]
+    assert layout.fields[3][2].dynamic and layout.dynamic
+    assert layout.fields[4][2].size == 2
+    
+    # Static sizes are what parsing reads.
+    data = b("00000000") + b("0a 01020304 ff 00 3412") * 3 + b("02 0102 0304")
+    result = schema.parse(data)
+    assert result.party._size == party.size
+    assert result.party[1]._size == mon.size
+    assert result.names._address == 32
+    assert datamijn.compile("x [2]{\n a B3\n}\n").layout().fields[0][2].bits == 6
+    assert datamijn.compile("x U8 match {\n 0 => U8\n _ => U16\n}\n").layout().dynamic
+    
+    from click.testing import CliRunner
+    from datamijn.__main__ import cli
+    definition = tmp_path / "layout.dm"
+    definition.write_text(LAYOUT_DM)
+    output = CliRunner().invoke(cli, [str(definition), str(definition), "layout", "--no-cache"]).output
+    lines = [line.split() for line in output.splitlines()]
+    assert lines[0] == ["offset", "size", "field", "type"]
+    assert lines[1] == ["0x0", "4", "header", "[4]ByteByteString"]
+    assert ["0x9.1", "0.2", "gender", "B2"] in lines
+    assert lines[-1] == ["?", "2", "tail", "U16"]
+
+LAZY_ARRAY_DM = """
+:Mon {
+    species     U8
+    level       U8
+    moves       [2]U8
+    flags       U16
+}
+count       U8
+mons        [count]Mon
+third       (mons[2])
+favorite    U8 -> mons
+mons[].ot   [count]U8
+tail        U8
+"""
+
+def test_lazy_array():
+    mons = b"".join(bytes([i, i + 1, i + 2, i + 3]) + b"xy" for i in range(0, 40, 10))
+    data = b("04") + mons + b("01") + b("aabbccdd") + b("ff")
+    eager = datamijn.parse(LAZY_ARRAY_DM, data)
+    schema = datamijn.compile(LAZY_ARRAY_DM)
+    result = schema.parse(data, lazy=True)
+    assert isinstance(result.mons, dmtypes.LazyArray) and isinstance(result.mons, list)
+    # The ones used while parsing are parsed, the others not yet.
+    unparsed = [item is dmtypes.UNPARSED for item in list.__iter__(result.mons)]
+    assert unparsed == [False] * 4
+    
+    result = schema.parse(data, lazy=True)
+    assert result.third.species == 20
+    assert result.favorite.level == 11
+    assert result.mons[-1].moves == [32, 33]
+    assert result.mons[1].ot == 0xbb
+    assert len(result.mons) == 4
+    assert result.mons[1:3] == eager.mons[1:3]
+    assert result.tail == 0xff
+    assert result.mons._address == 1 and result.mons._size == 24
+    assert result.mons[3]._address == 19
+    assert result.mons[3].species._path == ["mons", 3, "species"]
+    assert result._json() == eager._json()
+    assert result.mons == eager.mons
+    
+    dm = "mons [3] {\n a U8\n b U16\n}\n"
+    result = datamijn.parse(dm, b("010200 030400 050600"), lazy=True)
+    assert list.__getitem__(result.mons, 1) is dmtypes.UNPARSED
+    assert result.mons[1].b == 4
+    assert list.__getitem__(result.mons, 0) is dmtypes.UNPARSED
+    assert [mon.a for mon in result.mons] == [1, 3, 5]
+    assert dmtypes.UNPARSED not in list(list.__iter__(result.mons))
+    
+    # Elements that save, print or yield, or whose data isn't all there,
+    # are parsed as usual.
+    assert not isinstance(datamijn.parse("x [2] {\n a U8\n !debug a\n}\n", b("0102"), lazy=True).x,
+        dmtypes.LazyArray)
+    with pytest.raises(datamijn.utils.ReadError):
+        datamijn.parse(dm, b("010200 0304"), lazy=True)
+
+LAZY_STRUCT_DM = """
+magic       U32
+count       U8
+names_at    U16
+items       [count]U8
+after       U8
+flags       U16
+inner       {
+    a       U8
+    b       [2]U8
+}
+tail        {
+    n       U8
+    data    [n]U8
+}
+last        U8
+"""
+
+def test_lazy_struct():
+    data = b("01020304 02 3412 0a0b 07 0880 010203 02 0506 ff")
+    schema = datamijn.compile(LAZY_STRUCT_DM)
+    eager = schema.parse(data)
+    result = schema.parse(data, lazy=True)
+    unparsed = lambda struct: [name for name in struct if dict.__getitem__(struct, name) is dmtypes.UNPARSED]
+    assert isinstance(result, dmtypes.LazyStruct)
+    assert unparsed(result) == list(result)
+    
+    # At a static offset
+    assert result.names_at == 0x1234
+    assert unparsed(result) == ["magic", "count", "items", "after", "flags", "inner", "tail", "last"]
+    # After the fields before it, of which `count` is only parsed for `items`
+    assert result.after == 7
+    assert unparsed(result) == ["magic", "flags", "inner", "tail", "last"]
+    assert result.last == 0xff
+    assert unparsed(result) == ["magic", "flags", "inner"]
+    # Nested structs are lazy too if they always take up the same space.
+    assert isinstance(result.inner, dmtypes.LazyStruct)
+    assert not isinstance(result.tail, dmtypes.LazyStruct)
+    assert result.inner.b == [2, 3]
+    assert result.inner.b._path == ["inner", "b"]
+    assert result.tail._address == 15
+    
+    assert result._json() == eager._json()
+    assert result == eager
+    assert dict(schema.parse(data, lazy=True)) == dict(eager)
+    assert schema.parse(data, lazy=True)._size == eager._size == len(data)
+    
+    # Errors come up when the fields are looked at.
+    result = schema.parse(data[:-3], lazy=True)
+    assert result.after == 7
+    with pytest.raises(datamijn.utils.ReadError):
+        result.last
+    
+    # Structs that print, return or assign to other fields aren't lazy.
+    for dm in ("a U8\n!debug a\n", "a U8\n= a\n", "a [1] {\n b U8\n}\na[].c [1]U8\n"):
+        result = datamijn.parse(dm, b("0102"), lazy=True)
+        assert not isinstance(result, dmtypes.LazyStruct)
+
+NUMERIC_ARRAY_DM = """
+u8      [4]U8
+s8      [2]S8
+u16     [2]U16
+u32     [1]U32
+count   U8
+sized   [count]U8
+at      u16[1]
+joined  (u8 + sized)
+"""
+NUMERIC_ARRAY_DATA = b("01020304 ff7f 01020304 01020304 02 0506")
+
+find_spec = importlib.util.find_spec
+
+def test_numeric_array(monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    schema = datamijn.compile(NUMERIC_ARRAY_DM)
+    result = schema.parse(NUMERIC_ARRAY_DATA)
+    assert isinstance(result.u8, dmtypes.NumericArray)
+    assert isinstance(result.u8._values, numpy.ndarray)
+    assert result.u8 == [1, 2, 3, 4]
+    assert result.s8 == [-1, 127]
+    assert result.u16 == [0x201, 0x403]
+    assert result.u32 == [0x4030201]
+    assert result.sized == [5, 6]
+    assert result.at == 0x403
+    assert len(result.u8) == 4
+    assert result.u8[-1] == 4
+    assert result.u8[1:3] == [2, 3]
+    with pytest.raises(IndexError):
+        result.u8[4]
+    assert result.joined == [1, 2, 3, 4, 5, 6]
+    assert result.joined[4]._path == ["sized", 0]
+    assert repr(result.s8) == str(result.s8) == "[-1, 127]"
+    
+    monkeypatch.setattr(importlib.util, "find_spec",
+        lambda name, *args: None if name == "numpy" else find_spec(name, *args))
+    lists = datamijn.compile(NUMERIC_ARRAY_DM).parse(NUMERIC_ARRAY_DATA)
+    assert not isinstance(lists.u8, dmtypes.NumericArray)
+    assert result._json() == lists._json()
+    assert result._pretty_repr() == lists._pretty_repr()
+    assert provenance(result) == provenance(lists)
+    assert repr(result.joined) == repr(lists.joined)
+    assert (result.u8._address, result.u8._size) == (lists.u8._address, lists.u8._size)
+
+def test_numeric_array_fallback():
+    pytest.importorskip("numpy")
+    with pytest.raises(datamijn.utils.ReadError):
+        datamijn.parse("x [4]U8", b("0102"))
+    result = datamijn.parse("x [4]U8", b("0102"), lenient=True)
+    assert isinstance(result.x, dmtypes.NumericArray)
+    assert result.x[1] == 2
+    assert isinstance(result.x[2], datamijn.utils.ReadError)
+
+INPUT_SOURCE_DM = """
+bits    [3]B1
+ptr     @0x3 U16
+more    B5
+value   U8
+word    U32
+bytes   [2]Byte
+"""
+INPUT_SOURCE_DATA = b("a5 01 02 0403 01020304 ffee")
+
+def test_input_sources(tmpdir, monkeypatch):
+    schema = datamijn.compile(INPUT_SOURCE_DM)
+    result = schema.parse(INPUT_SOURCE_DATA)
+    assert result.bits == [1, 0, 1]
+    assert result.ptr == 0x304
+    assert result.more == 0x14
+    assert result.value == 1
+    assert result.word == 0x1030402
+    assert result.bytes == b("0203")
+    
+    # The same as parsing the old way, from a BytesIO with bits.
+    stream = dmtypes.BytesIOWithBits(INPUT_SOURCE_DATA)
+    assert schema._parse_stream(stream)._pretty_repr() == result._pretty_repr()
+    
+    path = tmpdir.join("test.bin")
+    path.write_binary(INPUT_SOURCE_DATA)
+    for source in (bytearray(INPUT_SOURCE_DATA), memoryview(INPUT_SOURCE_DATA),
+      str(path), open(str(path), 'rb')):
+        assert schema.parse(source)._pretty_repr() == result._pretty_repr()
+    
+    monkeypatch.setattr(dmtypes, "MMAP_THRESHOLD", 0)
+    stream = dmtypes.BufferStream.open(str(path))
+    assert isinstance(stream._buffer, mmap.mmap)
+    assert schema.parse(str(path))._pretty_repr() == result._pretty_repr()
+
+def test_buffer_stream():
+    stream = dmtypes.BufferStream(b("a5 01 02"))
+    assert stream.read_bits(3) == 0b101
+    assert stream.tell() == 1
+    position = stream.position()
+    with pytest.raises(datamijn.utils.ReadError, match="not byte-aligned"):
+        stream.read(1)
+    stream.jump(2)
+    assert stream.read(1) == b("02")
+    stream.restore(position)
+    assert stream.read_bits(5) == 0b10100
+    assert stream.read(1) == b("01")
+    with pytest.raises(datamijn.utils.ReadError, match="out of bounds"):
+        stream.read(2)
+    assert stream.read(2, strict=False) == b("02")
+    assert stream.read_fixed(1) is None
+
+BIT_READER_FIELDS = [("a", 3, False), ("b", 5, True), ("c", 12, False),
+    ("d", 12, True), ("e", 1, False), ("f", 3, True), ("g", 32, True),
+    ("h", 17, False), ("i", 7, True), ("j", 4, False)]
+BIT_READER_DATA = b("a5 3c 0f f0 5a 96 c3 e1 78 1e 87 f4 2b")
+
+def read_bits_reference(data, fields):
+    cursor = 0
+    values = {}
+    for name, bits, msb in fields:
+        value = 0
+        for i in range(bits):
+            byte = data[cursor >> 3]
+            if msb:
+                value = (value << 1) | ((byte >> (7 - (cursor & 7))) & 1)
+            else:
+                value |= ((byte >> (cursor & 7)) & 1) << i
+            cursor += 1
+        values[name] = value
+    return values
+
+def test_bit_reader():
+    fields = "\n".join(f"    {name} {'MSB' if msb else 'B'}{bits}"
+        for name, bits, msb in BIT_READER_FIELDS)
+    expected = read_bits_reference(BIT_READER_DATA, BIT_READER_FIELDS)
+    
+    schema = datamijn.compile("bits {\n" + fields + "\n}")
+    assert dict(schema.parse(BIT_READER_DATA).bits) == expected
+    stream = dmtypes.BytesIOWithBits(BIT_READER_DATA)
+    assert dict(schema._parse_stream(stream).bits) == expected
+    assert stream.tell() == 12
+    
+    piped = datamijn.parse("bits Byte | {\n" + fields + "\n}", BIT_READER_DATA)
+    assert dict(piped.bits) == expected
+    
+    # A definition's own types come first.
+    result = datamijn.parse(":MSB8 {\n    high U8\n    low U8\n}\nvalue MSB8\n", b("1234"))
+    assert (result.value.high, result.value.low) == (0x12, 0x34)
+
+def test_bit_reader_errors():
+    for data in (b("0102"), dmtypes.BytesIOWithBits(b("0102"))):
+        stream = dmtypes.BufferStream(data) if isinstance(data, bytes) else data
+        assert stream.read_bits(4, msb=True) == 0
+        with pytest.raises(datamijn.utils.ReadError,
+          match="out of bounds.\nRead of size 3 at position 0x1"):
+            stream.read_bits(21)
+
+BIT_RUN_DM = """
+:Color {
+    r   B5
+    g   B5
+    b   B5
+    _   B1
+}
+:Mixed {
+    a   MSB3
+    b   MSB5
+    c   B4
+    e   B4
+    d   U8
+    f   B2
+    g   B6
+}
+colors  [3]Color
+mixed   Mixed
+skew {
+    x   B1
+    c   Color
+    y   B7
+}
+"""
+BIT_RUN_DATA = b("1f7c e003 5aa5 b4 3c 81 c3 ff 00 5a")
+
+def disable_bit_runs(type_, seen=None):
+    seen = seen if seen is not None else set()
+    if not isinstance(type_, type) or id(type_) in seen:
+        return
+    seen.add(id(type_))
+    if getattr(type_, "_bit_runs", None):
+        type_._bit_runs = None
+    for sub in list(getattr(type_, "_contents", {}).values()) + [getattr(type_, "_parsetype", None)]:
+        disable_bit_runs(sub, seen)
+
+def test_bit_runs():
+    schema = datamijn.compile(BIT_RUN_DM)
+    mixed = schema._struct._contents["mixed"]
+    assert list(mixed._bit_runs) == ["a", "c", "f"]
+    assert mixed._bit_runs["a"].msb
+    result = schema.parse(BIT_RUN_DATA)
+    assert result.colors[0].r == 0x1f
+    assert result.colors[0].g == 0
+    assert result.colors[0].b == 0x1f
+    assert result.mixed.a == 0b101
+    assert result.mixed.b == 0b10100
+    assert result.skew.y == 0x2d
+    
+    disable_bit_runs(schema._struct)
+    assert not mixed._bit_runs
+    one_by_one = schema.parse(BIT_RUN_DATA)
+    assert result._pretty_repr() == one_by_one._pretty_repr()
+    assert provenance(result) == provenance(one_by_one)
+    assert result.mixed._size == one_by_one.mixed._size == 4
+    
+    generated = datamijn.compile(BIT_RUN_DM, backend="codegen").parse(BIT_RUN_DATA)
+    assert generated._pretty_repr() == result._pretty_repr()
+    assert provenance(generated) == provenance(result)
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_provenance(backend):
+    schema = datamijn.compile(open("datamijn/test/test2.dm"), backend=backend)
+    data = open("datamijn/test/test.bin", "rb").read()
+    full = schema.parse(data)
+    for provenance in ("none", "addresses"):
+        result = schema.parse(data, provenance=provenance)
+        assert result._json() == full._json()
+        assert result._pretty_repr() == full._pretty_repr()
+        assert not hasattr(result.version, "_trace")
+        assert result._error == False
+    
+    assert full.version._trace.param._address == 0
+    addresses = schema.parse(data, provenance="addresses")
+    assert provenance_without_traces(addresses) == provenance_without_traces(full)
+    none = schema.parse(data, provenance="none")
+    assert not hasattr(none.positions[1], "_address")
+    assert not hasattr(none.positions[1].nested.z, "_path")
+    
+    with pytest.raises(ValueError):
+        schema.parse(data, provenance="some")
+
+def provenance_without_traces(obj):
+    if isinstance(obj, dict):
+        return [(key, provenance_without_traces(value)) for key, value in obj.items()]
+    elif isinstance(obj, (list, dmtypes.NumericArray)):
+        return [provenance_without_traces(value) for value in obj]
+    # Traced ints have their address in what they were read from.
+    source = getattr(getattr(obj, "_trace", None), "param", None)
+    if not isinstance(source, (dmtypes.Byte, dmtypes.Short)):
+        source = obj
+    return (getattr(source, "_address", None), getattr(source, "_size", None),
+        getattr(obj, "_path", None))
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+@pytest.mark.parametrize("dm,data", CODEGEN_DEFINITIONS + [
+    (FIXED_LAYOUT_DM, FIXED_LAYOUT_RECORD * 4),
+    (BIT_RUN_DM, BIT_RUN_DATA),
+    (INPUT_SOURCE_DM, INPUT_SOURCE_DATA),
+])
+def test_provenance_levels(backend, dm, data):
+    schema = datamijn.compile(dm, backend=backend)
+    full = schema.parse(data)
+    for provenance in ("none", "addresses"):
+        result = schema.parse(data, provenance=provenance)
+        assert result._pretty_repr() == full._pretty_repr()
+    assert provenance_without_traces(result) == provenance_without_traces(full)
+
+def test_provenance_arithmetic():
+    dm = """
+x   U8
+y   U16
+z   x * 2 + y
+"""
+    full = datamijn.parse(dm, b("02 0100"))
+    untraced = datamijn.parse(dm, b("02 0100"), provenance="none")
+    assert untraced.z == full.z == 5
+    assert type(untraced.z) == type(full.z)
+    assert hasattr(full.z, "_trace")
+    assert not hasattr(untraced.z, "_trace")
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_provenance_lenient(backend):
+    dm = """
+test0 U8
+test1 [2]U16
+test2 U8
+"""
+    result = datamijn.parse(dm, b("000102"), lenient=True, backend=backend, provenance="none")
+    assert result.test0 == 0
+    assert isinstance(result.test1[1], datamijn.utils.ReadError)
+    assert result.test1[1]._error
+    assert isinstance(result.test2, datamijn.utils.ReadError)
+    assert result._error
+
+def plain_types(value):
+    if isinstance(value, dict):
+        return {type(value)} | set().union(*(plain_types(v) for v in value.values()))
+    elif isinstance(value, list):
+        return {type(value)} | set().union(*(plain_types(v) for v in value))
+    return {type(value)}
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_plain_result(backend):
+    schema = datamijn.compile(open("datamijn/test/test2.dm"), backend=backend)
+    data = open("datamijn/test/test.bin", "rb").read()
+    result = schema.parse(data, result="plain")
+    assert result == schema.parse(data)._json()
+    assert plain_types(result) <= {dict, list, int, str, type(None)}
+    
+    small = list(range(256))
+    assert result["positions"][1]["x"] is small[result["positions"][1]["x"]]
+    
+    with pytest.raises(ValueError):
+        schema.parse(data, result="fancy")
+
+def test_plain_result_values():
+    result = datamijn.parse(INPUT_SOURCE_DM, INPUT_SOURCE_DATA, result="plain")
+    assert result == {"bits": [1, 0, 1], "ptr": 0x304, "more": 0x14,
+        "value": 1, "word": 0x1030402, "bytes": b("0203")}
+    assert plain_types(result) == {dict, list, int, bytes}
+    
+    result = datamijn.parse(NUMERIC_ARRAY_DM + FIXED_LAYOUT_DM,
+        NUMERIC_ARRAY_DATA + FIXED_LAYOUT_RECORD * 4, result="plain")
+    assert result["u16"] == [0x201, 0x403]
+    assert result["record"]["e"] == b("aa")
+    assert result["record"]["f"] == b("0201")
+    assert plain_types(result) == {dict, list, int, bytes}
+    
+    result = datamijn.parse("x U8\ny U16", b("01"), lenient=True, result="plain")
+    assert result["x"] == 1
+    assert isinstance(result["y"], datamijn.utils.ReadError)
+
+def test_parse_path():
+    root = dmtypes.ParsePath()
+    path = dmtypes.ParsePath(dmtypes.ParsePath(root, "entries"), 2)
+    assert path == ["entries", 2]
+    assert root == []
+    assert ".".join(str(x) for x in path) == "entries.2"
+    assert path + ["kind"] == ["entries", 2, "kind"]
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_parse_state_paths(backend):
+    dm = """
+:Entry {
+    kind    U8 match {
+        1 => U8
+        _ => U16
+    }
+}
+entries   [3] Entry
+"""
+    schema = datamijn.compile(dm, backend=backend)
+    result = schema.parse(b("01050206"), lenient=True)
+    assert result.entries[0].kind._path == ["entries", 0, "kind", "[1]"]
+    assert result.entries[1].kind._path == ["entries", 1, "kind", "[_]"]
+    assert result.entries[2]._path == ["entries", 2]
+    assert isinstance(result.entries[2].kind, datamijn.utils.ReadError)
+    
+    with pytest.raises(datamijn.utils.ReadError, match=r"Path: entries\.1\.kind\.\[_\]"):
+        schema.parse(b("01050206"))
+
+NAME_BINDING_DM = """
+count U8
+outer {
+    a {
+        b {
+            data [count]U8
+        }
+    }
+}
+:Entry {
+    count U8
+    data [count]U8
+}
+entry Entry
+other U8 match {
+    0 => :Zero
+    x => [x]U8
+}
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_name_binding(backend):
+    schema = datamijn.compile(NAME_BINDING_DM, backend=backend)
+    data_type = schema._struct._contents["outer"]._contents["a"]._contents["b"]._contents["data"]
+    assert (data_type._length._scope, data_type._length._depth) == (schema._struct, 3)
+    result = schema.parse(b("03010203020708020506"))
+    assert list(result.outer.a.b.data) == [1, 2, 3]
+    assert list(result.entry.data) == [7, 8]
+    assert list(result.other) == [5, 6]
+
+MATCH_DISPATCH_DM = """
+:Small U8 match {
+    1 => :One
+    0x10..0x20 => :Teen
+    0x18..0x30 => :Late
+    x => x
+}
+:Big U16 match {
+    1 => :One
+    0x1000..0x2000 => :Range
+    0x1800..0x3000 => :Late
+}
+small [6]Small
+big [4]Big
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_match_dispatch(backend):
+    schema = datamijn.compile(MATCH_DISPATCH_DM, backend=backend)
+    small = schema._struct._contents["small"]._parsetype
+    big = schema._struct._contents["big"]._parsetype
+    assert len(small._table) == 0x30
+    assert big._table is None
+    assert big._range_starts == [0x1000, 0x1800, 0x2000]
+    
+    result = schema.parse(b("01101f202f30" "0100" "0010" "001f" "002f"))
+    assert [type(x).__name__ for x in result.small[:5]] == ["One", "Teen", "Teen", "Late", "Late"]
+    assert result.small[5] == 0x30
+    assert [type(x).__name__ for x in result.big] == ["One", "Range", "Range", "Late"]
+    assert result.big[2]._match_value == 0x1f00
+    
+    with pytest.raises(Exception, match="Parsed value 5, but not present in match"):
+        schema.parse(b("000000000000" "0500" "0000" "0000" "0000"))
+
+CHAR_TRANSLATION_DM = """
+:Char        U8 char match {
+    0x20 => " "
+    0x41 => "A"
+            "B"
+            "C"
+    0x61..0x7b => "x"
+    0xe1 => :TextSpeed  U8
+    0x00 => :End Terminator
+}
+
+terminated  [] Char
+fixed       [8]Char
+lone        [] Char
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_char_translation(backend):
+    schema = datamijn.compile(CHAR_TRANSLATION_DM, backend=backend)
+    char = schema._struct._contents["terminated"]._parsetype
+    assert char._translation[0x41] == "A"
+    assert char._translation[0x7a] == "x"
+    assert char._stop_bytes.match(b"\xe1")
+    assert not char._stop_bytes.match(b"B")
+    
+    data = b"BAC abc\xe1\x05CAB\x00" + b"AB\x00CA\xe1\x07CC" + b"C\x00"
+    result = schema.parse(data)
+    assert result.terminated == ["BAC xxx", result.Char.TextSpeed(5), "CAB", result.Char.End]
+    assert result.fixed == ["AB", result.Char.End, "CA", result.Char.TextSpeed(7), "CC"]
+    assert str(result.terminated) == "BAC xxx<TextSpeed(5)>CAB"
+    assert result.lone[0]._match_value == 0x43
+    
+    char._translation = None
+    assert schema.parse(data)._json() == result._json()
+
+def test_pipe_buffer_window():
+    buffer = dmtypes.PipeBuffer(window=4)
+    buffer.append(b"0123456789")
+    buffer.append(b"abcdef")
+    assert buffer.take(8, 4) == b"89ab"
+    
+    buffer.release(8)
+    assert len(buffer._buffer) == 16
+    
+    dmtypes.PIPE_COMPACT_SIZE, size = 2, dmtypes.PIPE_COMPACT_SIZE
+    try:
+        buffer.release(12)
+    finally:
+        dmtypes.PIPE_COMPACT_SIZE = size
+    assert buffer._base == 8
+    assert buffer.take(8, 8) == b"89abcdef"
+    with pytest.raises(datamijn.utils.ReadError, match="out of the window"):
+        buffer.take(7, 2)
+    buffer.seek(-3, 2)
+    assert buffer.tell() == 13
+    assert buffer.read(3) == b"def"
+    with pytest.raises(datamijn.utils.ReadError, match="out of the window"):
+        buffer.seek(7)
+
+PIPE_WINDOW_DM = """
+data {
+    _bytes  [4]Byte
+    < _bytes
+    _copy   |@-4 [4]Byte
+    < _copy
+    _first  |@0 Byte
+} | [64]U8
+"""
+
+def test_pipe_window(monkeypatch):
+    data = b("01020304")
+    expected = [1, 2, 3, 4] * 16
+    assert datamijn.parse(PIPE_WINDOW_DM, data).data == expected
+    
+    monkeypatch.setattr(dmtypes, "PIPE_COMPACT_SIZE", 8)
+    with pytest.raises(Exception, match="out of the window"):
+        datamijn.parse(PIPE_WINDOW_DM, data, pipe_window=4)
+    dm = PIPE_WINDOW_DM.replace("_first  |@0 Byte", "")
+    assert datamijn.parse(dm, data, pipe_window=4).data == expected
+    with pytest.raises(ValueError, match="must not be negative"):
+        datamijn.parse(dm, data, pipe_window=-1)
+
+BACK_REFERENCE_DM = """
+data {
+    _literal    [3]Byte
+    < _literal
+    _distance   U8
+    _length     U8
+    < |@(0 - _distance) [_length]Byte
+    < |@1 [_length]Byte
+} | [13]Byte
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_pipe_back_reference(backend):
+    data = b("414243 0205")
+    result = datamijn.parse(BACK_REFERENCE_DM, data, backend=backend)
+    bytewise = BACK_REFERENCE_DM.replace("< |@(0 - _distance) [_length]Byte",
+        "_ [_length] {\n < |@(0 - _distance) Byte\n }").replace("< |@1 [_length]Byte",
+        "_ [_length] {\n _i I\n < |@(1 + _i) Byte\n }")
+    assert datamijn.parse(bytewise, data, backend=backend).data == result.data
+    assert result.data == b"ABCBCBCBBCBCB"
+
+    buffer = dmtypes.PipeBuffer()
+    buffer.append(b"xyz")
+    assert buffer.copy(1, 2) == b"yz"
+    assert buffer.copy(1, 5) == b"yzyzy"
+    assert buffer.copy(3, 0) == b""
+    assert buffer.copy(3, 2, strict=False) == b""
+    with pytest.raises(datamijn.utils.ReadError):
+        buffer.copy(3, 2)
+
+BYTE_PIPE_DM = """
+size        U8
+record      ([size]Byte) | {
+    a           U8
+    pos         Pos
+    rest        [4]Byte
+}
+whole       ([3]Byte) | {
+    bytes       [RightSize]Byte
+    end         Pos
+}
+short       ([2]Byte) | [4]U8
+rle         ([6]Byte) | RLE
+nested      Byte | {
+    pair        ([2]Byte) | [2]U8
+}
+after       Pos
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_byte_pipe_view(backend):
+    data = b("05 0102030405 070809 0a0b 0c0d 3003000080 41 1011 ff")
+    result = datamijn.parse(BYTE_PIPE_DM, data, backend=backend)
+    assert result.record.a == 1
+    assert result.record.pos == 1
+    assert result.record.rest == b("02030405")
+    assert result.whole.bytes == b("070809")
+    assert result.whole.end == 3
+    # A right side bigger than the left side's bytes parses it again.
+    assert result.short == [0x0a, 0x0b, 0x0c, 0x0d]
+    assert result.rle == b"AAA"
+    # Inside another pipe's output, which can't be viewed.
+    assert result.nested.pair == [0x10, 0x11]
+    assert result.after == 21
+
+NESTED_RIGHT_SIZE_DM = """
+:Inner {
+    room    RightSize
+    b       U16
+}
+:Outer {
+    room    RightSize
+    a       U8
+    inner   ([2]Byte) | Inner
+}
+viewed      ([3]Byte) | Outer
+streamed    Byte | Outer
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_nested_right_size(backend):
+    result = datamijn.parse(NESTED_RIGHT_SIZE_DM, b("010203 040506"), backend=backend)
+    # Each RightSize is that of the innermost pipe around it.
+    for outer in (result.viewed, result.streamed):
+        assert (outer.room, outer.inner.room) == (3, 2)
+    assert result.viewed.inner.b == 0x302
+    assert result.streamed.inner.b == 0x605
+
+DECOMPRESSORS_DM = """
+lz77        LZ77 | [10]Byte
+rle         RLE | [4]U16
+gsclz       GSCLZ
+zlib        Zlib | [4]Byte
+deflate     Deflate
+after       U8
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_decompressors(backend):
+    import zlib
+    deflate = zlib.compressobj(wbits=-15)
+    data = b("100a0000 10 414243 3002 44") \
+        + b("30080000 82 41 02 42 7879") \
+        + b("01 4142 22 43 44 4445 61 83 0000 a0 80 c1 0001 e0 02 78797a ff") \
+        + zlib.compress(b"zlib data") \
+        + deflate.compress(b"deflated") + deflate.flush() \
+        + b"\x07"
+    result = datamijn.parse(DECOMPRESSORS_DM, data, backend=backend)
+    assert result.lz77 == b"ABCABCABCD"
+    assert result.rle == [0x4141, 0x4141, 0x4241, 0x7978]
+    assert result.gsclz == b"ABCCCDEDED\x00\x00ABCC\xc2BAxyz"
+    assert result.zlib == b"zlib"
+    assert result.deflate == b"deflated"
+    assert result.after == 7
+    
+    with pytest.raises(datamijn.utils.ParseError, match="Expected compression type 0x10"):
+        datamijn.parse("data LZ77", b("30080000"), backend=backend)
+    with pytest.raises(datamijn.utils.ParseError, match="past the end"):
+        datamijn.parse("data LZ77", b("100a0000 10 4142"), backend=backend)
+    with pytest.raises(datamijn.utils.ParseError, match="outside of the"):
+        datamijn.parse("data GSCLZ", b("80 0010 ff"), backend=backend)
+    with pytest.raises(datamijn.utils.ParseError, match="Invalid Zlib data"):
+        datamijn.parse("data Zlib", b"not zlib", backend=backend)
+    result = datamijn.parse("data LZ77\n", b("1000"), lenient=True, backend=backend)
+    assert isinstance(result.data, datamijn.utils.ParseError)
+    assert result.data._error and result._error
+    assert result.data._path == ["data"]
+    
+    # A definition's own types come first.
+    result = datamijn.parse(":RLE {\n    count U8\n    value U8\n}\nrun RLE\n", b("0341"),
+        backend=backend)
+    assert (result.run.count, result.run.value) == (3, 0x41)
+
+def decode_u24(buffer, offset):
+    return int.from_bytes(buffer[offset:offset + 3], 'little'), 3
+
+def decode_u24s(buffer, offset, count):
+    return [int.from_bytes(buffer[i:i + 3], 'little')
+        for i in range(offset, offset + count * 3, 3)], count * 3
+
+def decode_varint(buffer, offset):
+    value = shift = 0
+    for i in range(offset, len(buffer)):
+        value |= (buffer[i] & 0x7f) << shift
+        shift += 7
+        if not buffer[i] & 0x80:
+            return value, i + 1 - offset
+    raise IndexError("varint runs past the end")
+
+def decode_xor(buffer, offset):
+    length = buffer[offset]
+    return bytes(byte ^ 0xff for byte in buffer[offset + 1:offset + 1 + length]), length + 1
+
+BCD = datamijn.primitive("Bcd", lambda buffer, offset: ((buffer[offset] >> 4) * 10 + (buffer[offset] & 0xf), 1), size=1)
+
+EXTENSIONS_DM = """
+one         U24
+many        [2]U24
+varint      VarInt
+sum         one + varint
+xored       Xor | [2]U16
+after       U8
+"""
+
+@pytest.mark.parametrize("backend", datamijn.parsing.BACKENDS)
+def test_extensions(backend):
+    primitive_types = datamijn.parsing.primitive_types
+    datamijn.register_primitive("U24", decode_u24, size=3, batch=decode_u24s)
+    datamijn.register_primitive("VarInt", decode_varint)
+    datamijn.register_pipe_stage("Xor", decode_xor)
+    try:
+        with pytest.raises(ValueError, match="already"):
+            datamijn.register_primitive("U24", decode_u24)
+        with pytest.raises(ValueError, match="capital"):
+            datamijn.primitive("u24", decode_u24)
+        
+        schema = datamijn.compile(EXTENSIONS_DM, backend=backend)
+        assert issubclass(schema._struct._contents["many"], datamijn.extensions.PrimitiveArray)
+        data = b("030201 060504 090807 ac02 04 feff fdff 07")
+        result = schema.parse(data)
+        assert result.one == 0x010203
+        assert result.many == [0x040506, 0x070809]
+        assert result.many._address == 3
+        assert result.varint == 300
+        assert result.sum == 0x010203 + 300
+        assert result.xored == [1, 2]
+        assert result.after == 7
+        
+        with pytest.raises(datamijn.utils.ParseError, match="Failed to decode U24"):
+            datamijn.parse("x U24", b("0102"), backend=backend)
+        result = datamijn.parse("x [2]U24", b("010203 0405"), lenient=True, backend=backend)
+        assert result.x[0] == 0x030201
+        assert isinstance(result.x[1], datamijn.utils.ParseError)
+        assert result.x[1]._error and result._error
+        assert result.x[1]._path == ["x", 1]
+    finally:
+        for name in ("U24", "VarInt", "Xor"):
+            primitive_types.pop(name, None)
+
+def test_extension_entry_points(monkeypatch):
+    from importlib.metadata import EntryPoint
+    entry_point = EntryPoint("Bcd", "datamijn.test_datamijn:BCD", datamijn.extensions.ENTRY_POINT_GROUP)
+    monkeypatch.setattr(datamijn.extensions, "_entry_points", {"Bcd": entry_point})
+    try:
+        # Types defined in the definition come first.
+        assert datamijn.parse(":Bcd U8\nx Bcd\n", b("42")).x == 0x42
+        assert "Bcd" in datamijn.extensions._entry_points
+        
+        assert datamijn.parse("x Bcd\n", b("42")).x == 42
+        assert datamijn.extensions._entry_points == {}
+        assert datamijn.parsing.primitive_types["Bcd"] is BCD
+    finally:
+        datamijn.parsing.primitive_types.pop("Bcd", None)
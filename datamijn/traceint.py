@@ -1,3 +1,5 @@
+import operator
+
 OPERATIONS = "add sub mul floordiv mod".split()
 
 class Source():
@@ -37,6 +39,17 @@ for operation in OPERATIONS:
     func = make_method(int_func)
     setattr(TraceInt, method_name, func)
 
+INT_FUNCTIONS = {getattr(operator, operation): getattr(int, f"__{operation}__")
+    for operation in OPERATIONS}
+
+def untraced(op, left, right):
+    """ op(left, right), but without recording a Source for TraceInts. """
+    if isinstance(left, TraceInt) and op in INT_FUNCTIONS:
+        result = INT_FUNCTIONS[op](int(left), right)
+        if result != NotImplemented:
+            return type(left).__new__(type(left), result)
+    return op(left, right)
+
 # Tiny tests
 def test():
     x = TraceInt(5) + TraceInt(10)
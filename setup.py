@@ -17,4 +17,7 @@ setup(name='datamijn',
         'click',
         'urwid',
       ],
+      extras_require={
+        'numpy': ['numpy'],
+      },
       zip_safe=False)